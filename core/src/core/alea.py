@@ -19,11 +19,35 @@ __license__ = "Cecill-C"
 __revision__ = "$Id$"
 
 import sys
+import time
 from optparse import OptionParser
 #import threading
+
+_start_time = time.time()
 from openalea.core.pkgmanager import PackageManager
 
 
+class StartupProfile(object):
+    """ Duration of the steps of a command (--startup-profile) """
+
+    def __init__(self, start=None):
+        self.start = self.last = start or time.time()
+        self.steps = []
+
+    def step(self, name, info=''):
+        """ End the step name """
+        now = time.time()
+        self.steps.append((name, now - self.last, info))
+        self.last = now
+
+    def report(self):
+        lines = ['Startup profile:']
+        for name, duration, info in self.steps:
+            lines.append('  %-10s %8.3f s  %s' % (name, duration, info))
+        lines.append('  %-10s %8.3f s' % ('total', self.last - self.start))
+        return '\n'.join(lines)
+
+
 def start_qt(factory, node):
     """ Start Qt, and open widget of factory, node
 
@@ -57,17 +81,31 @@ def start_qt(factory, node):
     app.exec_()
 
 
-def load_package_manager(*args):
+def load_package_manager(pkg_id=None, node_id=None, profile=None):
     """ Return the package manager
 
+    If pkg_id is given, only this package and the packages used by its
+    node node_id are registered (see PackageManager.load_package). All
+    the packages are registered if they cannot be found.
+
     :param pkg_id:  package id
     :param node_id: node id
+    :param profile: StartupProfile
     :returns: package manager
 
     """
     pm = PackageManager()
-    pm.init(verbose=False)
+    if profile is not None:
+        profile.step('manager')
 
+    if pkg_id is not None and pm.load_package(pkg_id, node_id):
+        info = 'targeted'
+    else:
+        pm.init(verbose=False)
+        info = 'full discovery'
+
+    if profile is not None:
+        profile.step('packages', '%s, %d packages' % (info, len(pm)))
     return pm
 
 
@@ -83,7 +121,7 @@ def get_node(component, inputs, pm=None):
     pkg_id, node_id = component
 
     if (not pm):
-        pm = load_package_manager()
+        pm = load_package_manager(pkg_id, node_id)
 
     try:
         factory = pm[pkg_id][node_id]
@@ -155,7 +193,7 @@ def query(component, pm=None):
     pkg_id, node_id = component
 
     if (not pm):
-        pm = load_package_manager()
+        pm = load_package_manager(pkg_id, node_id)
 
     # package not found
     if (not pkg_id or not pm.has_key(pkg_id)):
@@ -296,14 +334,85 @@ def _outputs(node):
     #return node.outputs
     return [node.output(i) for i in range(node.get_nb_output())]
 
-def main():
+def main_sweep(argv):
+    """ Parse the options of 'alea sweep' and run the sweep """
+    from openalea.core import sweep
+
+    usage = """
+%prog sweep package_id:node_id [--table FILE] [--grid key=val1,val2 ...]
+             -o RESULTS [-p N] [--retries N] [--timeout S] [--resume]
+
+Evaluate the node for each row of a table of inputs (CSV file with a header
+line or JSON lines file), of the Cartesian product of the grid values, or of
+both. Write the results as JSON lines, one line per row.
+"""
+    parser = OptionParser(usage=usage)
+    parser.add_option("-t", "--table", help="CSV or JSON lines file of inputs")
+    parser.add_option("--grid", action="append", default=[],
+                      help="Values of an input, key=val1,val2,...")
+    parser.add_option("-o", "--output", help="JSON lines file of results")
+    parser.add_option("-p", "--processes", type="int", default=None,
+                      help="Number of worker processes "
+                           "(default, number of CPUs, 0 for none)")
+    parser.add_option("--max-in-flight", type="int", default=None,
+                      help="Maximum number of rows in progress "
+                           "(default, twice the number of processes)")
+    parser.add_option("--retries", type="int", default=1,
+                      help="Number of new evaluations of a failed row")
+    parser.add_option("--timeout", type="float", default=None,
+                      help="Maximum number of seconds to evaluate a row")
+    parser.add_option("--resume", action="store_true", default=False,
+                      help="Skip the rows already in the results file")
+
+    (options, args) = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error("Specify a 'package_id:node_id'")
+    if not options.output:
+        parser.error("Specify a results file (-o)")
+    if not options.table and not options.grid:
+        parser.error("Specify a table or a grid of inputs")
+
+    component = parse_component(args[0])
+    try:
+        axes = sweep.parse_grid(options.grid)
+    except ValueError, error:
+        parser.error(str(error))
+
+    table = options.table
+    if table and axes:
+        rows = (dict(row.items() + values.items())
+                for row in sweep.read_table(table)
+                for values in sweep.grid(axes))
+    elif table:
+        rows = sweep.read_table(table)
+    else:
+        rows = sweep.grid(axes)
+
+    s = sweep.Sweep(component, rows, options.output,
+                    processes=options.processes,
+                    max_in_flight=options.max_in_flight,
+                    retries=options.retries, resume=options.resume,
+                    timeout=options.timeout)
+    done, failed, skipped = s.run()
+    print "%d rows evaluated, %d failed, %d skipped" % (done, failed, skipped)
+    return 1 if failed else 0
+
+
+def main(argv=None):
     """ Parse options """
 
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv and argv[0] == 'sweep':
+        return main_sweep(argv[1:])
+
         # options
     usage = """
 %prog [-r|-q] package_id[:node_id] [-i key1=val1 key2=val2 ...]
 or
 %prog [-r|-q] package_id[/node_id] [-i key1=val1 key2=val2 ...]
+or
+%prog sweep package_id:node_id ... (see %prog sweep --help)
 """
     parser = OptionParser(usage=usage)
 
@@ -326,13 +435,17 @@ or
                        action="store_true", default=False)
 
 
+    parser.add_option("--startup-profile", dest="startup_profile",
+                       help="Print the duration of the startup steps.",
+                       action="store_true", default=False)
+
     parser.add_option("-i", "--input",
                        action="callback", callback=get_intput_callback,
                        help="Specify inputs as KEY=VALUE, KEY=VALUE...",
                        dest="input")
 
     try:
-        (options, args)= parser.parse_args()
+        (options, args)= parser.parse_args(argv)
     except Exception, error:
         parser.print_usage()
         print "Error while parsing args:", error
@@ -348,14 +461,27 @@ or
         import openalea.core.data
         openalea.core.data.PackageData.__local__ = True
 
+    profile = None
+    if options.startup_profile:
+        profile = StartupProfile(_start_time)
+        profile.step('import')
+    pm = load_package_manager(component[0], component[1], profile)
+
     if(options.run):
-        run_and_display(component, options.input, options.gui)
+        run_and_display(component, options.input, options.gui, pm)
+        if profile is not None:
+            profile.step('run')
     else:
-        query(component, )
+        query(component, pm)
+        if profile is not None:
+            profile.step('query')
+
+    if profile is not None:
+        print >> sys.stderr, profile.report()
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
 
 
 # this example need to be fixed
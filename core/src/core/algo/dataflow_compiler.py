@@ -0,0 +1,314 @@
+# -*- python -*-
+#
+#       OpenAlea.Core
+#
+#       Copyright 2006-2009 INRIA - CIRAD - INRA
+#
+#       Distributed under the Cecill-C License.
+#       See accompanying file LICENSE.txt or copy at
+#           http://www.cecill.info/licences/Licence_CeCILL-C_V1-en.html
+#
+#       OpenAlea WebSite: http://openalea.gforge.inria.fr
+#
+###############################################################################
+"""Compilation of a CompositeNode into a Python function.
+
+The vertices evaluated by LambdaEvaluation are visited once, in the same
+order, and each one becomes a line of a generated function: a direct call
+to the function of the node with its inputs bound to local variables or
+to constants. The generated function does not notify the listeners and
+does not modify the nodes of the dataflow.
+
+    >>> compiled = cn.compile()
+    >>> outputs = compiled(a=1, b=2)   # tuple of the composite outputs
+
+The compiled function is a snapshot: the values of the unconnected inputs
+and of the blocked nodes are read at compilation time. Compile again after
+modifying the composite node.
+
+Dataflows with lambda variables, function inputs, generator nodes, delays
+or cycles cannot be compiled and raise CompileError.
+"""
+
+__license__ = "Cecill-C"
+__revision__ = " $Id$ "
+
+import sys
+import itertools
+from copy import copy
+import traceback as tb
+
+from openalea.core.node import Node, FuncNode
+from openalea.core.interface import IFunction
+from openalea.core.algo.dataflow_evaluation import (LambdaEvaluation,
+                                                    EvaluationException,
+                                                    cmp_priority)
+
+
+class CompileError(Exception):
+    """ The dataflow cannot be compiled """
+    pass
+
+
+def single_output(outlist):
+    """ Value of the output of a node with one output (see Node.eval) """
+    try:
+        if hasattr(outlist, "__getitem__") and len(outlist) == 1:
+            return outlist[0]
+    except TypeError:
+        pass
+    return outlist
+
+
+def split_outputs(outlist, defaults):
+    """ Values of the outputs of a node with several outputs
+    (see Node.eval), missing outputs keep their default value """
+    if not isinstance(outlist, (tuple, list)):
+        outlist = (outlist,)
+    if len(outlist) >= len(defaults):
+        return outlist[:len(defaults)]
+    return tuple(outlist) + tuple(defaults[len(outlist):])
+
+
+def eval_actor(actor):
+    """ Return a function evaluating actor with Node.eval,
+    for the actors which cannot be called directly.
+
+    The function evaluates a copy of actor made now, without its
+    listeners: the inputs and outputs of actor are not modified.
+    """
+    actor = copy(actor)
+    nb_output = actor.get_nb_output()
+
+    def eval_actor(inputs):
+        for i, value in enumerate(inputs):
+            actor.set_input(i, value)
+        actor.eval()
+        return [actor.get_output(i) for i in xrange(nb_output)]
+    return eval_actor
+
+
+# numbers of the generated sources
+_compiled = itertools.count()
+
+
+class CompiledDataflow(object):
+    """
+    Function computing the outputs of a composite node from its inputs.
+
+    Call it with the inputs of the composite node, by position or by name.
+    Missing inputs take the value they had at compilation time.
+    Return the tuple of the outputs of the composite node.
+    """
+
+    def __init__(self, function, input_names, defaults, lines, source,
+                 filename='<compiled dataflow>'):
+        self.function = function
+        self.input_names = input_names
+        self.defaults = defaults
+        self.source = source
+        # line of the generated source -> (vid, actor)
+        self._lines = lines
+        # name of the generated source in the tracebacks, unique to
+        # tell it from the sources of the nested composite nodes
+        self.filename = filename
+
+    def __call__(self, *args, **kwds):
+        values = list(self.defaults)
+        if len(args) > len(values):
+            raise TypeError("takes at most %d inputs (%d given)" %
+                            (len(values), len(args)))
+        values[:len(args)] = args
+        for name, value in kwds.iteritems():
+            try:
+                values[self.input_names.index(name)] = value
+            except ValueError:
+                raise TypeError("unknown input '%s'" % (name,))
+
+        try:
+            return self.function(*values)
+        except EvaluationException:
+            raise
+        except Exception, e:
+            exc_tb = sys.exc_info()[2]
+            # find the vertex from the line of the generated function,
+            # the vertex of a nested composite node is the composite node
+            vid, actor = None, None
+            for filename, lineno, func, text in tb.extract_tb(exc_tb):
+                if filename == self.filename:
+                    vid, actor = self._lines.get(lineno, (None, None))
+                    break
+            raise EvaluationException(vid, actor, e, tb.format_tb(exc_tb))
+
+
+class DataflowCompiler(LambdaEvaluation):
+    """ Generate the function of a composite node, visiting the vertices
+    like LambdaEvaluation """
+
+    def __init__(self, dataflow):
+        LambdaEvaluation.__init__(self, dataflow)
+        self._visiting = set()
+        # vid -> list of output expressions
+        self._outputs = {}
+        self._namespace = {}
+        self._code = []
+        self._lines = {}
+
+    def constant(self, value):
+        name = 'c%d' % len(self._namespace)
+        self._namespace[name] = value
+        return name
+
+    def emit(self, line, vid=None):
+        self._code.append('    ' + line)
+        if vid is not None:
+            # first line is the def
+            self._lines[len(self._code) + 1] = (vid, self._dataflow.actor(vid))
+
+    def output(self, vid, actor, index):
+        """ Expression of the output index of vertex vid """
+        outputs = self._outputs.get(vid)
+        if outputs is None:
+            return self.constant(actor.get_output(index))
+        return outputs[index]
+
+    def input_expressions(self, vid, actor):
+        """ Return the expressions of the inputs of vid,
+        the parents are compiled first """
+        df = self._dataflow
+        nb_input = actor.get_nb_input()
+        exprs = [None] * nb_input
+
+        for pid, input_index in self.in_ports(vid):
+            interface = actor.input_desc[input_index].get('interface', None)
+            if interface is IFunction:
+                raise CompileError("vertex %s has a function input" % vid)
+
+            values = []
+            for npid, nvid, nactor in self.get_parent_nodes(pid):
+                if nvid in self._visiting:
+                    raise CompileError("cycle through vertex %s" % nvid)
+                if not self.is_stopped(nvid, nactor):
+                    self.eval_vertex(nvid)
+                values.append(self.output(nvid, nactor, df.local_id(npid)))
+
+            if len(values) == 1:
+                exprs[input_index] = values[0]
+            elif values:
+                exprs[input_index] = '[%s]' % ', '.join(values)
+
+        for i in xrange(nb_input):
+            if exprs[i] is None:
+                exprs[i] = self.constant(actor.get_input(i))
+        return exprs
+
+    def eval_vertex(self, vid, *args):
+        """ Compile vertex vid and its parents """
+        from openalea.core.compositenode import CompositeNode
+        from openalea.core.system.systemnodes import LambdaVar
+
+        df = self._dataflow
+        actor = df.actor(vid)
+
+        self._evaluated.add(vid)
+
+        if vid == df.id_in:
+            self._outputs[vid] = ['i%d' % i
+                                  for i in xrange(actor.get_nb_output())]
+            return
+
+        if not isinstance(actor, Node):
+            # annotations
+            self._outputs[vid] = []
+            return
+
+        if (isinstance(actor, LambdaVar) or
+            getattr(actor, 'generator', False) or
+            getattr(actor, 'delay', 0)):
+            raise CompileError("vertex %s cannot be compiled (%s)" %
+                               (vid, actor.__class__.__name__))
+
+        self._visiting.add(vid)
+        exprs = self.input_expressions(vid, actor)
+        self._visiting.discard(vid)
+
+        if vid == df.id_out:
+            self._result = exprs
+            return
+
+        nb_output = actor.get_nb_output()
+        outputs = ['v%d_%d' % (vid, i) for i in xrange(nb_output)]
+        self._outputs[vid] = outputs
+        args = ', '.join(exprs)
+        f = 'f%d' % vid
+
+        # call of the node and outputs made of its return value
+        cls = type(actor)
+        if isinstance(actor, CompositeNode):
+            self._namespace[f] = actor.compile().function
+            call, exact = '%s(%s)' % (f, args), True
+        elif actor.memoize or cls.eval.im_func is not Node.eval.im_func:
+            self._namespace[f] = eval_actor(actor)
+            call, exact = '%s([%s])' % (f, args), True
+        elif (isinstance(actor, FuncNode) and actor.func and
+              cls.__call__.im_func is FuncNode.__call__.im_func):
+            self._namespace[f] = actor.func
+            call, exact = '%s(%s)' % (f, args), False
+        else:
+            self._namespace[f] = actor.__call__
+            call, exact = '%s([%s])' % (f, args), False
+
+        if nb_output == 0:
+            self.emit(call, vid)
+        elif exact:
+            self.emit('%s, = %s' % (', '.join(outputs), call), vid)
+        elif nb_output == 1:
+            self.emit('%s = single_output(%s)' % (outputs[0], call), vid)
+        else:
+            defaults = self.constant(tuple(actor.outputs))
+            self.emit('%s, = split_outputs(%s, %s)' %
+                      (', '.join(outputs), call, defaults), vid)
+
+    def compile(self):
+        """ Return the CompiledDataflow of the dataflow """
+        df = self._dataflow
+        self._evaluated.clear()
+        self._result = None
+
+        # same vertices as CompositeNode.__call__
+        if df.id_out is not None and df.get_nb_output() > 0:
+            self.eval_vertex(df.id_out)
+        else:
+            leaves = [(vid, df.actor(vid)) for vid in self.leaves()]
+            leaves.sort(cmp_priority)
+            for vid, actor in leaves:
+                if not self.is_stopped(vid, actor):
+                    self.eval_vertex(vid)
+
+        nb_input = df.get_nb_input() if df.id_in is not None else 0
+        params = ['i%d' % i for i in xrange(nb_input)]
+        if self._result is None:
+            self._result = [self.constant(df.get_output(i))
+                            for i in xrange(df.get_nb_output())]
+
+        source = '\n'.join(['def compiled_dataflow(%s):' % ', '.join(params)]
+                           + self._code +
+                           ['    return (%s)' % ''.join(r + ', ' for r in
+                                                        self._result)])
+
+        namespace = dict(self._namespace,
+                         single_output=single_output,
+                         split_outputs=split_outputs)
+        filename = '<compiled dataflow %d>' % next(_compiled)
+        code = compile(source + '\n', filename, 'exec')
+        exec code in namespace
+
+        input_names = [df.input_desc[i]['name'] for i in xrange(nb_input)]
+        defaults = [df.get_input(i) for i in xrange(nb_input)]
+        return CompiledDataflow(namespace['compiled_dataflow'], input_names,
+                                defaults, self._lines, source, filename)
+
+
+def compile_dataflow(composite_node):
+    """ Return a CompiledDataflow computing the outputs of composite_node """
+    return DataflowCompiler(composite_node).compile()
@@ -20,73 +20,33 @@ __license__ = "Cecill-C"
 __revision__ = " $Id$ "
 
 import sys
-from time import clock
+import heapq
+import cPickle
+import multiprocessing
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from Queue import Queue, Empty
+from time import clock, time
 import traceback as tb
 from openalea.core import ScriptLibrary
 
 from openalea.core.dataflow import SubDataflow
 from openalea.core.interface import IFunction
+from openalea.core.observer import AbstractListener, observed_batch
+from openalea.core.algo import profiling
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 PROVENANCE = False
 
-# Implement provenance in OpenAlea
-db_conn = None
-
-import sqlite3
-from openalea.core.path import path
-from openalea.core import settings
-
-def db_create(cursor):
-    cur = cursor
-    #-prospective provenance-#
-    #User table creation
-    cur.execute("CREATE TABLE IF NOT EXISTS User (userid INTEGER,createtime DATETIME,name varchar (25), firstname varchar (25), email varchar (25), password varchar (25),PRIMARY KEY(userid))")
-
-    # CompositeNode table creation
-    cur.execute("CREATE TABLE IF NOT EXISTS CompositeNode (CompositeNodeid INTEGER, creatime DATETIME, name varchar (25), description varchar (25),userid INTEGER,PRIMARY KEY(CompositeNodeid),FOREIGN KEY(userid) references User)")
-    #Cr?ation de la table Node
-    cur.execute("CREATE TABLE IF NOT EXISTS Node (Nodeid INTEGER, createtime DATETIME, name varchar (25), NodeFactory varchar (25),CompositeNodeid INTEGER,PRIMARY KEY(Nodeid),FOREIGN KEY(CompositeNodeid) references CompsiteNode)")
-    #Cr?ation de la table Input
-    cur.execute("CREATE TABLE IF NOT EXISTS Input (Inputid INTEGER, createtime DATETIME, name varchar (25), typedata varchar (25), InputPort INTEGER,PRIMARY KEY (Inputid))")
-    #Cr?ation de la table Output
-    cur.execute("CREATE TABLE IF NOT EXISTS Output (Outputid INTEGER, createtime DATETIME, name varchar (25), typedata varchar (25), OutputPort INTEGER,PRIMARY KEY (Outputid))")
-    #Cr?ation de la table elt_connection
-    cur.execute("CREATE TABLE IF NOT EXISTS elt_connection (elt_connectionid INTEGER, createtime DATETIME,srcNodeid INTEGER, srcNodeOutputPortid INTEGER, targetNodeid INTEGER, targetNodeInputPortid INTEGER ,PRIMARY KEY (elt_connectionid))")
-
-    #- retrospective provenance -#
-    #- CompositeNodeExec table creation
-    cur.execute("CREATE TABLE IF NOT EXISTS CompositeNodeExec (CompositeNodeExecid INTEGER, createtime DATETIME, endtime DATETIME,userid INTEGER,CompositeNodeid INTEGER,PRIMARY KEY(CompositeNodeExecid),FOREIGN KEY(CompositeNodeid) references CompositeNode,FOREIGN KEY(userid) references User)")
-    #- NodeExec 
-    cur.execute("CREATE TABLE IF NOT EXISTS NodeExec (NodeExecid INTEGER, createtime DATETIME, endtime DATETIME,Nodeid INTEGER,CompositeNodeExecid INTEGER,dataid INTEGER,PRIMARY KEY(NodeExecid),FOREIGN KEY(Nodeid) references Node, FOREIGN KEY (CompositeNodeExecid) references CompositeNodeExec, FOREIGN KEY (dataid) references Data)")
-    #- History
-    cur.execute("CREATE TABLE IF NOT EXISTS Histoire (Histoireid INTEGER, createtime DATETIME, name varchar (25), description varchar (25),userid INTEGER,CompositeNodeExecid INTEGER,PRIMARY KEY (Histoireid), FOREIGN KEY(Userid) references User, FOREIGN KEY(CompositeNodeExecid) references CompositeNodeExec)")
-    #- Data
-    cur.execute("CREATE TABLE IF NOT EXISTS Data (dataid INTEGER, createtime DATETIME,NodeExecid INTEGER, PRIMARY KEY(dataid),FOREIGN KEY(NodeExecid) references NodeExec)")
-    #- Tag
-    cur.execute("CREATE TABLE IF NOT EXISTS Tag (CompositeNodeExecid INTEGER, createtime DATETIME, name varchar(25),userid INTEGER,PRIMARY KEY(CompositeNodeExecid),FOREIGN KEY(userid) references User)")
-    return cur
-
-def get_database_name():
-    db_fn = path(settings.get_openalea_home_dir())/'provenance.sq3'
-    return db_fn
-
-def db_connexion():
-    """ Return a curso on the database.
-
-    If the database does not exists, create it.
-    """
-    global db_conn
-    if db_conn is None:
-        db_fn = get_database_name()
-        if not db_fn.exists():
-            db_conn=sqlite3.connect(db_fn)
-            cur = db_conn.cursor()
-            cur = db_create(cur)
-            return cur
-    else:
-        cur = db_conn.cursor()
-        return cur
+# Implement provenance in OpenAlea (see ProvenanceStore)
+from openalea.core import provenance as provenance_store
+from openalea.core.provenance import (db_create, get_database_name,
+                                      db_connexion)
 
 class Provenance(object):
     def __init__(self, workflow):
@@ -173,6 +133,19 @@ def cmp_priority(x, y):
     return cmp(py, px)
 
 
+def to_vector(chunk):
+    """ Return chunk as a NumPy array if its elements are numbers,
+    as a list otherwise """
+    if numpy is not None:
+        try:
+            vector = numpy.asarray(chunk)
+            if vector.dtype.kind in 'biufc':
+                return vector
+        except Exception:
+            pass
+    return list(chunk)
+
+
 # order function to sort by pos x
 
 
@@ -205,6 +178,14 @@ class AbstractEvaluation(object):
         self._dataflow = dataflow
         if PROVENANCE:
             self.provenance = PrintProvenance(dataflow)
+        # Run of the ProvenanceStore (see CompositeNode.eval_as_expression)
+        self._run = None
+
+        # Structure of the dataflow, kept until its topology changes
+        self._topology_version = None
+        self._leaves = None
+        self._in_ports = {}
+        self._parent_nodes = {}
 
     def eval(self, *args):
         """todo"""
@@ -221,12 +202,23 @@ class AbstractEvaluation(object):
         """
 
         node = self._dataflow.actor(vid)
+        profiler = profiling.active
+        run = self._run
 
         try:
             t0 = clock()
-            ret = node.eval()
+            if run is not None:
+                start = time()
+            if profiler is None:
+                ret = node.eval()
+            else:
+                ret = profiler.eval_node(self._dataflow, vid, node)
             t1 = clock()
 
+            if run is not None:
+                store = provenance_store.active
+                if store is not None:
+                    store.node_exec(run, vid, node, start, time())
             if PROVENANCE:
                 self.provenance.node_exec(vid, node, t0,t1)
                 #provenance(vid, node, t0,t1)
@@ -236,7 +228,10 @@ class AbstractEvaluation(object):
             node.raise_exception = False
             # if hasattr(node, 'raise_exception'):
             #     del node.raise_exception
-            node.notify_listeners(('data_modified', None, None))
+            if profiler is None:
+                node.notify_listeners(('data_modified', None, None))
+            else:
+                profiler.notify(node, ('data_modified', None, None))
             return ret
 
         except EvaluationException, e:
@@ -255,25 +250,80 @@ class AbstractEvaluation(object):
                 tb.format_tb(sys.exc_info()[2]))
 
 
+    def check_topology(self):
+        """
+        Clear the cached structure of the dataflow if its topology has
+        changed since the last call.
+        """
+        version = self._dataflow.topology_version()
+        if version != self._topology_version:
+            self._topology_version = version
+            self._leaves = None
+            self._in_ports.clear()
+            self._parent_nodes.clear()
+
+    def leaves(self):
+        """ Return the list of vertex ids without out edges """
+        self.check_topology()
+
+        if self._leaves is None:
+            df = self._dataflow
+            self._leaves = [vid for vid in df.vertices()
+                            if df.nb_out_edges(vid) == 0]
+
+        return self._leaves
+
+    def in_ports(self, vid):
+        """
+        Return the list of in ports of vid
+        The list contains tuples (pid, input_index)
+        """
+        self.check_topology()
+
+        ports = self._in_ports.get(vid)
+        if ports is None:
+            df = self._dataflow
+            ports = [(pid, df.local_id(pid)) for pid in df.in_ports(vid)]
+            self._in_ports[vid] = ports
+
+        return ports
+
     def get_parent_nodes(self, pid):
         """
         Return the list of parent node connected to pid
         The list contains tuples (port_pid, node_pid, actor)
         This list is sorted by the x value of the node
         """
+        self.check_topology()
 
-        df = self._dataflow
+        npids = self._parent_nodes.get(pid)
+        if npids is None:
+            df = self._dataflow
 
-        # For each connected node
-        npids = [(npid, df.vertex(npid), df.actor(df.vertex(npid))) \
-                     for npid in df.connected_ports(pid)]
-        npids.sort(cmp=cmp_posx)
+            # For each connected node
+            npids = [(npid, df.vertex(npid), df.actor(df.vertex(npid))) \
+                         for npid in df.connected_ports(pid)]
+            self._parent_nodes[pid] = npids
+
+        # Positions are not part of the topology
+        if len(npids) > 1:
+            npids = sorted(npids, cmp=cmp_posx)
 
         return npids
 
     def set_provenance(self, provenance):
         self.provenance = provenance
 
+    def profile(self, *args, **kwds):
+        """
+        Evaluate the dataflow with a new profiler (see algo.profiling)
+        and return the profiler.
+        """
+        profiler = profiling.Profiler()
+        with profiler:
+            self.eval(*args, **kwds)
+        return profiler
+
 class BrutEvaluation(AbstractEvaluation):
     """ Basic evaluation algorithm """
     __evaluators__.append("BrutEvaluation")
@@ -311,7 +361,7 @@ class BrutEvaluation(AbstractEvaluation):
         self._evaluated.add(vid)
 
         # For each inputs
-        for pid in df.in_ports(vid):
+        for pid, input_index in self.in_ports(vid):
             inputs = []
 
             cpt = 0
@@ -327,7 +377,7 @@ class BrutEvaluation(AbstractEvaluation):
             if (cpt == 1):
                 inputs = inputs[0]
             if (cpt > 0):
-                actor.set_input(df.local_id(pid), inputs)
+                actor.set_input(input_index, inputs)
 
         # Eval the node
         self.eval_vertex_code(vid)
@@ -341,7 +391,7 @@ class BrutEvaluation(AbstractEvaluation):
         self._evaluated.clear()
 
         # Eval from the leaf
-        for vid in (vid for vid in df.vertices() if df.nb_out_edges(vid)==0):
+        for vid in self.leaves():
             self.eval_vertex(vid)
 
         t1 = clock()
@@ -369,8 +419,7 @@ class PriorityEvaluation(BrutEvaluation):
             return self.eval_vertex(vtx_id, *args)
 
         # Select the leaves (list of (vid, actor))
-        leaves = [(vid, df.actor(vid))
-              for vid in df.vertices() if df.nb_out_edges(vid)==0]
+        leaves = [(vid, df.actor(vid)) for vid in self.leaves()]
 
         leaves.sort(cmp_priority)
 
@@ -417,7 +466,7 @@ class GeneratorEvaluation(AbstractEvaluation):
         self._evaluated.add(vid)
 
         # For each inputs
-        for pid in df.in_ports(vid):
+        for pid, input_index in self.in_ports(vid):
             inputs = []
 
             cpt = 0
@@ -434,7 +483,7 @@ class GeneratorEvaluation(AbstractEvaluation):
             if (cpt == 1):
                 inputs = inputs[0]
             if (cpt > 0):
-                actor.set_input(df.local_id(pid), inputs)
+                actor.set_input(input_index, inputs)
 
         # Eval the node
         ret = self.eval_vertex_code(vid)
@@ -446,6 +495,7 @@ class GeneratorEvaluation(AbstractEvaluation):
     def eval(self, vtx_id=None, step=False):
         t0 = clock()
 
+        self.clear()
         df = self._dataflow
 
         if (vtx_id is not None):
@@ -453,8 +503,7 @@ class GeneratorEvaluation(AbstractEvaluation):
 
         else:
             # Select the leafs (list of (vid, actor))
-            leafs = [(vid, df.actor(vid))
-                for vid in df.vertices() if df.nb_out_edges(vid)==0]
+            leafs = [(vid, df.actor(vid)) for vid in self.leaves()]
 
         leafs.sort(cmp_priority)
 
@@ -473,6 +522,232 @@ class GeneratorEvaluation(AbstractEvaluation):
 
 
 
+class BatchEvaluation(GeneratorEvaluation):
+    """
+    Generator evaluation driving an iteration node in batches.
+
+    The evaluation of a leaf depending on one iteration node (a node with
+    a `batches` method, like IterNode) is split in two parts:
+
+      - the nodes which do not depend on the iteration node are evaluated
+        once,
+      - the elements produced by the iteration node are pushed through its
+        cone (the nodes between the iteration node and the leaf) in a
+        precomputed order, without walking the graph again.
+
+    Elements are read by chunks of `batch_size` elements. Nodes with the
+    `vectorized` flag whose parents in the cone are vectorized too are
+    evaluated once per chunk on the whole chunk, a NumPy array when the
+    elements are numbers and NumPy is available, a list otherwise. Their
+    outputs must be sequences of the same length as the chunk. The other
+    nodes of the cone are evaluated once per element. Their inputs are
+    notified for the first element of a chunk only and the notifications
+    of a chunk are coalesced (see observed_batch): the listeners of a node
+    receive its last notification of each kind once per chunk.
+
+    An iteration node producing no element does not evaluate its cone,
+    while GeneratorEvaluation evaluates it once with the output of the
+    iteration node unchanged (None for IterNode).
+
+    Leaves depending on several generator nodes are evaluated with
+    GeneratorEvaluation.
+    """
+    __evaluators__.append("BatchEvaluation")
+
+    batch_size = 1024
+
+    def ancestors(self, vid, stop=()):
+        """ Return the set of vertices evaluated before vid, vid included.
+        The walk does not go through the vertices in stop. """
+        df = self._dataflow
+        visited = set([vid])
+        stack = [vid]
+        while stack:
+            v = stack.pop()
+            if v in stop:
+                continue
+            for pid, input_index in self.in_ports(v):
+                for npid, nvid, nactor in self.get_parent_nodes(pid):
+                    if nvid not in visited and not nactor.block:
+                        visited.add(nvid)
+                        stack.append(nvid)
+        return visited
+
+    def find_iterator(self, vid):
+        """ Return the vertex id of the iteration node the evaluation of vid
+        depends on, or None if it cannot be evaluated in batches """
+        df = self._dataflow
+        generators = [v for v in self.ancestors(vid)
+                      if getattr(df.actor(v), 'generator', False) or
+                      getattr(df.actor(v), 'delay', 0)]
+        if (len(generators) == 1 and
+            hasattr(df.actor(generators[0]), 'batches')):
+            return generators[0]
+        return None
+
+    def plan(self, iter_vid, vid):
+        """ Return the vertices of the cone of iter_vid evaluated for vid,
+        in evaluation order """
+        df = self._dataflow
+        ancestors = self.ancestors(vid)
+        # the iteration node must not depend on its own elements
+        iter_ancestors = self.ancestors(iter_vid)
+        iter_ancestors.discard(iter_vid)
+
+        # descendants of the iteration node which are evaluated for vid
+        cone = set([iter_vid])
+        stack = [iter_vid]
+        while stack:
+            v = stack.pop()
+            for nvid in df.out_neighbors(v):
+                if (nvid in ancestors and nvid not in cone and
+                    not df.actor(nvid).block):
+                    cone.add(nvid)
+                    stack.append(nvid)
+        if cone & iter_ancestors:
+            return None
+
+        # same order as GeneratorEvaluation.eval_vertex: depth first,
+        # parents before children, without recursion for long cones
+        order = []
+        visited = set([vid])
+        stack = [(vid, self.cone_parents(vid, cone))]
+        while stack:
+            v, parents = stack[-1]
+            for nvid in parents:
+                if nvid not in visited:
+                    visited.add(nvid)
+                    stack.append((nvid, self.cone_parents(nvid, cone)))
+                    break
+            else:
+                stack.pop()
+                order.append(v)
+
+        order.remove(iter_vid)
+        return order
+
+    def cone_parents(self, vid, cone):
+        """ Return an iterator on the parents of vid in cone, in the order
+        of the input ports """
+        return (nvid for pid, input_index in self.in_ports(vid)
+                for npid, nvid, nactor in self.get_parent_nodes(pid)
+                if nvid in cone)
+
+    def eval_invariant(self, order):
+        """ Evaluate the parents of the vertices in order which are not in
+        order, and return the inputs of each vertex as a list of
+        (input index, [(parent vid, parent actor, output index)]) """
+        df = self._dataflow
+        in_order = set(order)
+        inputs = {}
+        for vid in order:
+            vid_inputs = inputs[vid] = []
+            for pid, input_index in self.in_ports(vid):
+                parents = []
+                for npid, nvid, nactor in self.get_parent_nodes(pid):
+                    if nvid not in in_order and not self.is_stopped(nvid,
+                                                                    nactor):
+                        GeneratorEvaluation.eval_vertex(self, nvid)
+                    parents.append((nvid, nactor, df.local_id(npid)))
+                if parents:
+                    vid_inputs.append((input_index, parents))
+        return inputs
+
+    def set_inputs(self, actor, inputs):
+        """ Set the inputs of actor from the outputs of its parents """
+        for input_index, parents in inputs:
+            values = [nactor.get_output(port)
+                      for nvid, nactor, port in parents]
+            actor.set_input(input_index,
+                            values[0] if len(values) == 1 else values)
+
+    def eval_batches(self, iter_vid, vid):
+        """ Evaluate vid for each element of the iteration node iter_vid.
+        Return False if the cone cannot be evaluated in batches. """
+        df = self._dataflow
+        order = self.plan(iter_vid, vid)
+        if order is None:
+            return False
+
+        iterator = df.actor(iter_vid)
+
+        self.clear()
+        self._evaluated.add(iter_vid)
+        self._evaluated.update(order)
+        self.set_inputs(iterator, self.eval_invariant([iter_vid])[iter_vid])
+        inputs = self.eval_invariant(order)
+
+        # vertices evaluated once per chunk
+        vectorized = set()
+        for v in order:
+            if (df.actor(v).vectorized and
+                all(nvid == iter_vid or nvid in vectorized
+                    for input_index, parents in inputs[v]
+                    for nvid, nactor, port in parents
+                    if nvid == iter_vid or nvid in inputs)):
+                vectorized.add(v)
+        scalar = [v for v in order if v not in vectorized]
+        vectorized = [v for v in order if v in vectorized]
+
+        # vertices evaluated per element: (vid, actor,
+        # [(input index, [(parent actor, output index, per element)])])
+        steps = []
+        for v in scalar:
+            steps.append((v, df.actor(v),
+                          [(input_index,
+                            [(nactor, port, nvid in vectorized)
+                             for nvid, nactor, port in parents])
+                           for input_index, parents in inputs[v]]))
+
+        for chunk in iterator.batches(self.batch_size):
+            with observed_batch():
+                if vectorized:
+                    iterator.outputs[0] = to_vector(chunk)
+                    for v in vectorized:
+                        self.set_inputs(df.actor(v), inputs[v])
+                        self.eval_vertex_code(v)
+
+                for i, element in enumerate(chunk):
+                    iterator.outputs[0] = element
+                    # the inputs are notified for the first element only
+                    notify = i == 0
+                    for v, actor, v_inputs in steps:
+                        for input_index, parents in v_inputs:
+                            values = []
+                            for nactor, port, per_element in parents:
+                                value = nactor.get_output(port)
+                                if per_element:
+                                    value = value[i]
+                                values.append(value)
+                            actor.set_input(input_index, values[0]
+                                            if len(values) == 1 else values,
+                                            notify)
+                        self.eval_vertex_code(v)
+
+        iterator.notify_listeners(('data_modified', None, None))
+        return True
+
+    def eval(self, vtx_id=None, step=False):
+        df = self._dataflow
+
+        if (vtx_id is not None):
+            leafs = [(vtx_id, df.actor(vtx_id))]
+        else:
+            leafs = [(vid, df.actor(vid)) for vid in self.leaves()]
+
+        leafs.sort(cmp_priority)
+
+        for vid, actor in leafs:
+            if actor.block:
+                continue
+            iter_vid = self.find_iterator(vid)
+            if iter_vid is None or not self.eval_batches(iter_vid, vid):
+                GeneratorEvaluation.eval(self, vid)
+
+        self.clear()
+        return False
+
+
 class LambdaEvaluation(PriorityEvaluation):
     """ Evaluation algorithm with support of lambda / priority and selection"""
     __evaluators__.append("LambdaEvaluation")
@@ -510,9 +785,8 @@ class LambdaEvaluation(PriorityEvaluation):
         use_lambda = False
 
         # For each inputs
-        for pid in df.in_ports(vid):
+        for pid, input_index in self.in_ports(vid):
 
-            input_index = df.local_id(pid)
             inputs = []
 
             # Get input interface
@@ -622,6 +896,112 @@ class LambdaEvaluation(PriorityEvaluation):
             self._resolution_node.clear()
 
 
+class TopologicalEvaluation(LambdaEvaluation):
+    """ Evaluation algorithm with support of lambda / priority and selection
+    which does not use recursion.
+
+    The semantic is the one of LambdaEvaluation, but the dataflow is walked
+    with an explicit stack, so that deep dataflows do not reach the python
+    recursion limit.
+    """
+    __evaluators__.append("TopologicalEvaluation")
+
+    def eval_vertex(self, vid, context, lambda_value, *args):
+        """
+        Evaluate the vertex vid and its parents.
+
+        Each vertex is processed by a generator (see eval_vertex_steps)
+        which yields the parents to evaluate before going on.
+        The generators are stacked instead of recursive calls.
+        """
+        stack = [self.eval_vertex_steps(vid, context, lambda_value)]
+
+        while stack:
+            try:
+                parent = stack[-1].next()
+            except StopIteration:
+                stack.pop()
+            else:
+                stack.append(self.eval_vertex_steps(*parent))
+
+    def eval_vertex_steps(self, vid, context, lambda_value):
+        """
+        Generator evaluating the vertex vid.
+
+        Yield (nvid, context, lambda_value) for each parent which has to be
+        evaluated before reading its outputs.
+        See LambdaEvaluation.eval_vertex for the lambda resolution.
+        """
+
+        df = self._dataflow
+        actor = df.actor(vid)
+
+        # Do not evaluate a node which is blocked
+        if self.is_stopped(vid, actor):
+            return
+
+        self._evaluated.add(vid)
+
+        use_lambda = False
+
+        for pid, input_index in self.in_ports(vid):
+            parents = self.get_parent_nodes(pid)
+            if not parents:
+                continue
+
+            # Get input interface
+            interface = actor.input_desc[input_index].get('interface', None)
+
+            if (interface is IFunction):
+                transmit_cxt = None
+                transmit_lambda = None
+            else:
+                transmit_cxt = context
+                transmit_lambda = lambda_value
+
+            inputs = []
+            for npid, nvid, nactor in parents:
+
+                # Do no reevaluate the same node
+                if not self.is_stopped(nvid, nactor):
+                    yield nvid, transmit_cxt, transmit_lambda
+
+                outval = nactor.get_output(df.local_id(npid))
+
+                if (isinstance(outval, SubDataflow)
+                   and interface is not IFunction):
+
+                    if (not context and not lambda_value):
+                        # we are not in resolution mode
+                        use_lambda = True
+                        self._resolution_node.add(vid)
+                    else:
+                        if (not lambda_value.has_key(outval)):
+                            try:
+                                lambda_value[outval] = context.pop()
+                            except Exception:
+                                raise Exception("The number of lambda variables is insuffisant")
+
+                        # We replace the value with a context value
+                        outval = lambda_value[outval]
+
+                inputs.append(outval)
+
+            # set input as a list or a simple value
+            if (len(inputs) == 1):
+                inputs = inputs[0]
+            actor.set_input(input_index, inputs)
+
+        # Eval the node
+        if (not use_lambda):
+            self.eval_vertex_code(vid)
+
+        else:
+            # set the node output with subdataflow
+            for i in xrange(actor.get_nb_output()):
+                actor.set_output(i, SubDataflow(df, self, vid, i))
+
+
 DefaultEvaluation = LambdaEvaluation
 #DefaultEvaluation = GeneratorEvaluation
 
@@ -784,73 +1164,731 @@ DefaultEvaluation = LambdaEvaluation
 
 
 
-# from openalea.core.threadmanager import ThreadManager
-# import thread
+def _eval_in_process(data):
+    """ Evaluate a pickled node in a worker process.
 
-# class ParallelEvaluation(LambdaEvaluation):
-#     """ Parallel execution of a dataflow """
+    Return (result, error, None) where result is (outputs, delay) pickled
+    and error is None or (exception, traceback).
+    """
+    try:
+        node = cPickle.loads(data)
+        delay = node.eval()
+        outputs = [node.get_output(i) for i in xrange(node.get_nb_output())]
+        # pickled here: the pool does not call the callback of a task
+        # whose result cannot be sent back
+        return cPickle.dumps((outputs, delay), -1), None, None
+    except Exception, e:
+        # the exception may not be picklable
+        e = Exception('%s: %s' % (e.__class__.__name__, e))
+        return None, (e, tb.format_tb(sys.exc_info()[2])), None
+
+
+def _future_result(future):
+    """ Return the result of a future evaluating
+    ParallelEvaluation.eval_in_thread or _eval_in_process, or its exception
+    as an error """
+    try:
+        return future.result()
+    except Exception, e:
+        return None, (e, tb.format_tb(sys.exc_info()[2])), None
+
+
+_pools = {} # (num_workers, processes) -> pool
+
+
+def get_pool(num_workers=None, processes=False):
+    """ Return a shared pool of worker threads or processes. """
+    key = (num_workers, processes)
+    if key not in _pools:
+        if processes:
+            _pools[key] = multiprocessing.Pool(num_workers)
+        else:
+            _pools[key] = ThreadPool(num_workers)
+    return _pools[key]
 
 
-#     def get_output_value(self, nvid, nactor, npid):
-#             """ Return the value of a node output """
+class ParallelEvaluation(PriorityEvaluation):
+    """ Parallel evaluation of the independent branches of a dataflow.
+
+    Each vertex is evaluated as soon as all its parents are, on a pool of
+    threads or of processes. Lambdas (SubDataflow) are not resolved by this
+    algorithm.
+
+    With threads, the notifications sent by the nodes during their
+    evaluation are delivered by the thread calling eval when the node is
+    completed, so the listeners (e.g. Qt widgets) are called in this
+    thread.
+    """
+    __evaluators__.append("ParallelEvaluation")
+
+    # Default configuration of the pool
+    NUM_WORKERS = 4
+    PROCESSES = False
+    # Seconds between two checks of the tasks lost by the pool
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, dataflow, pool=None, num_workers=None, processes=None):
+        """
+        :param dataflow: the dataflow to evaluate
+        :param pool: a multiprocessing pool (apply_async) or a
+            concurrent.futures executor (submit). If None, a shared pool is
+            created with num_workers threads or processes.
+        :param num_workers: number of workers of the default pool
+        :param processes: if True, evaluate the nodes in worker processes.
+            The nodes are then pickled and their outputs sent back.
+        """
+        PriorityEvaluation.__init__(self, dataflow)
+
+        if num_workers is None:
+            num_workers = self.NUM_WORKERS
+        if processes is None:
+            processes = self.PROCESSES
+
+        self.num_workers = num_workers
+        self.processes = processes
+        self._pool = pool
+        # worker processes seen during the evaluation, see lost_tasks
+        self._workers = set()
+
+    def get_pool(self):
+        """ Return the pool used to evaluate the nodes """
+        if self._pool is None:
+            self._pool = get_pool(self.num_workers, self.processes)
+        return self._pool
+
+    def dependencies(self, leaves):
+        """
+        Select the vertices to evaluate to compute the leaves.
+
+        Return (nb_parents, children) where nb_parents maps each selected
+        vertex to its number of selected parents, and children maps each
+        selected vertex to the set of selected vertices it feeds.
+        """
+        df = self._dataflow
+
+        nb_parents = {}
+        children = {}
+        scan_list = deque(leaves)
+        for vid in leaves:
+            children[vid] = set()
+
+        while scan_list:
+            vid = scan_list.popleft()
+
+            parents = set()
+            for pid, input_index in self.in_ports(vid):
+                for npid, nvid, nactor in self.get_parent_nodes(pid):
+                    if not self.is_stopped(nvid, nactor):
+                        parents.add(nvid)
+
+            nb_parents[vid] = len(parents)
+            for nvid in parents:
+                if nvid not in children:
+                    children[nvid] = set()
+                    scan_list.append(nvid)
+                children[nvid].add(vid)
+
+        return nb_parents, children
+
+    def check_cycles(self, nb_parents):
+        """ Raise an EvaluationException if vertices have not been
+        evaluated because they are on a cycle """
+        left = sorted(vid for vid, nb in nb_parents.iteritems() if nb > 0)
+        if left:
+            e = RuntimeError("Vertices %s are on a cycle" % (left,))
+            raise EvaluationException(left[0], self._dataflow.actor(left[0]),
+                                      e, [])
+
+    def set_inputs(self, vid):
+        """ Set the inputs of vid from the outputs of its parents """
+
+        df = self._dataflow
+        actor = df.actor(vid)
+
+        for pid, input_index in self.in_ports(vid):
+            inputs = [nactor.get_output(df.local_id(npid))
+                      for npid, nvid, nactor in self.get_parent_nodes(pid)]
+
+            # set input as a list or a simple value
+            if (len(inputs) == 1):
+                inputs = inputs[0]
+            if inputs:
+                actor.set_input(input_index, inputs)
+
+    def eval_in_thread(self, vid):
+        """ Evaluate vid in a worker thread with eval_vertex_code, so that
+        the profiler and the provenance store record it.
+
+        Return (result, error, notifications) where error is None or
+        (exception, traceback) and notifications is the NotificationBatch
+        of the notifications sent during the evaluation, to be delivered by
+        the calling thread.
+        """
+        with observed_batch() as batch:
+            try:
+                result, error = self.eval_vertex_code(vid), None
+            except EvaluationException, e:
+                result, error = None, (e, e.exc_info)
+            notifications = batch.take()
+        return result, error, notifications
+
+    def get_task(self, vid):
+        """ Return (func, arg) evaluating vid in the pool,
+        see eval_in_thread and _eval_in_process """
+        actor = self._dataflow.actor(vid)
+        if self.processes:
+            actor.notify_listeners(("start_eval",))
+            return _eval_in_process, cPickle.dumps(actor, -1)
+        return self.eval_in_thread, vid
+
+    def submit(self, vid, results):
+        """
+        Set the inputs of vid and submit its evaluation to the pool.
+
+        When done, (vid, result, error, notifications) is put in the
+        results queue. Return the AsyncResult of the task if the pool is a
+        multiprocessing pool, see lost_tasks.
+        """
+
+        actor = self._dataflow.actor(vid)
+        self._evaluated.add(vid)
+
+        try:
+            self.set_inputs(vid)
+
+            # lazy evaluation: no need to use a worker
+            is_blocked = (actor.block and actor.get_nb_output() != 0 and
+                          actor.get_output(0) is not None)
+            is_lazy = (actor.delay == 0 and actor.lazy and
+                       not actor.modified)
+            if is_blocked or is_lazy:
+                results.put((vid, None, None, None))
+                return None
+
+            func, arg = self.get_task(vid)
+        except Exception, e:
+            results.put((vid, None, (e, tb.format_tb(sys.exc_info()[2])),
+                         None))
+            return None
+
+        pool = self.get_pool()
+        if hasattr(pool, 'submit'):
+            future = pool.submit(func, arg)
+            future.add_done_callback(
+                lambda f: results.put((vid,) + _future_result(f)))
+            return None
+        else:
+            # the pool replaces its dead workers, see lost_tasks
+            self._workers.update(getattr(pool, '_pool', ()))
+            return pool.apply_async(func, (arg,),
+                             callback=lambda ret: results.put((vid,) + ret))
+
+    def lost_tasks(self, tasks):
+        """
+        Return the (vid, error) of the tasks (vid -> AsyncResult) which
+        will not put their result in the queue: the failed ones (the pool
+        does not call their callback) and, if a worker process has died,
+        the ones not completed.
+        """
+        pool = self.get_pool()
+        self._workers.update(getattr(pool, '_pool', ()))
+        died = [w for w in self._workers
+                if getattr(w, 'exitcode', None) not in (None, 0)]
+
+        lost = []
+        for vid, task in tasks.iteritems():
+            if task.ready():
+                if not task.successful():
+                    try:
+                        task.get()
+                    except Exception, e:
+                        exc_info = tb.format_tb(sys.exc_info()[2])
+                        lost.append((vid, (e, exc_info)))
+            elif died:
+                e = RuntimeError("Worker process %s has died (exit code %s)"
+                                 % (died[0].pid, died[0].exitcode))
+                lost.append((vid, (e, [])))
+        return lost
+
+    def wait_result(self, results, tasks):
+        """ Return the next (vid, result, error, notifications) of results.
+        The lost tasks (see lost_tasks) are removed from tasks and
+        returned with their error. """
+        while True:
+            try:
+                return results.get(timeout=self.POLL_INTERVAL)
+            except Empty:
+                for vid, error in self.lost_tasks(tasks):
+                    del tasks[vid]
+                    results.put((vid, None, error, None))
+
+    def complete(self, vid, result, error, notifications=None):
+        """
+        Update the node vid once its evaluation is done.
+
+        Raise an EvaluationException if the evaluation has failed.
+        """
+
+        node = self._dataflow.actor(vid)
+        if notifications is not None:
+            notifications.deliver()
+
+        if error is not None:
+            e, exc_info = error
+            # an EvaluationException of vid comes from eval_vertex_code,
+            # which has already set the flag and notified the node
+            if not (isinstance(e, EvaluationException) and e.vid == vid):
+                node.raise_exception = True
+                node.notify_listeners(('data_modified', None, None))
+            if isinstance(e, EvaluationException):
+                e.vid = vid
+                e.node = node
+                raise e
+            raise EvaluationException(vid, node, e, exc_info)
+
+        if self.processes:
+            if result is not None:
+                outputs, delay = cPickle.loads(result)
+                for i, value in enumerate(outputs):
+                    node.set_output(i, value)
+                node.modified = False
+                node.notify_listeners(("stop_eval",))
+
+            node.raise_exception = False
+            node.notify_listeners(('data_modified', None, None))
+
+    def eval(self, vtx_id=None, *args, **kwds):
+        """
+        Evaluate the dataflow from vtx_id, or from all the leaves if vtx_id
+        is None.
+        """
+        t0 = clock()
+        df = self._dataflow
+
+        self._evaluated.clear()
+        self._workers.clear()
+
+        if (vtx_id is not None):
+            leaves = [vtx_id]
+        else:
+            leaves = [(vid, df.actor(vid)) for vid in self.leaves()]
+            leaves.sort(cmp_priority)
+            leaves = [vid for vid, actor in leaves]
+
+        leaves = [vid for vid in leaves
+                  if not self.is_stopped(vid, df.actor(vid))]
+        nb_parents, children = self.dependencies(leaves)
+
+        ready = [(vid, df.actor(vid))
+                 for vid, nb in nb_parents.iteritems() if nb == 0]
+        results = Queue()
+        running = set()
+        # vid -> AsyncResult of the running vertices, see lost_tasks
+        tasks = {}
+        error = None
+
+        while ready or running:
+            # Submit the ready vertices by priority
+            ready.sort(cmp_priority)
+            for vid, actor in ready:
+                running.add(vid)
+                task = self.submit(vid, results)
+                if task is not None:
+                    tasks[vid] = task
+            ready = []
+
+            vid, result, err, notifications = self.wait_result(results,
+                                                                tasks)
+            if vid not in running:
+                # reported as lost before completing
+                continue
+            running.discard(vid)
+            tasks.pop(vid, None)
+
+            if error is not None:
+                # Wait for the running nodes before raising
+                if notifications is not None:
+                    notifications.deliver()
+                continue
+            try:
+                self.complete(vid, result, err, notifications)
+            except EvaluationException, e:
+                error = e
+                continue
+
+            for cvid in children[vid]:
+                nb_parents[cvid] -= 1
+                if nb_parents[cvid] == 0:
+                    ready.append((cvid, df.actor(cvid)))
+
+        t1 = clock()
+        if quantify:
+            print "Evaluation time: %s"%(t1-t0)
+
+        if error is not None:
+            raise error
+        self.check_cycles(nb_parents)
+
+
+def is_future(obj):
+    """ Return True if obj is a future: an object with the result and
+    add_done_callback methods of concurrent.futures.Future """
+    return hasattr(obj, 'result') and hasattr(obj, 'add_done_callback')
+
+
+def is_asynchronous(actor):
+    """ Return True if actor waits on I/O, see node.asynchronous """
+    method = getattr(actor, 'is_asynchronous', None)
+    return method is not None and method()
+
+
+class AsyncEvaluation(ParallelEvaluation):
+    """ Evaluation of the nodes waiting on I/O concurrently with the others.
+
+    The asynchronous nodes (see node.asynchronous) are evaluated in worker
+    threads and the other nodes in the calling thread. The outputs of a
+    node which are futures are replaced by their results once they are all
+    done. A vertex is evaluated when all its parents are completed, and at
+    most max_concurrency asynchronous nodes and nodes waiting for futures
+    are pending at the same time (the nodes evaluated in the calling thread
+    may start futures beyond this limit). eval returns once the evaluation
+    is complete. Lambdas (SubDataflow) are not resolved by this algorithm.
+
+    The notifications sent by the asynchronous nodes during their
+    evaluation are delivered by the thread calling eval when the node is
+    completed, so the listeners (e.g. Qt widgets) are called in this
+    thread.
+    """
+    __evaluators__.append("AsyncEvaluation")
+
+    # Default maximum number of pending nodes
+    MAX_CONCURRENCY = 8
+
+    def __init__(self, dataflow, max_concurrency=None, pool=None):
+        """
+        :param dataflow: the dataflow to evaluate
+        :param max_concurrency: maximum number of pending nodes
+        :param pool: a pool of threads (apply_async) or a
+            concurrent.futures executor (submit). If None, a shared pool of
+            max_concurrency threads is used.
+        """
+        if max_concurrency is None:
+            max_concurrency = self.MAX_CONCURRENCY
+        ParallelEvaluation.__init__(self, dataflow, pool,
+                                    num_workers=max_concurrency,
+                                    processes=False)
+        self.max_concurrency = max_concurrency
+
+    def wait_futures(self, vid, results):
+        """ Return the number of the outputs of vid which are futures.
+        When each one is done, (vid, None, None, None) is put in
+        results. """
+        futures = [value for value in self._dataflow.actor(vid).outputs
+                   if is_future(value)]
+        for future in futures:
+            future.add_done_callback(
+                lambda f: results.put((vid, None, None, None)))
+        return len(futures)
+
+    def set_results(self, vid):
+        """ Replace the outputs of vid which are futures by their results.
+
+        Raise an EvaluationException if a future has failed.
+        """
+        node = self._dataflow.actor(vid)
+        try:
+            for i, value in enumerate(node.outputs):
+                if is_future(value):
+                    node.set_output(i, value.result())
+        except Exception, e:
+            node.raise_exception = True
+            node.notify_listeners(('data_modified', None, None))
+            raise EvaluationException(vid, node, e,
+                                      tb.format_tb(sys.exc_info()[2]))
+
+    def eval(self, vtx_id=None, *args, **kwds):
+        """
+        Evaluate the dataflow from vtx_id, or from all the leaves if vtx_id
+        is None.
+        """
+        t0 = clock()
+        df = self._dataflow
+
+        self._evaluated.clear()
 
-#             l = self.locks[nvid]
+        if (vtx_id is not None):
+            leaves = [vtx_id]
+        else:
+            leaves = [(vid, df.actor(vid)) for vid in self.leaves()]
+            leaves.sort(cmp_priority)
+            leaves = [vid for vid, actor in leaves]
+
+        leaves = [vid for vid in leaves
+                  if not self.is_stopped(vid, df.actor(vid))]
+        nb_parents, children = self.dependencies(leaves)
+
+        ready = [(vid, df.actor(vid))
+                 for vid, nb in nb_parents.iteritems() if nb == 0]
+        # asynchronous vertices waiting for a worker
+        waiting = []
+        # pending vertex -> number of results expected in the queue
+        pending = {}
+        # vid -> AsyncResult of the asynchronous vertices, see lost_tasks
+        tasks = {}
+        # pending vertices waiting for futures
+        awaited = set()
+        results = Queue()
+        error = None
+
+        def completed(vid):
+            for cvid in children[vid]:
+                nb_parents[cvid] -= 1
+                if nb_parents[cvid] == 0:
+                    ready.append((cvid, df.actor(cvid)))
+
+        while ready or waiting or pending:
+            # Evaluate the ready vertices by priority
+            while ready and error is None:
+                ready.sort(cmp_priority)
+                batch, ready[:] = ready[:], []
+                for vid, actor in batch:
+                    if is_asynchronous(actor):
+                        waiting.append((vid, actor))
+                        continue
+                    self._evaluated.add(vid)
+                    try:
+                        self.set_inputs(vid)
+                        self.eval_vertex_code(vid)
+                    except EvaluationException, e:
+                        error = e
+                        break
+                    nb = self.wait_futures(vid, results)
+                    if nb:
+                        pending[vid] = nb
+                        awaited.add(vid)
+                    else:
+                        completed(vid)
+
+            if error is not None:
+                # Wait for the pending vertices before raising
+                del ready[:], waiting[:]
+            else:
+                waiting.sort(cmp_priority)
+                while waiting and len(pending) < self.max_concurrency:
+                    vid, actor = waiting.pop(0)
+                    pending[vid] = 1
+                    task = self.submit(vid, results)
+                    if task is not None:
+                        tasks[vid] = task
+
+            if not pending:
+                continue
+
+            vid, result, err, notifications = self.wait_result(results,
+                                                                tasks)
+            if vid not in pending:
+                # reported as lost before completing
+                continue
+            if notifications is not None:
+                notifications.deliver()
+            pending[vid] -= 1
+            if pending[vid]:
+                continue
+            del pending[vid]
+            tasks.pop(vid, None)
+
+            if error is not None:
+                continue
+            try:
+                if vid in awaited:
+                    awaited.discard(vid)
+                    self.set_results(vid)
+                else:
+                    if err is not None:
+                        self.complete(vid, result, err)
+                    nb = self.wait_futures(vid, results)
+                    if nb:
+                        pending[vid] = nb
+                        awaited.add(vid)
+                        continue
+            except EvaluationException, e:
+                error = e
+                continue
+            completed(vid)
 
-#             l.acquire()
-#             v = nactor.get_output(self._dataflow.local_id(npid))
-#             l.release()
+        t1 = clock()
+        if quantify:
+            print "Evaluation time: %s"%(t1-t0)
 
-#             return v
+        if error is not None:
+            raise error
+        self.check_cycles(nb_parents)
 
 
-#     def eval_one_vertex (self, vid, context, lambda_value):
-#         """ Evaluate only one vertex
-#         @param vid: id of vertex to evalaute
-#         @param context: list of values to assign to variables
-#         @param lambda_value: dictionary of previous assigned values
-#         """
-#         LambdaEvaluation.eval_one_vertex(self, vid, context, lambda_value)
-#         self.locks[vid].release()
+class IncrementalEvaluation(PriorityEvaluation, AbstractListener):
+    """ Evaluate only the nodes downstream of the modified ones.
 
+    The evaluation listens to the nodes of the dataflow. A node is dirty
+    when it notifies an input modification, when it is not lazy, when the
+    inputs of the composite node have changed or when it is flagged as
+    modified at the start of the evaluation (inputs set without
+    notification, or with the notification delayed by an observed_batch).
+    Only the downstream cone of the dirty nodes is evaluated: the rest of
+    the dataflow is not visited and its outputs are used as they are.
 
+    All the nodes are dirty after a change of topology.
 
-#     def eval_vertex (self, vid, context, *args):
-#         """ Evaluate the graph starting at the vertex vid
-#         @param vid: starting vertex id
-#         @param context list of values to assign to variables
-#         """
+    Like PriorityEvaluation, it does not handle the lambda variables and
+    the SubDataflow nodes of LambdaEvaluation: use LambdaEvaluation for
+    such dataflows.
+    """
+    __evaluators__.append("IncrementalEvaluation")
 
-#         lambda_value = {}
+    def __init__(self, dataflow):
+        PriorityEvaluation.__init__(self, dataflow)
+        AbstractListener.__init__(self)
+
+        self._watched_version = None
+        # id(actor) -> vid of the listened actors
+        self._vids = {}
+        # (vid, actor) of the listened actors, but the composite node
+        # inputs and outputs, checked for modifications at each evaluation
+        self._actors = []
+        self._dirty = set()
+        # non lazy nodes, dirty at each evaluation
+        self._volatile = set()
+        self._inputs = None
+        self._cone = set()
+        self._running = False
+
+    def notify(self, sender, event):
+        """ Mark the sender dirty when its inputs are modified """
+        if self._running or not event:
+            return
+        vid = self._vids.get(id(sender))
+        if vid is None:
+            return
 
-#         tm = ThreadManager()
-#         tm.clear()
+        if event[0] == "input_modified":
+            self._dirty.add(vid)
+        elif event[0] == "internal_data_changed" and \
+                event[1] in ("lazy", "delay"):
+            self.update_volatile(vid, sender)
 
-#         # Get the node order
-#         process_list = self.scan_graph(vid, context)
+    def update_volatile(self, vid, actor):
+        if not getattr(actor, "lazy", True) or getattr(actor, "delay", 0):
+            self._volatile.add(vid)
+        else:
+            self._volatile.discard(vid)
 
-#         # Synchronisation locks
-#         self.locks = {}
+    def watch(self):
+        """
+        Listen to the nodes of the dataflow if its topology has changed.
+        All the nodes are dirty then.
+        """
+        self.check_topology()
+        if self._watched_version == self._topology_version:
+            return
+        self._watched_version = self._topology_version
 
-#         for vid, context in process_list:
+        df = self._dataflow
+        self._vids.clear()
+        self._volatile.clear()
+        self._actors = []
+        io = (getattr(df, "id_in", None), getattr(df, "id_out", None))
+        for vid in df.vertices():
+            actor = df.actor(vid)
+            if actor is None:
+                continue
+            self._vids[id(actor)] = vid
+            if vid not in io:
+                self._actors.append((vid, actor))
+            if hasattr(actor, "register_listener"):
+                actor.register_listener(self)
+            self.update_volatile(vid, actor)
+
+        self._dirty = set(self._vids.itervalues())
+
+    def inputs_changed(self):
+        """ Return True if the inputs of the composite node have changed """
+        df = self._dataflow
+        id_in = getattr(df, "id_in", None)
+        if id_in is None:
+            return False
 
-#             if (self.locks.has_key(vid)): continue
-#             l = thread.allocate_lock()
-#             l.acquire()
-#             self.locks[vid] = l
+        inputs = list(df.actor(id_in).outputs)
+        old, self._inputs = self._inputs, inputs
+        if old is None or len(old) != len(inputs):
+            return True
+        for v1, v2 in zip(old, inputs):
+            if v1 is not v2:
+                return True
+        return False
 
+    def downstream(self, vids):
+        """ Return the set of vids and of all their children """
+        df = self._dataflow
+        cone = set(vids)
+        scan_list = list(cone)
+        while scan_list:
+            for nvid in df.out_neighbors(scan_list.pop()):
+                if nvid not in cone:
+                    cone.add(nvid)
+                    scan_list.append(nvid)
+        return cone
 
-#         # Eval each node
-#         scanned = set()
+    def is_stopped(self, vid, actor):
+        """ Return True if evaluation must be stop at this vertex """
+        if vid not in self._cone:
+            return True
+        return PriorityEvaluation.is_stopped(self, vid, actor)
 
-#         for vid, context in process_list:
-#             if (vid not in scanned):
-#                 tm.add_task( self.eval_one_vertex, (vid, context, lambda_value))
-#             scanned.add(vid)
+    def eval(self, vtx_id=None, *args, **kwds):
+        """ Evaluate the nodes downstream of the dirty ones
 
+        If vtx_id is not None, only the dirty ancestors of vtx_id and
+        vtx_id itself are evaluated.
+        """
+        t0 = clock()
+        df = self._dataflow
+
+        self.watch()
+        if self.inputs_changed():
+            self._dirty.add(df.id_in)
+        self._dirty.update(self._volatile)
+        # modified without a notification received by the listener
+        self._dirty.update(vid for vid, actor in self._actors
+                           if getattr(actor, "modified", False))
+
+        self._cone = cone = self.downstream(self._dirty)
+        self._evaluated.clear()
+        self._running = True
+        try:
+            if vtx_id is not None:
+                cone.add(vtx_id)
+                self.eval_vertex(vtx_id, *args)
+            else:
+                leaves = [(vid, df.actor(vid)) for vid in cone
+                          if df.nb_out_edges(vid) == 0]
+                leaves.sort(cmp_priority)
+
+                for vid, actor in leaves:
+                    if vid not in self._evaluated:
+                        self.eval_vertex(vid, *args)
+        except:
+            self._dirty = set(cone)
+            raise
+        else:
+            # the part of the cone not evaluated stays dirty
+            self._dirty = cone - self._evaluated
+        finally:
+            self._running = False
+
+        t1 = clock()
+        if quantify:
+            print "Evaluation time: %s"%(t1-t0)
 
 
-# DefaultEvaluation = ParallelEvaluation
-# #DefaultEvaluation = LambdaEvaluation
 class ToScriptEvaluation(AbstractEvaluation):
     """ Basic transformation into script algorithm """
     __evaluators__.append("ToScriptEvaluation")
@@ -875,7 +1913,7 @@ class ToScriptEvaluation(AbstractEvaluation):
 
         script = ""
         # For each inputs
-        for pid in df.in_ports(vid):
+        for pid, input_index in self.in_ports(vid):
             # For each connected node
             for npid, nvid, nactor in self.get_parent_nodes(pid):
                 if not self.is_stopped(nvid, nactor):
@@ -896,7 +1934,7 @@ class ToScriptEvaluation(AbstractEvaluation):
 
         # Eval from the leaf
         script = ""
-        for vid in (vid for vid in df.vertices() if df.nb_out_edges(vid)==0):
+        for vid in self.leaves():
             script += self.eval_vertex(vid)
 
         return script
@@ -907,9 +1945,23 @@ class ToScriptEvaluation(AbstractEvaluation):
 # The objective is to take
 
 class DiscreteTimeEvaluation(AbstractEvaluation):
-    """ Evaluation algorithm with generator / priority and selection"""
+    """
+    Evaluation algorithm with generator / priority and selection
+
+    A node returning a delay d when it is evaluated at cycle c is evaluated
+    again at cycle c + d, its outputs do not change in between. The
+    simulation stops when a delayed node returns no delay or when the next
+    event is after the horizon.
+
+    The first cycle evaluates the dataflow. The scheduler then jumps to the
+    cycle of the next delayed node and evaluates only the delayed nodes due
+    at this cycle and the nodes which depend on them.
+    """
     __evaluators__.append("DiscreteTimeEvaluation")
 
+    # last cycle of a simulation, None for no limit
+    horizon = 1000
+
     def __init__(self, dataflow):
 
         AbstractEvaluation.__init__(self, dataflow)
@@ -922,9 +1974,10 @@ class DiscreteTimeEvaluation(AbstractEvaluation):
         # one unit.
 
         self._current_cycle = 0
-        # timed nodes are a dict with vid, time >0
-        # when time is 0, remove the node from the dict
+        # timed nodes: vid -> cycle of their next evaluation
         self._timed_nodes = dict()
+        # events: heap of (cycle, vid), may contain outdated events
+        self._events = []
         self._stop = False
         self._nodes_to_reset = []
 
@@ -947,11 +2000,58 @@ class DiscreteTimeEvaluation(AbstractEvaluation):
         self._stop = False
         self._nodes_to_reset = []
 
-    def next_step(self):
-        """ Update the scheduler of one step. """
-        self._current_cycle += 1
-        for vid in self._timed_nodes:
-            self._timed_nodes[vid] -= 1
+    def schedule(self, vid, delay):
+        """ Evaluate vid again delay cycles after the current one """
+        cycle = self._current_cycle + int(delay)
+        self._timed_nodes[vid] = cycle
+        heapq.heappush(self._events, (cycle, vid))
+
+    def next_event(self, cone=None):
+        """ Return the cycle of the next delayed node (in cone),
+        None if there is none """
+        events = self._events
+        while events:
+            cycle, vid = events[0]
+            if self._timed_nodes.get(vid) != cycle:
+                heapq.heappop(events)  # outdated
+                continue
+            if cone is None or vid in cone:
+                return cycle
+            # other leaf: look further without dropping the event
+            return min([c for c, v in events
+                        if v in cone and self._timed_nodes.get(v) == c] or
+                       [None])
+        return None
+
+    def next_step(self, cone=None):
+        """ Move the scheduler to the cycle of the next event,
+        return the vertices due at this cycle """
+        cycle = self.next_event(cone)
+        if cycle is None:
+            return []
+
+        self._current_cycle = cycle
+        return [vid for vid, c in self._timed_nodes.iteritems()
+                if c == cycle and (cone is None or vid in cone)]
+
+    def cone(self, vid):
+        """
+        Return the vertices evaluated with vid and, for each vertex,
+        the set of its children among them.
+        """
+        seen = set([vid])
+        children = {}
+        stack = [vid]
+        while stack:
+            v = stack.pop()
+            for pid, input_index in self.in_ports(v):
+                for npid, nvid, nactor in self.get_parent_nodes(pid):
+                    children.setdefault(nvid, set()).add(v)
+                    if nvid not in seen and not getattr(nactor, 'block',
+                                                        False):
+                        seen.add(nvid)
+                        stack.append(nvid)
+        return seen, children
 
     def eval_vertex(self, vid):
         """ Evaluate the vertex vid """
@@ -965,7 +2065,7 @@ class DiscreteTimeEvaluation(AbstractEvaluation):
 
         # For each inputs
         # Compute the inputs of the node
-        for pid in df.in_ports(vid):
+        for pid, input_index in self.in_ports(vid):
             inputs = []
 
             cpt = 0
@@ -982,33 +2082,65 @@ class DiscreteTimeEvaluation(AbstractEvaluation):
             if (cpt == 1):
                 inputs = inputs[0]
             if (cpt > 0):
-                actor.set_input(df.local_id(pid), inputs)
+                actor.set_input(input_index, inputs)
 
-        # Eval the node
-        delay = 0
         # When a node return no delay, we stopped the simulation
         stop_when_finished = False
 
         if vid in self._timed_nodes:
-            delay = self._timed_nodes[vid]
-            if delay == 0:
-                del self._timed_nodes[vid]
-                stop_when_finished = True
-
-        if delay == 0:
-            delay = self.eval_vertex_code(vid)
+            if self._timed_nodes[vid] > self._current_cycle:
+                # not due yet
+                self.reeval = True
+                return
+            del self._timed_nodes[vid]
+            stop_when_finished = True
 
+        # Eval the node
+        delay = self.eval_vertex_code(vid)
 
         # Reevaluation flag
-        # TODO: Add the node to the scheduler rather to execute
         if (delay):
-            self._timed_nodes[vid] = int(delay)
+            self.schedule(vid, delay)
             self.reeval = delay
         elif stop_when_finished:
             self._stop = True
             self._nodes_to_reset.append(vid)
-        elif self._current_cycle > 1000:
-            self._stop = True
+
+    def run(self, vid, step=False):
+        """ Simulate the dataflow up to vid, or one cycle if step """
+        cone, children = self.cone(vid)
+        horizon = self.horizon
+
+        if step and self.next_event(cone) is not None:
+            due = self.next_step(cone)
+        else:
+            # first cycle: evaluate all the vertices
+            self.clear()
+            self.eval_vertex(vid)
+            if step:
+                return
+            due = self.next_step(cone)
+
+        while due and not self._stop:
+            if horizon is not None and self._current_cycle > horizon:
+                self._stop = True
+                break
+
+            # due vertices and their descendants
+            affected = set(due)
+            stack = list(due)
+            while stack:
+                for child in children.get(stack.pop(), ()):
+                    if child not in affected:
+                        affected.add(child)
+                        stack.append(child)
+
+            self.clear()
+            self._evaluated.update(cone.difference(affected))
+            self.eval_vertex(vid)
+            if step:
+                return
+            due = self.next_step(cone)
 
     def eval(self, vtx_id=None, step=False):
         t0 = clock()
@@ -1022,24 +2154,14 @@ class DiscreteTimeEvaluation(AbstractEvaluation):
 
         else:
             # Select the leafs (list of (vid, actor))
-            leafs = [(vid, df.actor(vid))
-                for vid in df.vertices() if df.nb_out_edges(vid)==0]
+            leafs = [(vid, df.actor(vid)) for vid in self.leaves()]
 
         leafs.sort(cmp_priority)
 
         # Execute
         for vid, actor in leafs:
-            if not self.is_stopped(vid, actor):
-                self.reeval = True
-                if not step:
-                    while(self.reeval and not self._stop):
-                        self.clear()
-                        self.eval_vertex(vid)
-                        self.next_step()
-                elif (self.reeval and not self._stop):
-                    self.clear()
-                    self.eval_vertex(vid)
-                    self.next_step()
+            if not self.is_stopped(vid, actor) and not self._stop:
+                self.run(vid, step)
 
         if self._stop:
             self._nodes_to_reset.extend(self._timed_nodes)
@@ -1049,9 +2171,11 @@ class DiscreteTimeEvaluation(AbstractEvaluation):
         #print 'Run %d times the dataflow'%(self._current_cycle,)
 
         # Reset the state
-        if not step:
+        if not step or self._stop:
             self.clear()
             self._current_cycle = 0
+            self._timed_nodes.clear()
+            del self._events[:]
 
         t1 = clock()
         if quantify:
@@ -1173,14 +2297,14 @@ class SciFlowareEvaluation(AbstractEvaluation):
         t0 = clock()
 
         df = self._dataflow
+        self._evaluated.clear()
         self.scifloware_actors()
 
         if (vtx_id is not None):
             leafs = [(vtx_id, df.actor(vtx_id))]
         else:
             # Select the leafs (list of (vid, actor))
-            leafs = [(vid, df.actor(vid))
-                for vid in df.vertices() if df.nb_out_edges(vid)==0]
+            leafs = [(vid, df.actor(vid)) for vid in self.leaves()]
 
         leafs.sort(cmp_priority)
 
@@ -0,0 +1,322 @@
+# -*- python -*-
+#
+#       OpenAlea.Core
+#
+#       Copyright 2006-2009 INRIA - CIRAD - INRA
+#
+#       Distributed under the Cecill-C License.
+#       See accompanying file LICENSE.txt or copy at
+#           http://www.cecill.info/licences/Licence_CeCILL-C_V1-en.html
+#
+#       OpenAlea WebSite: http://openalea.gforge.inria.fr
+#
+###############################################################################
+"""Profiling of dataflow evaluations.
+
+A Profiler records, for each node evaluated while it is active, the wall
+and CPU times, the number of calls, the size of the inputs and outputs and
+the time spent to notify the end of the evaluation. Calls are nested:
+nodes evaluated by a composite node or by a SubDataflow are recorded as
+children of the calling node. Nodes evaluated in worker threads (see
+AsyncEvaluation and ParallelEvaluation) are recorded as top level calls of
+their thread.
+
+    >>> profiler = Profiler()
+    >>> with profiler:
+    ...     cn.eval_as_expression()
+    >>> print profiler.report()
+    >>> profiler.dump_stats('eval.prof')   # pstats
+    >>> profiler.dump_speedscope('eval.speedscope.json')
+
+See also CompositeNode.set_profiler.
+"""
+
+__license__ = "Cecill-C"
+__revision__ = " $Id$ "
+
+import sys
+import json
+import marshal
+import threading
+from timeit import default_timer
+
+try:
+    import resource
+
+    def cpu_time():
+        """ Return the CPU time of the process """
+        r = resource.getrusage(resource.RUSAGE_SELF)
+        return r.ru_utime + r.ru_stime
+except ImportError:
+    from time import clock as cpu_time
+
+# Profiler recording the evaluations, None if profiling is disabled
+active = None
+
+
+def data_size(values):
+    """ Return the sum of the sizes of values in bytes """
+    size = 0
+    for v in values:
+        try:
+            size += sys.getsizeof(v)
+        except TypeError:
+            pass
+    return size
+
+
+def dataflow_name(dataflow):
+    """ Return the factory name of dataflow,
+    or a name made unique by its id if it has no factory """
+    factory = getattr(dataflow, 'factory', None)
+    if factory is not None:
+        return factory.name
+    return '%s@%x' % (dataflow.__class__.__name__, id(dataflow))
+
+
+def node_name(node):
+    factory = getattr(node, 'factory', None)
+    if factory is not None:
+        return factory.name
+    return node.__class__.__name__
+
+
+class NodeStats(object):
+    """ Statistics of the evaluations of a node """
+
+    __slots__ = ('calls', 'wall', 'cpu', 'self_wall', 'self_cpu',
+                 'input_size', 'output_size', 'notify', 'callers')
+
+    def __init__(self):
+        self.calls = 0
+        self.wall = 0.
+        self.cpu = 0.
+        self.self_wall = 0.
+        self.self_cpu = 0.
+        self.input_size = 0
+        self.output_size = 0
+        self.notify = 0.
+        # caller key -> [calls, self wall, wall]
+        self.callers = {}
+
+    def to_dict(self):
+        return dict(calls=self.calls, wall=self.wall, cpu=self.cpu,
+                    self_wall=self.self_wall, self_cpu=self.self_cpu,
+                    input_size=self.input_size,
+                    output_size=self.output_size, notify=self.notify)
+
+
+class Profiler(object):
+    """
+    Record the evaluation of nodes.
+
+    The statistics are stored per node in `stats`, a dict
+    (dataflow name, vid, node name) -> NodeStats, and per call path in
+    `tree`, a dict (key, ..., key) -> [calls, self wall time].
+    """
+
+    def __init__(self):
+        self._previous = []
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """ Remove the recorded statistics """
+        self.stats = {}
+        self.tree = {}
+        # call stack and last evaluated node of each thread
+        self._local = threading.local()
+
+    # Activation
+
+    def enable(self):
+        """ Record the evaluations until disable is called """
+        global active
+        self._previous.append(active)
+        active = self
+
+    def disable(self):
+        global active
+        active = self._previous.pop()
+
+    def __enter__(self):
+        self.enable()
+        return self
+
+    def __exit__(self, *args):
+        self.disable()
+
+    # Recording
+
+    def eval_node(self, dataflow, vid, node):
+        """ Evaluate node (vertex vid of dataflow) and record the call """
+        key = (dataflow_name(dataflow), vid, node_name(node))
+        local = self._local
+        try:
+            stack = local.stack
+        except AttributeError:
+            stack = local.stack = []
+        if stack:
+            parent = stack[-1]
+            path = parent[1] + (key,)
+        else:
+            parent = None
+            path = (key,)
+
+        # key, path, children wall and cpu times
+        frame = [key, path, 0., 0.]
+        stack.append(frame)
+
+        input_size = data_size(getattr(node, 'inputs', ()))
+        c0 = cpu_time()
+        t0 = default_timer()
+        try:
+            return node.eval()
+        finally:
+            wall = default_timer() - t0
+            cpu = cpu_time() - c0
+            stack.pop()
+            output_size = data_size(getattr(node, 'outputs', ()))
+            self_wall = wall - frame[2]
+            if parent is not None:
+                parent[2] += wall
+                parent[3] += cpu
+
+            # the statistics are shared by the threads
+            with self._lock:
+                stats = self.stats.get(key)
+                if stats is None:
+                    stats = self.stats[key] = NodeStats()
+                stats.calls += 1
+                stats.wall += wall
+                stats.cpu += cpu
+                stats.self_wall += self_wall
+                stats.self_cpu += cpu - frame[3]
+                stats.input_size += input_size
+                stats.output_size += output_size
+
+                if parent is not None:
+                    caller = stats.callers.get(parent[0])
+                    if caller is None:
+                        caller = stats.callers[parent[0]] = [0, 0., 0.]
+                    caller[0] += 1
+                    caller[1] += self_wall
+                    caller[2] += wall
+
+                node_path = self.tree.get(path)
+                if node_path is None:
+                    node_path = self.tree[path] = [0, 0.]
+                node_path[0] += 1
+                node_path[1] += self_wall
+
+            local.last = stats
+
+    def notify(self, node, event):
+        """ Send event to the listeners of node,
+        the time is added to the last evaluated node """
+        t0 = default_timer()
+        node.notify_listeners(event)
+        last = getattr(self._local, 'last', None)
+        if last is not None:
+            elapsed = default_timer() - t0
+            with self._lock:
+                last.notify += elapsed
+
+    # Export
+
+    def total_time(self):
+        """ Return the wall time of the top level evaluations """
+        return sum(s[1] for s in self.tree.itervalues())
+
+    def report(self, sort='self_wall', limit=20):
+        """ Return a text table of the nodes sorted by decreasing sort """
+        rows = sorted(self.stats.iteritems(),
+                      key=lambda (k, s): getattr(s, sort), reverse=True)
+        lines = ['%8s %10s %10s %10s %10s  %s' %
+                 ('calls', 'self wall', 'wall', 'cpu', 'notify', 'node')]
+        for (df, vid, name), s in rows[:limit]:
+            lines.append('%8d %10.4f %10.4f %10.4f %10.4f  %s:%s(%s)' %
+                         (s.calls, s.self_wall, s.wall, s.cpu, s.notify,
+                          df, name, vid))
+        return '\n'.join(lines)
+
+    def get_pstats(self):
+        """ Return the statistics in the format of the pstats module,
+        functions are identified by (dataflow name, vid, node name) """
+        stats = {}
+        for key, s in self.stats.iteritems():
+            callers = dict((k, (c[0], c[0], c[1], c[2]))
+                           for k, c in s.callers.iteritems())
+            stats[key] = (s.calls, s.calls, s.self_wall, s.wall, callers)
+        return stats
+
+    def dump_stats(self, filename):
+        """ Write the statistics in a file readable by pstats.Stats """
+        f = open(filename, 'wb')
+        try:
+            marshal.dump(self.get_pstats(), f)
+        finally:
+            f.close()
+
+    def to_json(self):
+        """ Return the statistics as a JSON string """
+        nodes = []
+        for (df, vid, name), s in self.stats.iteritems():
+            d = s.to_dict()
+            d.update(dataflow=df, vid=vid, name=name)
+            nodes.append(d)
+        tree = [dict(path=['%s:%s(%s)' % k for k in path],
+                     calls=v[0], self_wall=v[1])
+                for path, v in self.tree.iteritems()]
+        return json.dumps(dict(nodes=nodes, tree=tree), indent=1)
+
+    def dump_json(self, filename):
+        f = open(filename, 'w')
+        try:
+            f.write(self.to_json())
+        finally:
+            f.close()
+
+    def to_speedscope(self, name='OpenAlea evaluation'):
+        """ Return the call tree as a speedscope sampled profile """
+        frames = []
+        index = {}
+        samples = []
+        weights = []
+        for path, (calls, self_wall) in sorted(self.tree.iteritems()):
+            stack = []
+            for key in path:
+                i = index.get(key)
+                if i is None:
+                    i = index[key] = len(frames)
+                    frames.append(dict(name='%s(%s)' % (key[2], key[1]),
+                                       file=key[0]))
+                stack.append(i)
+            samples.append(stack)
+            weights.append(self_wall)
+
+        profile = dict(type='sampled', name=name, unit='seconds',
+                       startValue=0, endValue=sum(weights),
+                       samples=samples, weights=weights)
+        return json.dumps({
+            '$schema': 'https://www.speedscope.app/file-format-schema.json',
+            'shared': dict(frames=frames),
+            'profiles': [profile],
+            'name': name,
+            'exporter': 'openalea'})
+
+    def dump_speedscope(self, filename):
+        f = open(filename, 'w')
+        try:
+            f.write(self.to_speedscope())
+        finally:
+            f.close()
+
+    def to_folded(self):
+        """ Return the call tree as folded stacks (flamegraph.pl input),
+        weights in microseconds """
+        lines = []
+        for path, (calls, self_wall) in sorted(self.tree.iteritems()):
+            stack = ';'.join('%s(%s)' % (key[2], key[1]) for key in path)
+            lines.append('%s %d' % (stack, int(self_wall * 1e6)))
+        return '\n'.join(lines)
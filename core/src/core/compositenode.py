@@ -23,9 +23,12 @@ modified in a dataflow.
 __license__ = "Cecill-C"
 __revision__ = " $Id$ "
 
+import os
 import string
 import pprint
 import copy
+import cPickle
+import itertools
 
 from openalea.core.node import AbstractFactory, AbstractPort, Node
 from openalea.core.node import RecursionError
@@ -34,6 +37,7 @@ from openalea.core.package import UnknownNodeError
 from openalea.core.dataflow import DataFlow, InvalidEdge, PortError
 from openalea.core.settings import Settings
 from openalea.core.metadatadict import MetaDataDict
+from openalea.core import provenance
 import logger
 
 quantify = False
@@ -43,6 +47,47 @@ class IncompatibleNodeError(Exception):
     pass
 
 
+# versions of the descriptions of the composite node factories
+_versions = itertools.count(1)
+
+
+class ElementDict(dict):
+    """
+    Dictionary of the description of a CompositeNodeFactory (elt_factory,
+    connections, ...) which records the version of its last modification.
+    """
+
+    version = 0
+
+    def __setitem__(self, key, value):
+        self.version = next(_versions)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self.version = next(_versions)
+        dict.__delitem__(self, key)
+
+    def clear(self):
+        self.version = next(_versions)
+        dict.clear(self)
+
+    def update(self, *args, **kwds):
+        self.version = next(_versions)
+        dict.update(self, *args, **kwds)
+
+    def setdefault(self, key, default=None):
+        self.version = next(_versions)
+        return dict.setdefault(self, key, default)
+
+    def pop(self, key, *args):
+        self.version = next(_versions)
+        return dict.pop(self, key, *args)
+
+    def popitem(self):
+        self.version = next(_versions)
+        return dict.popitem(self)
+
+
 class CompositeNodeFactory(AbstractFactory):
 
     mimetype = "openalea/compositenodefactory"
@@ -52,6 +97,11 @@ class CompositeNodeFactory(AbstractFactory):
     Each node has an unique id : the element id (elt_id)
     """
 
+    # Instantiate from a CompositeNodePrototype, see get_prototype
+    use_prototype = True
+    _prototype = None
+    _version = 0
+
     def __init__(self, *args, **kargs):
         """
         CompositeNodeFactory accept more optional parameters:
@@ -72,15 +122,15 @@ class CompositeNodeFactory(AbstractFactory):
 
         # Dict mapping elt_id with its corresponding factory
         # the factory is identified by its unique id (package_id, factory_id)
-        self.elt_factory = kargs.get("elt_factory", {})
+        self.elt_factory = ElementDict(kargs.get("elt_factory", {}))
 
         # Dictionnary which contains tuples describing connection
         # ( source_vid , source_port ) : ( target_vid, target_port )
-        self.connections = kargs.get("elt_connections", {})
+        self.connections = ElementDict(kargs.get("elt_connections", {}))
 
-        self.elt_data = kargs.get("elt_data", {})
-        self.elt_value = kargs.get("elt_value", {})
-        self.elt_ad_hoc = kargs.get("elt_ad_hoc", {})
+        self.elt_data = ElementDict(kargs.get("elt_data", {}))
+        self.elt_value = ElementDict(kargs.get("elt_value", {}))
+        self.elt_ad_hoc = ElementDict(kargs.get("elt_ad_hoc", {}))
         from openalea.core.algo.dataflow_evaluation import DefaultEvaluation
         self.eval_algo = kargs.get("eval_algo", DefaultEvaluation.__name__)
 
@@ -100,6 +150,40 @@ class CompositeNodeFactory(AbstractFactory):
         self.connections.clear()
         self.elt_data.clear()
         self.elt_value.clear()
+        self.invalidate_prototype()
+
+    def __getstate__(self):
+        """ Pickle function : remove the prototype """
+        odict = AbstractFactory.__getstate__(self)
+        odict.pop('_prototype', None)
+        return odict
+
+    def get_prototype(self):
+        """ Return the CompositeNodePrototype used to instantiate the
+        factory. It is built again when the packages of the elements
+        have changed. """
+        proto = self._prototype
+        if proto is None or not proto.is_valid(self):
+            proto = self._prototype = CompositeNodePrototype(self)
+        return proto
+
+    def invalidate_prototype(self):
+        """ Remove the prototype. Call it when an element of the
+        description of the composite node (e.g. elt_data[vid]) is
+        modified in place. """
+        self._prototype = None
+        self._version = next(_versions)
+
+    def get_version(self):
+        """ Return the version of the description of the composite node,
+        changed by the modifications of elt_factory, connections, elt_data,
+        elt_value and elt_ad_hoc and by invalidate_prototype """
+        return max(self._version,
+                   getattr(self.elt_factory, 'version', 0),
+                   getattr(self.connections, 'version', 0),
+                   getattr(self.elt_data, 'version', 0),
+                   getattr(self.elt_value, 'version', 0),
+                   getattr(self.elt_ad_hoc, 'version', 0))
 
     def copy(self, **args):
         """
@@ -113,6 +197,7 @@ class CompositeNodeFactory(AbstractFactory):
         """
 
         ret = AbstractFactory.copy(self, **args)
+        ret.invalidate_prototype()
 
         # Replace old pkg name to new pkg name
         (old_pkg, new_pkg) = args['replace_pkg']
@@ -155,10 +240,26 @@ class CompositeNodeFactory(AbstractFactory):
 
         cont_eval = set() # continuous evaluated nodes
 
+        if self.use_prototype:
+            proto = self.get_prototype()
+            elements = proto.elements
+            io_data = proto.io_data
+            connections = proto.connections
+        else:
+            elements = [(vid, None, None, None, None)
+                        for vid in self.elt_factory]
+            io_data = None
+            connections = self.connections.itervalues()
+
         # Instantiate the node with each factory
-        for vid in self.elt_factory:
+        for vid, factory, data, ad_hoc, values in elements:
             try:
-                node = self.instantiate_node(vid, call_stack)
+                if factory is None:
+                    node = self.instantiate_node(vid, call_stack)
+                else:
+                    node = factory.instantiate(call_stack)
+                    self.set_node_data(node, data(), ad_hoc(),
+                                       [(port, v()) for port, v in values])
 
                 # Manage continuous eval
                 if(node.user_application):
@@ -177,17 +278,18 @@ class CompositeNodeFactory(AbstractFactory):
 
         # Set IO internal data
         try:
-            self.load_ad_hoc_data(new_df.node(new_df.id_in),
-                                  copy.deepcopy(self.elt_data["__in__"]),
-                                  copy.deepcopy(self.elt_ad_hoc.get("__in__", None)))
-            self.load_ad_hoc_data(new_df.node(new_df.id_out),
-                                  copy.deepcopy(self.elt_data["__out__"]),
-                                  copy.deepcopy(self.elt_ad_hoc.get("__out__", None)))
+            if io_data is None:
+                io_data = [(key, lambda: copy.deepcopy(self.elt_data[key]),
+                            lambda: copy.deepcopy(self.elt_ad_hoc.get(key, None)))
+                           for key in ("__in__", "__out__")]
+            for key, data, ad_hoc in io_data:
+                vid = new_df.id_in if key == "__in__" else new_df.id_out
+                self.load_ad_hoc_data(new_df.node(vid), data(), ad_hoc())
         except:
             pass
 
         # Create the connections
-        for eid, link in self.connections.iteritems():
+        for link in connections:
             (source_vid, source_port, target_vid, target_port) = link
 
             # Replace id for in and out nodes
@@ -252,6 +354,7 @@ class CompositeNodeFactory(AbstractFactory):
                 node.set_input(port, eval(v))
                 if(len(vs)>2):
                     d = MetaDataDict(vs[2])
+                    node.own_ports()
                     node.input_desc[port].get_ad_hoc_dict().update(d)
             except:
                 continue
@@ -310,8 +413,7 @@ class CompositeNodeFactory(AbstractFactory):
     def load_ad_hoc_data(self, node, elt_data, elt_ad_hoc=None):
         if elt_ad_hoc and len(elt_ad_hoc):
             #reading 0.8+ files.
-            d = MetaDataDict(dict=elt_ad_hoc)
-            node.get_ad_hoc_dict().update(d)
+            node.load_ad_hoc_dict(elt_ad_hoc)
         else:
             #extracting ad hoc data from old files.
             #we parse the Node class' __ad_hoc_from_old_map__
@@ -342,6 +444,19 @@ class CompositeNodeFactory(AbstractFactory):
 
         :param call_stack: a list of parent id (to avoid infinite recursion)
         """
+        pkg, factory = self.get_element_factory(vid)
+
+        node = factory.instantiate(call_stack)
+
+        attributes = copy.deepcopy(self.elt_data[vid])
+        ad_hoc     = copy.deepcopy(self.elt_ad_hoc.get(vid, None))
+        self.set_node_data(node, attributes, ad_hoc,
+                           self.get_element_values(vid))
+
+        return node
+
+    def get_element_factory(self, vid):
+        """ Return the package and the factory of element vid """
         (package_id, factory_id) = self.elt_factory[vid]
         pkgmanager = PackageManager()
         pkg = pkgmanager[package_id]
@@ -352,29 +467,39 @@ class CompositeNodeFactory(AbstractFactory):
             pkg = pkgmanager[protected(package_id)]
             factory = pkg.get_factory(factory_id)
 
+        return pkg, factory
 
-        node = factory.instantiate(call_stack)
-
-        attributes = copy.deepcopy(self.elt_data[vid])
-        ad_hoc     = copy.deepcopy(self.elt_ad_hoc.get(vid, None))
-        self.load_ad_hoc_data(node, attributes, ad_hoc)
-
-        # copy node input data if any
-        values = copy.deepcopy(self.elt_value.get(vid, ()))
-
-        for vs in values:
+    def get_element_values(self, vid):
+        """ Return the list of (port, value) of the inputs of element vid.
+        Values which cannot be evaluated are ignored. """
+        values = []
+        for vs in self.elt_value.get(vid, ()):
             try:
                 #the two first elements are the historical
                 #values : port Id and port value
                 #the values beyond are not used.
                 port, v = vs[:2]
-                node.set_input(port, eval(v))
-                node.input_desc[port].get_ad_hoc_dict().set_metadata("hide",
-                                                                     node.is_port_hidden(port))
+                values.append((port, eval(v)))
             except:
                 continue
+        return values
 
-        return node
+    def set_node_data(self, node, attributes, ad_hoc, values):
+        """ Set the internal data, ad hoc data and input values of node """
+        self.load_ad_hoc_data(node, attributes, ad_hoc)
+
+        # copy node input data if any
+        for port, v in values:
+            try:
+                node.set_input(port, v)
+                hidden = node.is_port_hidden(port)
+                ad_hoc = node.input_desc[port].get_ad_hoc_dict()
+                if ad_hoc.get_metadata("hide") != hidden:
+                    node.own_ports()
+                    node.input_desc[port].get_ad_hoc_dict().set_metadata(
+                        "hide", hidden)
+            except:
+                continue
 
     #########################################################
     # This shouldn't be here, it is related to visual stuff #
@@ -399,6 +524,93 @@ class CompositeNodeFactory(AbstractFactory):
         return DisplayGraphWidget(node, parent, autonomous)
 
 
+def _frozen(value):
+    """ Return a function returning a deep copy of value """
+    try:
+        data = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+        cPickle.loads(data)
+    except Exception:
+        return lambda: copy.deepcopy(value)
+    return lambda: cPickle.loads(data)
+
+
+class CompositeNodePrototype(object):
+    """
+    Compiled form of a CompositeNodeFactory used to instantiate it quickly.
+
+    The factories of the elements are resolved once, their internal data,
+    ad hoc data and input values are evaluated once and kept pickled.
+    The prototype is valid as long as the description of the factory is
+    not modified (see CompositeNodeFactory.get_version), no package is
+    added or removed in the package manager, and the packages of the
+    elements and their wralea files are not modified.
+
+    The prototype is not a graph which is cloned: each instance still
+    creates its nodes from their factories and connects them one by one,
+    which takes most of the remaining time. The prototype about halves
+    the instantiation time of a chain of additions (see
+    test/bench_compositenode.py).
+    """
+
+    def __init__(self, factory):
+        self.factory_version = factory.get_version()
+        pkgmanager = PackageManager()
+        self.pkgs = pkgmanager.pkgs
+        self.pkgs_version = self.pkgs.version
+
+        packages = {}
+
+        # (vid, factory, data, ad_hoc, values)
+        # factory is None if it cannot be found
+        self.elements = []
+        for vid in factory.elt_factory:
+            try:
+                pkg, elt_factory = factory.get_element_factory(vid)
+                packages[id(pkg)] = pkg
+            except (UnknownNodeError, UnknownPackageError):
+                self.elements.append((vid, None, None, None, None))
+                continue
+
+            values = [(port, _frozen(v))
+                      for port, v in factory.get_element_values(vid)]
+            self.elements.append((vid, elt_factory,
+                                  _frozen(factory.elt_data[vid]),
+                                  _frozen(factory.elt_ad_hoc.get(vid, None)),
+                                  values))
+
+        self.io_data = [(key, _frozen(factory.elt_data[key]),
+                         _frozen(factory.elt_ad_hoc.get(key, None)))
+                        for key in ("__in__", "__out__")
+                        if key in factory.elt_data]
+        self.connections = factory.connections.values()
+
+        # (package, version, wralea file, modification time)
+        self.stamps = [(pkg, pkg.version, pkg.wralea_path,
+                        self.mtime(pkg.wralea_path))
+                       for pkg in packages.itervalues()]
+
+    @staticmethod
+    def mtime(filename):
+        try:
+            return os.stat(filename).st_mtime
+        except (OSError, TypeError, AttributeError):
+            return None
+
+    def is_valid(self, factory=None):
+        """ Return False if the packages or the description of factory
+        have changed """
+        if (factory is not None and
+            factory.get_version() != self.factory_version):
+            return False
+        pkgs = PackageManager().pkgs
+        if pkgs is not self.pkgs or pkgs.version != self.pkgs_version:
+            return False
+        for pkg, version, filename, mtime in self.stamps:
+            if pkg.version != version or self.mtime(filename) != mtime:
+                return False
+        return True
+
+
 class CompositeNode(Node, DataFlow):
     """
     The CompositeNode is a container that interconnect
@@ -407,6 +619,11 @@ class CompositeNode(Node, DataFlow):
 
     mimetype = "openalea/compositenode"
 
+    # (eval_algo, evaluation algo instance), see get_eval_algo
+    _eval_algo_cache = None
+    # profiler recording the evaluations, see set_profiler
+    profiler = None
+
     def __init__(self, inputs=(), outputs=()):
         """ Inputs and outputs are list of
         dict(name='', interface='', value='') """
@@ -424,6 +641,14 @@ class CompositeNode(Node, DataFlow):
     def copy_to(self, other):
         raise NotImplementedError
 
+    def __getstate__(self):
+        """ Pickle function : remove the evaluation algo instance
+        and the profiler """
+        odict = Node.__getstate__(self)
+        odict['_eval_algo_cache'] = None
+        odict.pop('profiler', None)
+        return odict
+
     def close(self):
         for vid in set(self.vertices()):
             node = self.actor(vid)
@@ -498,8 +723,30 @@ class CompositeNode(Node, DataFlow):
 
         return self.node(self.id_out).set_output(index_key, val)
 
+    def set_profiler(self, profiler=True):
+        """ Profile the evaluations of the composite node
+
+        :param profiler: a Profiler (see algo.profiling), True to create a
+            new one, or None to stop profiling
+        :returns: the profiler
+        """
+        if profiler is True:
+            from openalea.core.algo.profiling import Profiler
+            profiler = Profiler()
+        self.profiler = profiler or None
+        return self.profiler
+
     def get_eval_algo(self):
-        """ Return the evaluation algo instance """
+        """ Return the evaluation algo instance
+
+        The instance is kept between evaluations as long as eval_algo is not
+        changed. It caches the structure of the dataflow until its topology
+        is modified.
+        """
+        if (self._eval_algo_cache is not None and
+            self._eval_algo_cache[0] == self.eval_algo):
+            return self._eval_algo_cache[1]
+
         try:
             algo_str = self.eval_algo
 
@@ -511,13 +758,14 @@ class CompositeNode(Node, DataFlow):
             baseimp = "algo.dataflow_evaluation"
             module = __import__(baseimp, globals(), locals(), [algo_str])
             classobj = module.__dict__[algo_str]
-            return classobj(self)
+            algo = classobj(self)
 
         except Exception, e:
             from  openalea.core.algo.dataflow_evaluation import DefaultEvaluation
-            return DefaultEvaluation(self)
+            algo = DefaultEvaluation(self)
 
-        return self.eval_algo
+        self._eval_algo_cache = (self.eval_algo, algo)
+        return algo
 
     def eval_as_expression(self, vtx_id=None, step=False):
         """
@@ -533,11 +781,21 @@ class CompositeNode(Node, DataFlow):
             self.node(vtx_id).modified = True
         algo = self.get_eval_algo()
 
+        store = provenance.active
+        if store is not None:
+            algo._run = store.start_run(self)
         try:
             self.evaluating = True
-            algo.eval(vtx_id,step=step)
+            if self.profiler is None:
+                algo.eval(vtx_id,step=step)
+            else:
+                with self.profiler:
+                    algo.eval(vtx_id,step=step)
         finally:
             self.evaluating = False
+            if store is not None:
+                store.end_run(algo._run)
+                algo._run = None
         t1 = time.time()
         if quantify:
             logger.info('Evaluation time: %s'%(t1-t0))
@@ -569,6 +827,13 @@ class CompositeNode(Node, DataFlow):
 
         return ()
 
+    def compile(self):
+        """ Return a function computing the outputs of the composite node
+        from its inputs, without notification (see algo.dataflow_compiler)
+        """
+        from openalea.core.algo.dataflow_compiler import compile_dataflow
+        return compile_dataflow(self)
+
     def to_script (self) :
         """Translate the dataflow into a python script.
         """
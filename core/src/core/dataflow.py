@@ -49,11 +49,20 @@ class DataFlow(PropertyGraph):
     ports are typed
     """
 
+    # incremented each time the topology (vertices, ports, edges
+    # or actors) is modified
+    _topology_version = 0
+
     def __init__(self):
         PropertyGraph.__init__(self)
         self._ports = {}
         self._pid_generator = IdGenerator()
 
+        # indexes on ports
+        self._in_port_index = {} # (vid, local_pid) -> pid
+        self._out_port_index = {} # (vid, local_pid) -> pid
+        self._port_edges = {} # pid -> set of eid
+
         self.add_edge_property("_source_port")
         self.add_edge_property("_target_port")
 
@@ -179,15 +188,7 @@ class DataFlow(PropertyGraph):
         to this port
         :rtype: iter of eid
         """
-        vid = self.vertex(pid)
-        if self.is_out_port(pid):
-            for eid in self.out_edges(vid):
-                if self.source_port(eid)==pid:
-                    yield eid
-        else:
-            for eid in self.in_edges(vid):
-                if self.target_port(eid)==pid:
-                    yield eid
+        return iter(self._port_edges[pid])
 
     def nb_connections(self, pid):
         """ Compute number of edges connected to a given port.
@@ -198,7 +199,18 @@ class DataFlow(PropertyGraph):
         return:
             - int
         """
-        return len(tuple(self.connected_edges(pid)))
+        return len(self._port_edges[pid])
+
+    def topology_version(self):
+        """ Return a counter incremented at each topological modification.
+
+        Algorithms that cache information about the structure of the
+        dataflow can compare it to detect that their cache is out of date.
+
+        return:
+            - int
+        """
+        return self._topology_version
 
     ####################################################
     #
@@ -230,20 +242,20 @@ class DataFlow(PropertyGraph):
         global port id of a given port
         :rtype: pid
         """
-        for pid in self.out_ports(vid):
-            if self._ports[pid]._local_pid == local_pid:
-                return pid
-        raise PortError("Local pid '%s' does not exist" % str(local_pid))
+        try:
+            return self._out_port_index[(vid, local_pid)]
+        except KeyError:
+            raise PortError("Local pid '%s' does not exist" % str(local_pid))
 
     def in_port(self, vid, local_pid):
         """
         global port id of a given port
         :rtype: pid
         """
-        for pid in self.in_ports(vid):
-            if self._ports[pid]._local_pid == local_pid:
-                return pid
-        raise PortError("local pid '%s' does not exist for vertex %d" % (str(local_pid),vid) )
+        try:
+            return self._in_port_index[(vid, local_pid)]
+        except KeyError:
+            raise PortError("local pid '%s' does not exist for vertex %d" % (str(local_pid),vid) )
 
     #####################################################
     #
@@ -258,6 +270,7 @@ class DataFlow(PropertyGraph):
         try : actor.set_id(vid)
         except Exception, e: print e
         self.vertex_property("_actor")[vid] = actor
+        self._topology_version += 1
 
     def actor(self, vid):
         """
@@ -300,6 +313,9 @@ class DataFlow(PropertyGraph):
         pid = self._pid_generator.get_id(pid)
         self._ports[pid] = Port(vid, local_pid, False)
         self.vertex_property("_ports")[vid].add(pid)
+        self._in_port_index[(vid, local_pid)] = pid
+        self._port_edges[pid] = set()
+        self._topology_version += 1
         return pid
 
     def add_out_port(self, vid, local_pid, pid=None):
@@ -315,6 +331,9 @@ class DataFlow(PropertyGraph):
         pid = self._pid_generator.get_id(pid)
         self._ports[pid] = Port(vid, local_pid, True)
         self.vertex_property("_ports")[vid].add(pid)
+        self._out_port_index[(vid, local_pid)] = pid
+        self._port_edges[pid] = set()
+        self._topology_version += 1
         return pid
 
     def remove_port(self, pid):
@@ -324,9 +343,19 @@ class DataFlow(PropertyGraph):
         """
         for eid in list(self.connected_edges(pid)):
             self.remove_edge(eid)
+        port = self._ports[pid]
+        if port._is_out_port:
+            index = self._out_port_index
+        else:
+            index = self._in_port_index
+        key = (port._vid, port._local_pid)
+        if index.get(key) == pid:
+            del index[key]
+        del self._port_edges[pid]
         self.vertex_property("_ports")[self.vertex(pid)].remove(pid)
         self._pid_generator.release_id(pid)
         del self._ports[pid]
+        self._topology_version += 1
 
     def connect(self, source_pid, target_pid, eid=None):
         """
@@ -350,13 +379,29 @@ class DataFlow(PropertyGraph):
             self.vertex(target_pid)), eid)
         self.edge_property("_source_port")[eid] = source_pid
         self.edge_property("_target_port")[eid] = target_pid
+        self._port_edges[source_pid].add(eid)
+        self._port_edges[target_pid].add(eid)
+        self._topology_version += 1
 
         return eid
 
+    def remove_edge(self, eid):
+        """todo"""
+        source_pid = self.edge_property("_source_port").get(eid)
+        target_pid = self.edge_property("_target_port").get(eid)
+        PropertyGraph.remove_edge(self, eid)
+        for pid in (source_pid, target_pid):
+            if pid is not None:
+                self._port_edges[pid].discard(eid)
+        self._topology_version += 1
+
+    remove_edge.__doc__ = PropertyGraph.remove_edge.__doc__
+
     def add_vertex(self, vid=None):
         """todo"""
         vid = PropertyGraph.add_vertex(self, vid)
         self.vertex_property("_ports")[vid] = set()
+        self._topology_version += 1
         return vid
 
     add_vertex.__doc__ = PropertyGraph.add_vertex.__doc__
@@ -369,14 +414,28 @@ class DataFlow(PropertyGraph):
             except:
                 pass
         PropertyGraph.remove_vertex(self, vid)
+        self._topology_version += 1
 
     remove_vertex.__doc__ = PropertyGraph.remove_vertex.__doc__
 
+    def clear_edges(self):
+        """todo"""
+        PropertyGraph.clear_edges(self)
+        for eids in self._port_edges.itervalues():
+            eids.clear()
+        self._topology_version += 1
+
+    clear_edges.__doc__ = PropertyGraph.clear_edges.__doc__
+
     def clear(self):
         """todo"""
         self._ports.clear()
+        self._in_port_index.clear()
+        self._out_port_index.clear()
+        self._port_edges.clear()
         self._pid_generator = IdGenerator()
         PropertyGraph.clear(self)
+        self._topology_version += 1
 
     clear.__doc__ = PropertyGraph.clear.__doc__
 
@@ -14,14 +14,51 @@
 #       OpenAlea WebSite : http://openalea.gforge.inria.fr
 #
 ##############################################################################
-"""DataPool is a global dictionnary to share data between node instance"""
+"""DataPool is a global dictionnary to share data between node instance
+
+Values can be registered lazily with DataPool.set_lazy: they are loaded
+the first time they are read (see Session.load).
+
+With a memory budget (DataPool.set_budget), the least recently used values
+are pickled to disk when the estimated size of the values in memory
+exceeds the budget, and loaded back when they are accessed. The values
+referenced outside the pool (e.g. the list of an AccuList node, which is
+also its output) are spilled last, only if the other values do not free
+enough memory: a change made through such a reference after the value is
+spilled is lost. The accumulators (AccuList, AccuFloat) read their value
+from the pool at each evaluation, so they are not affected.
+
+The size of a value is estimated when it is set or loaded, and again when
+a container (list, dict, set, ...) is read with a new length, e.g. after
+an AccuList has appended to it.
+
+The values not loaded yet are LazyData placeholders in the underlying
+dict: the methods of DataPool load them, but the functions of dict called
+on the pool (e.g. dict(pool) or dict.values(pool)) return the
+placeholders.
+"""
 
 __license__ = "Cecill-C"
 __revision__ = "$Id$"
 
+import os
+import sys
+import uuid
+import atexit
+import shutil
+import cPickle
+import tempfile
+from collections import OrderedDict, deque, ValuesView, ItemsView
+from itertools import islice
+
 from openalea.core.singleton import Singleton
 from openalea.core.observer import Observed
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 # Decorator to add notification to function
 
@@ -37,6 +74,81 @@ def notify_decorator(f):
     return wrapped
 
 
+def estimate_size(value, sample=100, depth=3):
+    """
+    Return an estimate of the memory used by value in bytes.
+
+    Containers are measured with their items, up to depth levels. Only
+    sample items of large containers are measured, the others are
+    assumed to be of the same mean size.
+    """
+    if numpy is not None and isinstance(value, numpy.ndarray):
+        return value.nbytes + 96
+
+    try:
+        size = sys.getsizeof(value)
+    except TypeError:
+        size = 64
+    if depth == 0:
+        return size
+
+    depth -= 1
+    if isinstance(value, dict):
+        n = len(value)
+        items = islice(value.iteritems(), sample)
+        sizes = [estimate_size(k, sample, depth) +
+                 estimate_size(v, sample, depth) for k, v in items]
+    elif isinstance(value, (list, tuple)):
+        n = len(value)
+        items = value[::n // sample + 1] if n > sample else value
+        sizes = [estimate_size(v, sample, depth) for v in items]
+    elif isinstance(value, (set, frozenset, deque)):
+        n = len(value)
+        sizes = [estimate_size(v, sample, depth)
+                 for v in islice(value, sample)]
+    elif isinstance(getattr(value, '__dict__', None), dict):
+        return size + estimate_size(value.__dict__, sample, depth)
+    else:
+        return size
+
+    if sizes:
+        size += sum(sizes) * n // len(sizes)
+    return size
+
+
+# values which may be modified in place, measured again when their length
+# changes
+_containers = (list, dict, set, deque, bytearray)
+
+
+class LazyData(object):
+    """ Placeholder of a datapool value which is loaded on first access """
+
+    __slots__ = ('loader', 'info')
+
+    def __init__(self, loader, info=None):
+        """
+        :param loader: function without argument returning the value
+        :param info: data of the owner of the value (e.g. where it is stored)
+        """
+        self.loader = loader
+        self.info = info
+
+    def load(self):
+        return self.loader()
+
+
+def spill_loader(path):
+    """ Return a function loading the value pickled in path """
+    def load():
+        f = open(path, 'rb')
+        try:
+            return cPickle.load(f)
+        finally:
+            f.close()
+    return load
+
+
 class DataPool(Observed, dict):
     """ Dictionnary of session data """
 
@@ -47,9 +159,20 @@ class DataPool(Observed, dict):
         Observed.__init__(self)
         dict.__init__(self)
 
-        DataPool.__setitem__ = notify_decorator(dict.__setitem__)
-        DataPool.__delitem__ = notify_decorator(dict.__delitem__)
-        DataPool.clear = notify_decorator(dict.clear)
+        # memory budget in bytes, None for no limit
+        self.max_bytes = None
+        self.directory = None
+        self._tmp_directory = None
+        # estimated size of the values in memory
+        self.nbytes = 0
+        # key -> estimated size, least recently used first
+        self._sizes = OrderedDict()
+        # key -> length of the containers when their size was estimated
+        self._lengths = {}
+        # key -> estimated size of the values which cannot be pickled
+        self._pinned = {}
+        # key -> (path, size) of the values spilled to disk
+        self._spilled = {}
 
     def add_data(self, key, instance):
         """ Add an instance referenced by key to the data pool """
@@ -64,3 +187,274 @@ class DataPool(Observed, dict):
             self.notify_listeners(('pool_modified', ))
         except:
             pass
+
+    def set_lazy(self, key, loader, info=None):
+        """ Register key with a value returned by loader on first access """
+        self._untrack(key)
+        dict.__setitem__(self, key, LazyData(loader, info))
+
+    def get_lazy(self, key):
+        """ Return the LazyData of key if its value is not loaded yet,
+        None otherwise """
+        value = dict.get(self, key)
+        if isinstance(value, LazyData):
+            return value
+        return None
+
+    # Memory budget
+
+    def set_budget(self, max_bytes, directory=None):
+        """
+        Keep at most max_bytes of values in memory (None for no limit).
+
+        :param directory: directory where the least recently used values
+            are spilled (default, a temporary directory)
+        """
+        self.max_bytes = max_bytes
+        if directory is not None:
+            self.directory = directory
+
+        self._sizes.clear()
+        self._lengths.clear()
+        self._pinned.clear()
+        self.nbytes = 0
+        if max_bytes is not None:
+            self._track_all()
+            self._spill()
+
+    def get_directory(self):
+        """ Return the directory of the spilled values """
+        if self.directory is not None:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            return self.directory
+        if self._tmp_directory is None:
+            self._tmp_directory = tempfile.mkdtemp(prefix='datapool')
+            atexit.register(shutil.rmtree, self._tmp_directory, True)
+        return self._tmp_directory
+
+    def spilled_path(self, key):
+        """ Return the file of the pickled value of key if it has been
+        spilled to disk, None otherwise """
+        spilled = self._spilled.get(key)
+        return spilled[0] if spilled is not None else None
+
+    def memory_usage(self):
+        """
+        Return the list of (key, size in bytes, state)
+        sorted by decreasing size.
+
+        state is 'memory', 'disk' for the values spilled to disk or
+        'lazy' for the values not loaded yet (see set_lazy).
+        """
+        usage = []
+        for key, value in dict.iteritems(self):
+            if key in self._spilled:
+                usage.append((key, self._spilled[key][1], 'disk'))
+            elif isinstance(value, LazyData):
+                usage.append((key, 0, 'lazy'))
+            else:
+                usage.append((key, estimate_size(value), 'memory'))
+        usage.sort(key=lambda u: u[1], reverse=True)
+        return usage
+
+    def _track(self, key, value):
+        """ Measure value and mark key as the most recently used """
+        size = estimate_size(value)
+        self.nbytes += size - self._sizes.pop(key, 0)
+        self._pinned.pop(key, None)
+        self._sizes[key] = size
+        if isinstance(value, _containers):
+            self._lengths[key] = len(value)
+        else:
+            self._lengths.pop(key, None)
+
+    def _track_all(self):
+        """ Measure the values in memory """
+        for key, value in dict.iteritems(self):
+            if not isinstance(value, LazyData):
+                self._track(key, value)
+
+    def _touch(self, key, value):
+        """ Mark key as the most recently used, measure value if it is
+        not tracked yet or if it is a container modified in place """
+        size = self._sizes.pop(key, None)
+        if size is None or (key in self._lengths and
+                            len(value) != self._lengths[key]):
+            self._sizes[key] = size or 0
+            self._track(key, value)
+        else:
+            self._sizes[key] = size
+
+    def _untrack(self, key):
+        self.nbytes -= self._sizes.pop(key, 0)
+        self._lengths.pop(key, None)
+        self._pinned.pop(key, None)
+        spilled = self._spilled.pop(key, None)
+        if spilled is not None:
+            try:
+                os.remove(spilled[0])
+            except OSError:
+                pass
+
+    def _spill(self, keep=None):
+        """ Spill the least recently used values but keep
+        until the values in memory fit in the budget.
+        The values referenced outside the pool are spilled last. """
+        if self.nbytes <= self.max_bytes:
+            return
+        referenced = []
+        for key, size in self._sizes.items():
+            if self.nbytes <= self.max_bytes or key == keep:
+                break
+            value = dict.__getitem__(self, key)
+            # references of the pool, of value and of getrefcount
+            referenced_outside = sys.getrefcount(value) > 3
+            del value
+            if referenced_outside:
+                referenced.append((key, size))
+            else:
+                self._spill_value(key, size)
+        for key, size in referenced:
+            if self.nbytes <= self.max_bytes:
+                break
+            self._spill_value(key, size)
+
+    def _spill_value(self, key, size):
+        """ Pickle the value of key to disk """
+        del self._sizes[key]
+        self._lengths.pop(key, None)
+        self.nbytes -= size
+
+        value = dict.__getitem__(self, key)
+        try:
+            data = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+        except Exception:
+            self._pinned[key] = size
+            return
+
+        name = uuid.uuid4().hex + '.pkl'
+        path = os.path.join(self.get_directory(), name)
+        f = open(path, 'wb')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        self._spilled[key] = (path, size)
+        dict.__setitem__(self, key, LazyData(spill_loader(path)))
+
+    # Dictionary
+
+    def _load(self, key, value):
+        if isinstance(value, LazyData):
+            value = value.load()
+            self._untrack(key)
+            dict.__setitem__(self, key, value)
+            if self.max_bytes is not None:
+                self._track(key, value)
+                self._spill(key)
+            return value
+        elif self.max_bytes is None or key in self._pinned:
+            return value
+
+        self._touch(key, value)
+        self._spill(key)
+        return value
+
+    def _set(self, key, value):
+        self._untrack(key)
+        dict.__setitem__(self, key, value)
+        if self.max_bytes is not None:
+            self._track(key, value)
+            self._spill(key)
+
+    @notify_decorator
+    def __setitem__(self, key, value):
+        self._set(key, value)
+
+    @notify_decorator
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._untrack(key)
+
+    @notify_decorator
+    def clear(self):
+        dict.clear(self)
+        for key in self._spilled.keys():
+            self._untrack(key)
+        self._sizes.clear()
+        self._lengths.clear()
+        self._pinned.clear()
+        self.nbytes = 0
+
+    def __getitem__(self, key):
+        return self._load(key, dict.__getitem__(self, key))
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def setdefault(self, key, default=None):
+        if key in self:
+            return self[key]
+        self._set(key, default)
+        return default
+
+    def update(self, *args, **kwds):
+        for key, value in dict(*args, **kwds).iteritems():
+            self._set(key, value)
+
+    def pop(self, key, *args):
+        value = dict.pop(self, key, *args)
+        if isinstance(value, LazyData):
+            value = value.load()
+        self._untrack(key)
+        return value
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        if isinstance(value, LazyData):
+            value = value.load()
+        self._untrack(key)
+        return key, value
+
+    def itervalues(self):
+        for key in self.keys():
+            yield self[key]
+
+    def iteritems(self):
+        for key in self.keys():
+            yield key, self[key]
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def viewvalues(self):
+        return ValuesView(self)
+
+    def viewitems(self):
+        return ItemsView(self)
+
+    def copy(self):
+        """ Return a dict of the values, loaded """
+        return dict(self.iteritems())
+
+    def __eq__(self, other):
+        if not isinstance(other, dict):
+            return NotImplemented
+        if len(self) != len(other):
+            return False
+        for key in self.keys():
+            if key not in other or other[key] != self[key]:
+                return False
+        return True
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
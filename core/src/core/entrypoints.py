@@ -0,0 +1,281 @@
+# -*- python -*-
+#
+#       OpenAlea.Core
+#
+#       Copyright 2006-2009 INRIA - CIRAD - INRA
+#
+#       Distributed under the Cecill-C License.
+#       See accompanying file LICENSE.txt or copy at
+#           http://www.cecill.info/licences/Licence_CeCILL-C_V1-en.html
+#
+#       OpenAlea WebSite : http://openalea.gforge.inria.fr
+#
+###############################################################################
+"""Persistent index of the entry points of the installed distributions.
+
+Finding the entry points of a group with pkg_resources scans the metadata
+of all the distributions of the working set. The index stores the entry
+points of all the groups in the OpenAlea home directory and is used as
+long as the stamp of the python path does not change: the entries of
+sys.path, the names of the distributions they contain and the
+modification times of their metadata.
+
+    >>> for ep in iter_entry_points('wralea'):
+    ...     module = ep.load()
+
+The index also keeps data attached to the entry points by their users,
+e.g. the description of the plugins used to register them without
+importing their module (see PluginManager.discover). This data is
+dropped when the index is built again.
+"""
+
+__license__ = "Cecill-C"
+__revision__ = " $Id$ "
+
+import os
+import sys
+import cPickle
+import hashlib
+
+from openalea.core import logger
+from openalea.core.settings import get_openalea_home_dir
+
+# version of the index file
+INDEX_VERSION = 1
+METADATA_EXT = ('.egg-info', '.dist-info', '.egg', '.egg-link')
+
+
+def search_paths():
+    """ Return the entries of sys.path and of the working set """
+    paths = list(sys.path)
+    pkg_resources = sys.modules.get('pkg_resources')
+    if pkg_resources is not None:
+        entries = pkg_resources.working_set.entries
+        paths.extend(entry for entry in entries if entry not in paths)
+    return paths
+
+
+def metadata_stamp(digest, meta):
+    """ Add the modification times of the metadata meta to digest """
+    for filename in (meta, os.path.join(meta, 'entry_points.txt'),
+                     os.path.join(meta, 'EGG-INFO', 'entry_points.txt')):
+        try:
+            digest.update('%s:%r' % (filename, os.stat(filename).st_mtime))
+        except OSError:
+            pass
+
+
+def path_stamp(paths):
+    """ Return a digest of paths, of the names of the distributions they
+    contain and of the modification times of their metadata """
+    digest = hashlib.sha1()
+    for entry in paths:
+        entry = os.path.abspath(entry or os.curdir)
+        digest.update(entry)
+        if entry.endswith(METADATA_EXT):
+            metadata_stamp(digest, entry)
+        try:
+            names = sorted(os.listdir(entry))
+        except OSError:
+            digest.update(repr(os.path.exists(entry)))
+            continue
+        for name in names:
+            if name.endswith(METADATA_EXT):
+                metadata_stamp(digest, os.path.join(entry, name))
+    return digest.hexdigest()
+
+
+def scan_entry_points():
+    """ Return the entry points of the working set,
+    group -> list of (name, module name, attrs, distribution) """
+    import pkg_resources
+
+    groups = {}
+    for dist in pkg_resources.working_set:
+        try:
+            entry_map = dist.get_entry_map()
+        except Exception, e:
+            logger.warning("Cannot read the entry points of %s : %s" %
+                           (dist, e))
+            continue
+        info = (dist.project_name, dist.version, dist.location,
+                dist.egg_name())
+        for group, eps in entry_map.iteritems():
+            specs = groups.setdefault(group, [])
+            for ep in eps.itervalues():
+                specs.append((ep.name, ep.module_name, ep.attrs, info))
+    return groups
+
+
+class CachedDistribution(object):
+    """ Distribution of a CachedEntryPoint """
+
+    def __init__(self, project_name, version, location, egg_name):
+        self.project_name = project_name
+        self.key = project_name.lower()
+        self.version = version
+        self.location = location
+        self._egg_name = egg_name
+
+    def egg_name(self):
+        return self._egg_name
+
+    def __str__(self):
+        return '%s %s' % (self.project_name, self.version)
+
+
+class CachedEntryPoint(object):
+    """ Entry point read from the index, loaded without pkg_resources """
+
+    def __init__(self, name, module_name, attrs, dist):
+        self.name = name
+        self.module_name = module_name
+        self.attrs = tuple(attrs)
+        self.dist = dist
+        self.key = (dist.egg_name(), module_name, name, self.attrs)
+
+    def load(self, require=False, *args, **kwds):
+        """ Import the module of the entry point and return its object """
+        module = __import__(self.module_name, fromlist=['__name__'])
+        obj = module
+        for attr in self.attrs:
+            try:
+                obj = getattr(obj, attr)
+            except AttributeError, e:
+                raise ImportError("%r has no %r attribute" % (obj, attr))
+        return obj
+
+    def __str__(self):
+        s = '%s = %s' % (self.name, self.module_name)
+        if self.attrs:
+            s += ':' + '.'.join(self.attrs)
+        return s
+
+    def __repr__(self):
+        return 'CachedEntryPoint.parse(%r)' % str(self)
+
+
+class EntryPointIndex(object):
+    """
+    Entry points of all the groups, built with pkg_resources when the
+    python path changes and saved in a file.
+    """
+
+    def __init__(self, filename=None):
+        """
+        :param filename: file of the index (default .alea_ep_index in the
+            OpenAlea home directory)
+        """
+        if filename is None:
+            filename = os.path.join(get_openalea_home_dir(), '.alea_ep_index')
+        self.filename = filename
+
+        self._paths = None
+        self._stamp = None
+        # group -> list of (name, module name, attrs, distribution)
+        self._groups = None
+        self._data = {}
+
+    def update(self):
+        """ Build the index again if the python path has changed """
+        paths = search_paths()
+        if paths == self._paths:
+            return
+        self._paths = paths
+        stamp = path_stamp(paths)
+        if stamp == self._stamp:
+            return
+
+        if self._groups is None:
+            saved = self.read()
+            if saved is not None and saved[0] == stamp:
+                self._stamp, self._groups, self._data = saved
+                return
+
+        self._stamp = stamp
+        self._groups = scan_entry_points()
+        self._data = {}
+        self.save()
+
+    def read(self):
+        """ Return (stamp, groups, data) read from the file or None """
+        try:
+            f = open(self.filename, 'rb')
+        except IOError:
+            return None
+        try:
+            try:
+                version, stamp, groups, data = cPickle.load(f)
+            except Exception:
+                return None
+        finally:
+            f.close()
+        if version != INDEX_VERSION:
+            return None
+        return stamp, groups, data
+
+    def save(self):
+        tmp = '%s.%d.tmp' % (self.filename, os.getpid())
+        try:
+            f = open(tmp, 'wb')
+            try:
+                cPickle.dump((INDEX_VERSION, self._stamp, self._groups,
+                              self._data), f, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            if os.name != 'posix' and os.path.exists(self.filename):
+                os.remove(self.filename)
+            os.rename(tmp, self.filename)
+        except (IOError, OSError, cPickle.PicklingError), e:
+            logger.warning("Cannot save entry point index : %s" % (e,))
+
+    def iter_entry_points(self, group, name=None):
+        """ Yield the CachedEntryPoint of group,
+        in the order of pkg_resources.iter_entry_points """
+        self.update()
+        dists = {}
+        for ep_name, module_name, attrs, info in self._groups.get(group, ()):
+            if name is not None and ep_name != name:
+                continue
+            dist = dists.get(info)
+            if dist is None:
+                dist = dists[info] = CachedDistribution(*info)
+            yield CachedEntryPoint(ep_name, module_name, attrs, dist)
+
+    def groups(self):
+        """ Return the names of the groups of entry points """
+        self.update()
+        return self._groups.keys()
+
+    def get_data(self, key, default=None):
+        """ Return the data stored for key since the index was built """
+        self.update()
+        return self._data.get(key, default)
+
+    def set_data(self, key, value):
+        """ Store value (picklable) for key until the index is built again """
+        self.update()
+        self._data[key] = value
+        self.save()
+
+
+_index = None
+
+
+def get_index():
+    """ Return the global index of entry points """
+    global _index
+    if _index is None:
+        _index = EntryPointIndex()
+    return _index
+
+
+def set_index(index):
+    """ Replace the global index of entry points """
+    global _index
+    _index = index
+
+
+def iter_entry_points(group, name=None):
+    """ Yield the entry points of group from the global index """
+    return get_index().iter_entry_points(group, name)
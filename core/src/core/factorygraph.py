@@ -0,0 +1,252 @@
+# -*- python -*-
+#
+#       OpenAlea.Core
+#
+#       Copyright 2006-2009 INRIA - CIRAD - INRA
+#
+#       Distributed under the Cecill-C License.
+#       See accompanying file LICENSE.txt or copy at
+#           http://www.cecill.info/licences/Licence_CeCILL-C_V1-en.html
+#
+#       OpenAlea WebSite : http://openalea.gforge.inria.fr
+#
+###############################################################################
+"""Dependency graph of the composite node factories of the package manager.
+
+A composite node factory uses the factories of its elements (elt_factory).
+The graph keeps, for each composite factory, the (package, factory) names of
+its elements, and computes on demand and caches:
+  - the factories used directly or indirectly by a composite factory and
+    the elements which cannot be found,
+  - the composite factories using a factory directly or indirectly.
+
+Factories are identified by (package name, factory name).
+"""
+
+__license__ = "Cecill-C"
+__revision__ = " $Id$ "
+
+from openalea.core.pkgdict import is_protected
+
+
+class FactoryGraph(object):
+    """
+    Dependency graph of the composite factories of a package dictionary.
+
+    The graph is updated before each query: packages added, removed or
+    modified since the last query (see PackageDict.version) are read again
+    and the cached closures are dropped. Composite factories modified in
+    place are not seen until their package is modified.
+    """
+
+    def __init__(self):
+        self._pkgs = None
+        self._pkgs_version = None
+        self._names = []
+
+        # package name -> (package, version, composite keys)
+        self._packages = {}
+        # composite key -> factory
+        self._composites = {}
+        # composite key -> (package name, factory name) of its elements
+        self._elements = {}
+
+        # Derived from the elements and the registered packages,
+        # dropped when a package changes
+        # (package name, factory name) -> key of the factory or None
+        self._resolved = {}
+        # key -> (keys used, missing elements), transitive
+        self._closures = {}
+        # key -> keys of the composites using it directly
+        self._users = None
+        # factory name -> keys of the factories used by composites
+        self._used_names = None
+        # key -> keys of the composites using it, transitive
+        self._ancestors = {}
+
+    def clear(self):
+        self.__init__()
+
+    def invalidate(self):
+        """ Drop the closures and the reverse adjacency """
+        self._resolved = {}
+        self._closures = {}
+        self._users = None
+        self._used_names = None
+        self._ancestors = {}
+
+    def update(self, pkgs):
+        """ Update the graph with the packages of the PackageDict pkgs """
+
+        if pkgs is not self._pkgs:
+            self.clear()
+            self._pkgs = pkgs
+
+        if pkgs.version != self._pkgs_version:
+            self._pkgs_version = pkgs.version
+            self._names = [name for name in pkgs.iterkeys()
+                           if not is_protected(name)]
+            for name in set(self._packages).difference(self._names):
+                self.remove_package(name)
+            self.invalidate()
+
+        for name in self._names:
+            pkg = dict.__getitem__(pkgs, name)
+            indexed = self._packages.get(name)
+            if (indexed is None or indexed[0] is not pkg or
+                indexed[1] != pkg.version):
+                self.add_package(name, pkg)
+                self.invalidate()
+
+    def add_package(self, name, pkg):
+        """ Read the composite factories of pkg registered under name """
+
+        self.remove_package(name)
+
+        keys = []
+        for fname, factory in pkg.iteritems():
+            if is_protected(fname) or not factory.is_composite_node():
+                continue
+            key = (pkg.name, factory.name)
+            keys.append(key)
+            self._composites[key] = factory
+
+            elements = []
+            for p, n in factory.elt_factory.itervalues():
+                if is_protected(p) or is_protected(n):
+                    continue
+                if (p, n) not in elements:
+                    elements.append((p, n))
+            self._elements[key] = elements
+
+        self._packages[name] = (pkg, pkg.version, keys)
+
+    def remove_package(self, name):
+        """ Remove the composite factories of the package registered
+        under name """
+
+        indexed = self._packages.pop(name, None)
+        if indexed is None:
+            return
+        for key in indexed[2]:
+            self._composites.pop(key, None)
+            self._elements.pop(key, None)
+
+    # Forward
+
+    def resolve(self, element):
+        """ Return the key of the factory of element (package name,
+        factory name) or None if it is not registered """
+        try:
+            return self._resolved[element]
+        except KeyError:
+            pass
+        p, n = element
+        try:
+            factory = self._pkgs[p][n]
+            key = (factory.package.name, factory.name)
+        except Exception:
+            key = None
+        self._resolved[element] = key
+        return key
+
+    def closure(self, key):
+        """ Return (keys, missing): the keys of the factories used directly
+        or indirectly by the composite key, and the elements which are not
+        registered """
+
+        closure = self._closures.get(key)
+        if closure is not None:
+            return closure
+
+        keys = set()
+        missing = set()
+        expanded = set([key])
+        stack = [key]
+        while stack:
+            for element in self._elements.get(stack.pop(), ()):
+                used = self.resolve(element)
+                if used is None:
+                    missing.add(element)
+                    continue
+                keys.add(used)
+                if used in expanded:
+                    continue
+                expanded.add(used)
+                # closures are complete, even through cycles
+                known = self._closures.get(used)
+                if known is not None:
+                    keys.update(known[0])
+                    missing.update(known[1])
+                else:
+                    stack.append(used)
+
+        closure = self._closures[key] = (frozenset(keys), frozenset(missing))
+        return closure
+
+    def dependencies(self, factory):
+        """ Return (keys, missing) of the composite factory,
+        see closure """
+        if not factory.is_composite_node():
+            return frozenset(), frozenset()
+        key = (factory.package.name if factory.package else None,
+               factory.name)
+        if self._composites.get(key) is factory:
+            return self.closure(key)
+
+        # factory not registered in the packages
+        keys = set()
+        missing = set()
+        for p, n in factory.elt_factory.itervalues():
+            if is_protected(p) or is_protected(n):
+                continue
+            used = self.resolve((p, n))
+            if used is None:
+                missing.add((p, n))
+            else:
+                keys.add(used)
+                used_keys, used_missing = self.closure(used)
+                keys.update(used_keys)
+                missing.update(used_missing)
+        return frozenset(keys), frozenset(missing)
+
+    # Reverse
+
+    def users(self, key):
+        """ Return the keys of the composites using key directly """
+        if self._users is None:
+            users = {}
+            used_names = {}
+            for cn_key, elements in self._elements.iteritems():
+                for element in elements:
+                    used = self.resolve(element)
+                    if used is not None:
+                        users.setdefault(used, set()).add(cn_key)
+                        used_names.setdefault(used[1], set()).add(used)
+            self._users = users
+            self._used_names = used_names
+        return self._users.get(key, ())
+
+    def used_keys(self, factory_name):
+        """ Return the keys of the used factories named factory_name """
+        self.users(None)
+        return self._used_names.get(factory_name, ())
+
+    def ancestors(self, key):
+        """ Return the keys of the composites using key directly
+        or indirectly """
+
+        ancestors = self._ancestors.get(key)
+        if ancestors is not None:
+            return ancestors
+
+        result = set()
+        stack = [key]
+        while stack:
+            for user in self.users(stack.pop()):
+                if user not in result:
+                    result.add(user)
+                    stack.append(user)
+
+        ancestors = self._ancestors[key] = frozenset(result)
+        return ancestors
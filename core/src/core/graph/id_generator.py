@@ -24,36 +24,48 @@ __revision__=" $Id$ "
 
 
 class IdGenerator(object):
+    """
+    Generate unique ids.
+
+    Released ids are reused before new ones, the last released first.
+    Free ids are stored in a set for membership tests and in a stack for
+    reuse. Ids taken explicitly are only removed from the set, their entry
+    in the stack is discarded when it reaches the top.
+    """
 
     def __init__(self):
         self._id_max=0
+        self._free_ids=set()
         self._id_list=[]
 
     def get_id(self, id=None):
         if id is None:
-            if len(self._id_list)==0:
-                ret=self._id_max
-                self._id_max+=1
-                return ret
-            else:
-                return self._id_list.pop()
+            while self._id_list:
+                ret=self._id_list.pop()
+                if ret in self._free_ids:
+                    self._free_ids.remove(ret)
+                    return ret
+            ret=self._id_max
+            self._id_max+=1
+            return ret
         else:
             if id>=self._id_max:
-                self._id_list.extend(range(self._id_max, id))
+                free_ids=xrange(self._id_max, id)
+                self._free_ids.update(free_ids)
+                self._id_list.extend(free_ids)
                 self._id_max=id+1
                 return id
+            elif id in self._free_ids:
+                self._free_ids.remove(id)
+                return id
             else:
-                try:
-                    ind=self._id_list.index(id)
-                    del self._id_list[ind]
-                    return id
-                except ValueError:
-                    raise IndexError("id %d already used" % id)
+                raise IndexError("id %d already used" % id)
 
     def release_id(self, id):
         if id>self._id_max:
             raise IndexError("id out of range")
-        elif id in self._id_list:
+        elif id in self._free_ids:
             raise IndexError("id already not used")
         else:
+            self._free_ids.add(id)
             self._id_list.append(id)
@@ -0,0 +1,343 @@
+# -*- python -*-
+#
+#       OpenAlea.Core
+#
+#       Copyright 2006-2009 INRIA - CIRAD - INRA
+#
+#       Distributed under the Cecill-C License.
+#       See accompanying file LICENSE.txt or copy at
+#           http://www.cecill.info/licences/Licence_CeCILL-C_V1-en.html
+#
+#       OpenAlea WebSite : http://openalea.gforge.inria.fr
+#
+###############################################################################
+"""Memoization of node outputs.
+
+Outputs of nodes with the `memoize` flag set are stored in a global
+cache keyed by the identity of the node factory and a fingerprint of
+the node inputs. A node evaluated again with the same inputs, even
+after its CompositeNode has been instantiated again, gets its outputs
+from the cache instead of running.
+
+Cached outputs are shared with the nodes, not copied. The key includes a
+stamp of the module defining the node, so that the outputs stored on disk
+are not reused once its source is modified.
+"""
+
+__license__ = "Cecill-C"
+__revision__ = " $Id$ "
+
+import os
+import sys
+import cPickle
+import hashlib
+import threading
+from collections import OrderedDict
+
+from openalea.core.datapool import estimate_size
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class FingerprintError(Exception):
+    """ The value cannot be fingerprinted """
+    pass
+
+
+###############################################################################
+# Hashers
+
+_hashers = []
+_type_hashers = {}  # type -> (hasher, type name), filled on first use
+
+
+def register_hasher(types, hasher):
+    """
+    Register a hasher for values of the given types.
+
+    :param types: a type or a tuple of types
+    :param hasher: function returning a string from a value.
+        Equal values must give the same string.
+
+    Hashers registered last are tried first.
+    """
+    _hashers.insert(0, (types, hasher))
+    _type_hashers.clear()
+
+
+def _type_hasher(cls):
+    try:
+        return _type_hashers[cls]
+    except KeyError:
+        for types, hasher in _hashers:
+            if issubclass(cls, types):
+                break
+        else:
+            hasher = _pickle_hasher
+        entry = _type_hashers[cls] = (hasher,
+                                      '%s.%s' % (cls.__module__, cls.__name__))
+        return entry
+
+
+def _pickle_hasher(value):
+    try:
+        return cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+    except Exception, e:
+        raise FingerprintError(str(e))
+
+
+def _bytes_hasher(value):
+    return str(value)
+
+
+def _unicode_hasher(value):
+    return value.encode('utf-8')
+
+
+def _numpy_hasher(value):
+    if value.dtype.hasobject:
+        return _pickle_hasher(value)
+    return '%s%s%s' % (value.dtype.str, value.shape,
+                       numpy.ascontiguousarray(value).tostring())
+
+
+register_hasher((str, bytearray, buffer), _bytes_hasher)
+register_hasher(unicode, _unicode_hasher)
+if numpy is not None:
+    register_hasher(numpy.ndarray, _numpy_hasher)
+
+
+def fingerprint(values):
+    """
+    Return a digest of a sequence of values.
+
+    Raise FingerprintError if a value cannot be hashed.
+    """
+    digest = hashlib.sha1()
+    for value in values:
+        hasher, name = _type_hasher(type(value))
+        data = hasher(value)
+        digest.update('%s:%d:' % (name, len(data)))
+        digest.update(data)
+    return digest.hexdigest()
+
+
+def _utf8(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def module_stamp(name):
+    """
+    Return a string which changes when the source file of the module name
+    is modified, empty if the module has no file.
+    """
+    filename = getattr(sys.modules.get(name), '__file__', None)
+    if not filename:
+        return ''
+    if filename.endswith(('.pyc', '.pyo')):
+        filename = filename[:-1]
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return ''
+    return '%s:%s:%d' % (filename, st.st_mtime, st.st_size)
+
+
+def node_key(node):
+    """
+    Return the cache key of a node for its current inputs
+    or None if the inputs cannot be fingerprinted.
+    """
+    obj = node.process_obj
+    if obj is node:
+        obj = node.__class__
+    module = getattr(obj, '__module__', None)
+
+    factory = getattr(node, 'factory', None)
+    if factory is not None:
+        pkg = factory.package
+        pkg_id = pkg.get_id() if pkg is not None else None
+        names = [pkg_id, factory.get_id()]
+    else:
+        names = [module, getattr(obj, '__name__', repr(obj))]
+    ident = ':'.join(map(_utf8, names) + [module_stamp(module)])
+
+    try:
+        return '%s:%s' % (hashlib.sha1(ident).hexdigest(),
+                          fingerprint(node.inputs))
+    except FingerprintError:
+        return None
+
+
+###############################################################################
+# Cache
+
+def get_cache_dir(name='cache'):
+    """
+    Return the default directory of the on-disk cache
+    If it doesn't exist, create it
+    """
+    from openalea.core import settings
+
+    cachedir = os.path.join(settings.get_openalea_home_dir(), name)
+    if not os.path.exists(cachedir):
+        os.makedirs(cachedir)
+    return cachedir
+
+
+class OutputCache(object):
+    """
+    LRU cache of node outputs bounded in number of entries and in bytes.
+
+    Entries evicted from memory stay available from disk
+    when a directory is given. The cache may be used by nodes evaluated in
+    several threads: the entries are updated under a lock, the pickling and
+    the disk accesses are done outside of it.
+    """
+
+    def __init__(self, max_items=256, max_bytes=256 * 2 ** 20,
+                 directory=None):
+        """
+        :param max_items: maximum number of entries kept in memory
+        :param max_bytes: maximum size of the entries kept in memory,
+            measured on their pickled form with a disk tier and estimated
+            (see datapool.estimate_size) otherwise
+        :param directory: directory of the on-disk tier (default None,
+            no disk tier). Use get_cache_dir() for the default one.
+        """
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.directory = directory
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries or (
+            self.directory is not None and os.path.exists(self._path(key)))
+
+    def _path(self, key):
+        return os.path.join(self.directory, key.replace(':', '_') + '.pkl')
+
+    def get(self, key, default=None):
+        """ Return the outputs stored for key, or default """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+                self.hits += 1
+                return entry[0]
+
+        loaded = self._load(key)
+        with self._lock:
+            if loaded is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._store(key, loaded[0], loaded[1])
+        return loaded[0]
+
+    def set(self, key, value):
+        """ Store outputs for key """
+        # outputs are pickled only to be written to disk
+        data = None
+        if self.directory is not None:
+            try:
+                data = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+            except Exception:
+                # not picklable: kept in memory only
+                pass
+        if data is not None:
+            self._dump(key, data)
+            size = len(data)
+        else:
+            size = estimate_size(value)
+        with self._lock:
+            self._store(key, value, size)
+
+    def _store(self, key, value, size):
+        """ Add an entry and evict the oldest ones, the lock must be held """
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.nbytes -= old[1]
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (value, size)
+        self.nbytes += size
+        while self._entries and (len(self._entries) > self.max_items or
+                                 self.nbytes > self.max_bytes):
+            self.nbytes -= self._entries.popitem(last=False)[1][1]
+
+    def _dump(self, key, data):
+        if self.directory is None:
+            return
+        path = self._path(key)
+        # a file per thread, the same key may be stored by several threads
+        tmp = '%s.%d.tmp' % (path, threading.current_thread().ident)
+        try:
+            f = open(tmp, 'wb')
+            try:
+                f.write(data)
+            finally:
+                f.close()
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            pass
+
+    def _load(self, key):
+        """ Return (value, size) read from disk or None """
+        if self.directory is None:
+            return None
+        try:
+            f = open(self._path(key), 'rb')
+        except IOError:
+            return None
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        try:
+            return cPickle.loads(data), len(data)
+        except Exception:
+            return None
+
+    def clear(self, disk=False):
+        """ Remove all the entries in memory, and on disk if disk is True """
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+        if disk and self.directory is not None:
+            for name in os.listdir(self.directory):
+                if name.endswith('.pkl'):
+                    try:
+                        os.remove(os.path.join(self.directory, name))
+                    except OSError:
+                        pass
+
+
+_output_cache = None
+
+
+def get_output_cache():
+    """ Return the global cache of node outputs """
+    global _output_cache
+    if _output_cache is None:
+        _output_cache = OutputCache()
+    return _output_cache
+
+
+def set_output_cache(cache):
+    """ Replace the global cache of node outputs """
+    global _output_cache
+    _output_cache = cache
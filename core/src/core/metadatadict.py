@@ -181,9 +181,29 @@ class HasAdHoc(object):
                 cls.__ad_hoc_from_old_map__ = cls.__ad_hoc_from_old_map__.copy()
             cls.__ad_hoc_from_old_map__[name] = args
 
+    # created on first access: only the views use the ad hoc data
+    __ad_hoc_dict = None
+    # values given to load_ad_hoc_dict before the creation of the dictionnary
+    __ad_hoc_values = None
+
     def __init__(self):
-        self.__ad_hoc_dict = MetaDataDict(slots= {} if not hasattr(self,'__ad_hoc_slots__') else self.__ad_hoc_slots__)
+        pass
 
     def get_ad_hoc_dict(self):
+        if self.__ad_hoc_dict is None:
+            self.__ad_hoc_dict = MetaDataDict(slots= {} if not hasattr(self,'__ad_hoc_slots__') else self.__ad_hoc_slots__)
+            for values in self.__ad_hoc_values or ():
+                self.__ad_hoc_dict.update(MetaDataDict(dict=values))
+            self.__ad_hoc_values = None
         return self.__ad_hoc_dict
 
+    def load_ad_hoc_dict(self, values):
+        """ Update the ad hoc dictionnary with values (a dict {key:value,...}
+        or a MetaDataDict) when it is first accessed """
+        if self.__ad_hoc_dict is not None:
+            self.__ad_hoc_dict.update(MetaDataDict(dict=values))
+        elif self.__ad_hoc_values is None:
+            self.__ad_hoc_values = [values]
+        else:
+            self.__ad_hoc_values.append(values)
+
@@ -48,9 +48,39 @@ can be used to reset internal state and run a given number of step (one by defau
 By default, functions are generated for "init", "run" and "animate"
 """
 
+import hashlib
 from ast import literal_eval
+from collections import OrderedDict
 from copy import copy
 
+# Compiled code objects of the models, see compile_code
+_code_cache = OrderedDict()
+CODE_CACHE_SIZE = 256
+
+
+def compile_code(source, filename='<model>'):
+    """
+    Return the code object of source, compiled once for each source and
+    filename. Return None if source is not plain Python (IPython magics,
+    syntax errors, ...): it must be run with run_cell.
+    """
+    if isinstance(source, unicode):
+        data = source.encode('utf-8')
+    else:
+        data = source
+    key = (hashlib.sha1(data).hexdigest(), filename)
+    try:
+        code = _code_cache.pop(key)
+    except KeyError:
+        try:
+            code = compile(source, filename, 'exec')
+        except (SyntaxError, TypeError, ValueError):
+            code = None
+    _code_cache[key] = code
+    if len(_code_cache) > CODE_CACHE_SIZE:
+        _code_cache.popitem(last=False)
+    return code
+
 
 class IModel(object):
     dtype = None
@@ -137,9 +167,16 @@ class IModel(object):
 class Model(object):
     icon = ''
 
+    # Fast mode: init and step codes are executed in the namespace of the
+    # model, without going through the interpreter and without copying its
+    # namespace at each step. Exceptions are raised instead of being
+    # displayed by the interpreter.
+    fast = False
+
     def __init__(self, name=None, **kwds):
         from openalea.core.service.ipython import interpreter
         self.interp = interpreter()
+        self.fast = kwds.pop('fast', self.fast)
 
         self.inputs_info = []
         self.outputs_info = []
@@ -148,6 +185,8 @@ class Model(object):
 
         self._ns = {}
         self._code = {}
+        # fname -> (source, code object)
+        self._code_objects = {}
         self._initial_code = ''
 
         self.outputs = []
@@ -157,17 +196,39 @@ class Model(object):
 
     def __copy__(self):
         m = self.__class__(name=self.name)
+        m.fast = self.fast
         m.inputs_info = list(self.inputs_info)
         m.outputs_info = list(self.outputs_info)
         for fname, code in self._code.iteritems():
             m.set_func_code(fname, code)
         return m
 
-    def _run_code(self, code):
+    def _run_code(self, code, fname=None):
         if isinstance(code, basestring):
-            self.interp.run_cell(code)
-        else:
-            self.interp.run_code(code)
+            if fname is not None:
+                code_obj = self._code_object(fname)
+            else:
+                code_obj = compile_code(code, '<%s>' % self.name)
+            if code_obj is None:
+                self.interp.run_cell(code)
+                return
+            code = code_obj
+        self.interp.run_code(code)
+
+    def _code_object(self, fname):
+        """ Return the code object of function fname (see compile_code) """
+        source = self._code[fname]
+        entry = self._code_objects.get(fname)
+        if entry is None or entry[0] is not source:
+            entry = self._code_objects[fname] = (
+                source, compile_code(source, '<%s:%s>' % (self.name, fname)))
+        return entry[1]
+
+    def _compiled(self, fname):
+        """ Return the code object of function fname if the model is run
+        in fast mode, else None """
+        if self.fast and fname in self._code:
+            return self._code_object(fname)
 
     def set_code(self, code):
         self.set_step_code(code)
@@ -183,6 +244,12 @@ class Model(object):
         self._old_ns = copy(self.interp.user_ns)
 
     def _fill_namespace(self, *args, **kwds):
+        self._ns = self._build_namespace(self._old_ns, *args, **kwds)
+
+        self.interp.user_ns.clear()
+        self.interp.user_ns.update(self._ns)
+
+    def _build_namespace(self, interp_ns, *args, **kwds):
         # Create a new namespace with
         #  - interpreter namespace
         #  - initial namespace given by user (namespace keyword)
@@ -191,7 +258,7 @@ class Model(object):
         initial_ns = kwds.pop('namespace', {})
 
         global_ns = {}
-        global_ns.update(self._old_ns)
+        global_ns.update(interp_ns)
         global_ns.update(initial_ns)
         global_ns.update(kwds)
         global_ns['this'] = self
@@ -199,10 +266,7 @@ class Model(object):
         kwargs = self.inputs_from_ns(self.inputs_info, global_ns, *args, **kwds)
         global_ns.update(kwargs)
 
-        self._ns = global_ns
-
-        self.interp.user_ns.clear()
-        self.interp.user_ns.update(self._ns)
+        return global_ns
 
     def _populate_ns(self):
         # add vars defined in init function
@@ -217,12 +281,21 @@ class Model(object):
         self.interp.user_ns.update(self._old_ns)
 
     def init(self, *args, **kwds):
+        code = self._compiled('init')
+        if code is not None or (self.fast and 'init' not in self._code):
+            # fast mode: the interpreter namespace is only read
+            self._ns = self._build_namespace(self.interp.user_ns,
+                                             *args, **kwds)
+            if code is not None:
+                exec code in self._ns
+            return self.output_from_ns(self._ns)
+
         self._push_ns()
         self._fill_namespace(*args, **kwds)
 
         # Run init code
         if 'init' in self._code:
-            self._run_code(self._code['init'])
+            self._run_code(self._code['init'], 'init')
 
         self._populate_ns()
         self._pop_ns()
@@ -233,6 +306,12 @@ class Model(object):
         return self.run(*args, **kwds)
 
     def _exec(self, fname='step'):
+        code = self._compiled(fname)
+        if code is not None:
+            exec code in self._ns
+            self.outputs = self.output_from_ns(self._ns)
+            return self.outputs
+
         # Save namespace
         old_ns = {}
         old_ns.update(self.interp.user_ns)
@@ -241,7 +320,7 @@ class Model(object):
 
         # Run code
         if fname in self._code:
-            self._run_code(self._code[fname])
+            self._run_code(self._code[fname], fname)
         outputs = self.output_from_ns(self.interp.user_ns)
 
         self.interp.user_ns.clear()
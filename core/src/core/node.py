@@ -39,6 +39,10 @@ from observer import Observed, AbstractListener
 from actor import IActor
 from metadatadict import MetaDataDict, HasAdHoc
 from interface import TypeNameInterfaceMap
+from memoize import node_key, get_output_cache
+
+_no_output = object()
+
 # Exceptions
 class RecursionError (Exception):
     """todo"""
@@ -170,6 +174,14 @@ class AbstractPort(dict, Observed, HasAdHoc):
         other.get_ad_hoc_dict().update(self.get_ad_hoc_dict())
         self.transfer_listeners(other)
 
+    def copy_for(self, vertex):
+        """ Return a copy of the port for vertex """
+        port = self.__class__(vertex)
+        port.update(self)
+        port.set_id(self.get_id())
+        port.get_ad_hoc_dict().update(self.get_ad_hoc_dict())
+        return port
+
     def get_id(self):
         return self.__id
 
@@ -255,6 +267,14 @@ class Node(AbstractNode):
     Inputs and Outpus are indexed by their position or by a name (str)
     """
 
+    # see set_compact
+    compact = False
+    # True while the port descriptors are shared with the other nodes
+    # of the factory, see own_ports
+    _shared_ports = False
+    # see continuous_eval
+    _continuous_eval = None
+
     @staticmethod
     def is_deprecated_event(event):
         evLen = len(event)
@@ -302,10 +322,21 @@ class Node(AbstractNode):
         # Add delay
         self.internal_data["delay"] = 0
 
-        # Observed object to notify final nodes wich are continuously evaluated
-        self.continuous_eval = Observed()
+    def _get_continuous_eval(self):
+        """ Return the observed object notifying the final nodes which are
+        continuously evaluated, created on first access """
+        if self._continuous_eval is None:
+            self._continuous_eval = Observed()
+        return self._continuous_eval
+
+    def _set_continuous_eval(self, observed):
+        self._continuous_eval = observed
+
+    continuous_eval = property(_get_continuous_eval, _set_continuous_eval)
 
     def notify_listeners(self, event):
+        if not self.has_listeners():
+            return
         txt, trevent = Node.is_deprecated_event(event)
         if txt:
             Observed.notify_listeners(self, trevent)
@@ -317,12 +348,17 @@ class Node(AbstractNode):
         """ Call function. Must be overriden """
         raise NotImplementedError()
 
+    def is_asynchronous(self):
+        """ Return True if __call__ waits on I/O, see asynchronous """
+        return getattr(self.__call__, 'asynchronous', False)
+
     def get_tip(self):
         return self.__doc__
 
     def copy_to(self, other):
         # we copy some attributes.
         self.transfer_listeners(other)
+        other.own_ports()
         # other.internal_data.update(self.internal_data)
         other.get_ad_hoc_dict().update(self.get_ad_hoc_dict())
         for portOld, portNew in zip(self.input_desc + self.output_desc,
@@ -371,6 +407,31 @@ class Node(AbstractNode):
 
     lazy = property(get_lazy, set_lazy)
 
+    def get_memoize(self):
+        """ Return True if the outputs are taken from the output cache
+        when the inputs have already been seen """
+        return self.internal_data.get("memoize", False)
+
+    def set_memoize(self, data):
+        """ Set the memoize flag """
+        self.internal_data["memoize"] = data
+        self.notify_listeners(("internal_data_changed", "memoize", data))
+
+    memoize = property(get_memoize, set_memoize)
+
+    def get_vectorized(self):
+        """ Return True if the node accepts sequences of values in place of
+        its values and returns the sequences of the results, see
+        BatchEvaluation """
+        return self.internal_data.get("vectorized", False)
+
+    def set_vectorized(self, data):
+        """ Set the vectorized flag """
+        self.internal_data["vectorized"] = data
+        self.notify_listeners(("internal_data_changed", "vectorized", data))
+
+    vectorized = property(get_vectorized, set_vectorized)
+
     def get_delay(self):
         """todo"""
         return self.internal_data.get("delay", 0)
@@ -442,10 +503,12 @@ class Node(AbstractNode):
 
         if (s != state):
             changed.add(index)
+            self.own_ports()
             self.input_desc[index].get_ad_hoc_dict().set_metadata("hide", state)
             self.notify_listeners(("hiddenPortChange",))
         elif(index in changed):
             changed.remove(index)
+            self.own_ports()
             self.input_desc[index].get_ad_hoc_dict().set_metadata("hide", state)
             self.notify_listeners(("hiddenPortChange",))
 
@@ -461,7 +524,8 @@ class Node(AbstractNode):
         index = self.map_index_in[index_key]
         if(notify):
             self.notify_listeners(("input_modified", index))
-            self.continuous_eval.notify_listeners(("node_modified",))
+            if self._continuous_eval is not None:
+                self._continuous_eval.notify_listeners(("node_modified",))
 
     # Declarations
     def set_io(self, inputs, outputs):
@@ -472,6 +536,14 @@ class Node(AbstractNode):
         :param outputs: list of dict(name='X', interface=IFloat)
         """
 
+        # ports shared by the nodes of a factory in compact mode
+        shared = getattr(inputs, 'shared_ports', None)
+        if(shared is not None and
+           shared is getattr(outputs, 'shared_ports', None)):
+            self.set_shared_ports(shared)
+            self._to_script_func = None
+            return
+
         # # Values
         if(inputs is None or len(inputs) != len(self.inputs)):
             self.clear_inputs()
@@ -488,7 +560,39 @@ class Node(AbstractNode):
         # to_script
         self._to_script_func = None
 
+    def set_shared_ports(self, shared):
+        """ Use the port descriptors of shared (SharedPorts) instead of
+        creating new ones, see own_ports """
+        self.inputs = [copy(v) for v in shared.defaults]
+        self.input_states = [None] * len(self.inputs)
+        self.input_desc = shared.input_desc
+        self.map_index_in = shared.map_index_in
+        self.outputs = [None] * len(shared.output_desc)
+        self.output_desc = shared.output_desc
+        self.map_index_out = shared.map_index_out
+        self._shared_ports = True
+
+    def own_ports(self):
+        """ Copy the port descriptors shared with the other nodes of the
+        factory (compact mode) before modifying them """
+        if not self._shared_ports:
+            return
+        self._shared_ports = False
+
+        input_desc = []
+        for port in self.input_desc:
+            input_desc.append(port.copy_for(self))
+        self.input_desc = input_desc
+        self.map_index_in = dict(self.map_index_in)
+
+        output_desc = []
+        for port in self.output_desc:
+            output_desc.append(port.copy_for(self))
+        self.output_desc = output_desc
+        self.map_index_out = dict(self.map_index_out)
+
     def clear_inputs(self):
+        self.own_ports()
         # Values
         self.inputs = []
         # Description (list of dict (name=, interface=, ...))
@@ -500,6 +604,7 @@ class Node(AbstractNode):
         self.notify_listeners(("cleared_input_ports",))
 
     def clear_outputs(self):
+        self.own_ports()
         # Values
         self.outputs = []
         # Description (list of dict (name=, interface=, ...))
@@ -531,6 +636,7 @@ class Node(AbstractNode):
         value = copy(value)
 
         name = str(name) # force to have a string
+        self.own_ports()
         self.inputs.append(None)
 
         port = InputPort(self)
@@ -544,8 +650,9 @@ class Node(AbstractNode):
         port.set_id(index)
 
         self.set_input(name, value, False)
-        port.get_ad_hoc_dict().set_metadata("hide",
-                                            kargs.get("hide", False))
+        # False is the default of the ad hoc data
+        if kargs.get("hide", False):
+            port.get_ad_hoc_dict().set_metadata("hide", kargs["hide"])
         self.notify_listeners(("input_port_added", port))
         return port
 
@@ -554,6 +661,7 @@ class Node(AbstractNode):
 
         # Get parameters
         name = str(kargs['name'])
+        self.own_ports()
         self.outputs.append(None)
 
         port = OutputPort(self)
@@ -578,7 +686,9 @@ class Node(AbstractNode):
         if(self.lazy):
             # Test if the inputs has changed
             try:
-                changed = (cmp(self.inputs[index], val) != 0)
+                old = self.inputs[index]
+                # same object: avoid a costly comparison
+                changed = (old is not val) and (cmp(old, val) != 0)
             except:
                 pass
 
@@ -643,8 +753,18 @@ class Node(AbstractNode):
 
         self.notify_listeners(("start_eval",))
 
-        # Run the node
-        outlist = self.__call__(self.inputs)
+        # Run the node, or get its outputs from the cache
+        key = None
+        if self.memoize and self.delay == 0:
+            key = node_key(self)
+        if key is not None:
+            cache = get_output_cache()
+            outlist = cache.get(key, _no_output)
+            if outlist is _no_output:
+                outlist = self.__call__(self.inputs)
+                cache.set(key, outlist)
+        else:
+            outlist = self.__call__(self.inputs)
 
         # Copy outputs
         # only one output
@@ -704,6 +824,15 @@ class Node(AbstractNode):
         in_ports = []
         out_ports = []
 
+        if self._shared_ports:
+            # the shared ports have no vertex
+            odict['input_desc'] = [copy(port) for port in self.input_desc]
+            odict['output_desc'] = [copy(port) for port in self.output_desc]
+            odict['map_index_in'] = dict(self.map_index_in)
+            odict['map_index_out'] = dict(self.map_index_out)
+            odict['_shared_ports'] = False
+            return odict
+
         for i, port in enumerate(self.input_desc):
             port.vertex = None
             in_ports.append(copy(port))
@@ -721,6 +850,9 @@ class Node(AbstractNode):
 
     def __setstate__(self, dict):
         self.__dict__.update(dict)
+        # saved before continuous_eval was a property
+        if 'continuous_eval' in self.__dict__:
+            self._continuous_eval = self.__dict__.pop('continuous_eval')
 
         for port in self.input_desc:
             port.vertex = ref(self)
@@ -756,7 +888,8 @@ class Node(AbstractNode):
         self.modified = True
         self.notify_listeners(("input_modified", -1))
 
-        self.continuous_eval.notify_listeners(("node_modified", self))
+        if self._continuous_eval is not None:
+            self._continuous_eval.notify_listeners(("node_modified", self))
 
 # X     @property
 # X     def outputs(self):
@@ -790,6 +923,10 @@ class FuncNode(Node):
         if(self.func):
             return self.func(*inputs)
 
+    def is_asynchronous(self):
+        """ Return True if the function waits on I/O, see asynchronous """
+        return getattr(self.func, 'asynchronous', False)
+
     def get_process_obj(self):
         """ Return the process obj """
 
@@ -1060,6 +1197,8 @@ class NodeFactory(AbstractFactory):
         # Cache
         self.nodeclass = None
         self.src_cache = None
+        # (inputs, outputs, PortSpecs, PortSpecs), see get_shared_io
+        self._shared_io = None
 
         # Module path, value=0
         self.nodemodule_path = None
@@ -1094,6 +1233,7 @@ class NodeFactory(AbstractFactory):
         odict['nodemodule'] = None
         odict['nodeclass'] = None
         odict['module_cache'] = None
+        odict['_shared_io'] = None
         odict['__pkg__'] = None # remove weakref reference
 
         return odict
@@ -1153,12 +1293,14 @@ class NodeFactory(AbstractFactory):
                 if callable(_classobj):
                     classobj = _classobj
 
-            node = FuncNode(self.inputs, self.outputs, classobj)
+            inputs, outputs = self.get_io()
+            node = FuncNode(inputs, outputs, classobj)
 
         # Class inherits from Node
         else:
+            inputs, outputs = self.get_io()
             try:
-                node = classobj(self.inputs, self.outputs)
+                node = classobj(inputs, outputs)
             except TypeError, e:
                 node = classobj()
 
@@ -1179,6 +1321,21 @@ class NodeFactory(AbstractFactory):
 
         return node
 
+    def get_io(self):
+        """ Return the inputs and outputs given to the nodes,
+        with the shared port descriptors in compact mode """
+        if not Node.compact or self.inputs is None or self.outputs is None:
+            return self.inputs, self.outputs
+
+        shared = getattr(self, '_shared_io', None)
+        if(shared is None or shared[0] is not self.inputs or
+           shared[1] is not self.outputs):
+            ports = SharedPorts(self.inputs, self.outputs)
+            shared = self._shared_io = (self.inputs, self.outputs,
+                                        PortSpecs(self.inputs, ports),
+                                        PortSpecs(self.outputs, ports))
+        return shared[2:]
+
     def instantiate_widget(self, node=None, parent=None,
                             edit=False, autonomous=False):
         """ Return the corresponding widget initialised with node """
@@ -1407,6 +1564,55 @@ $NAME = Factory(name=$PNAME,
                                       WIDGETCLASS=repr(f.widgetclass_name),)
         return result
 
+class SharedPorts(object):
+    """
+    Port descriptors shared by the nodes instantiated by a factory in
+    compact mode (see set_compact). The ports have no vertex.
+    """
+
+    def __init__(self, inputs, outputs):
+        node = Node(inputs, outputs)
+        for port in node.input_desc + node.output_desc:
+            port.vertex = None
+
+        # default values of the inputs
+        self.defaults = node.inputs
+        self.input_desc = node.input_desc
+        self.map_index_in = node.map_index_in
+        self.output_desc = node.output_desc
+        self.map_index_out = node.map_index_out
+
+
+class PortSpecs(tuple):
+    """ Description of the inputs or of the outputs of a factory, with the
+    port descriptors used by Node.set_io """
+
+    def __new__(cls, specs, shared_ports):
+        self = tuple.__new__(cls, specs)
+        self.shared_ports = shared_ports
+        return self
+
+
+def asynchronous(func):
+    """ Declare that func, the function of a FuncNode or the __call__
+    method of a Node, waits on I/O (system command, file, network...).
+
+    AsyncEvaluation evaluates these nodes in worker threads, concurrently
+    with the other nodes. """
+    func.asynchronous = True
+    return func
+
+
+def set_compact(compact=True):
+    """ In compact mode, the nodes instantiated by a NodeFactory share the
+    port descriptors of the factory. A node copies them when they are
+    modified (see Node.own_ports).
+
+    The shared ports have no vertex: this mode is intended for headless
+    evaluations. """
+    Node.compact = compact
+
+
 # Utility functions
 def gen_port_list(size):
     """ Generate a list of port description """
@@ -32,19 +32,40 @@ if graphobserver:
     from openalea.grapheditor.observer import *
 else:
    import weakref
-   from collections import deque
+   import threading
+   from collections import deque, OrderedDict
+   from contextlib import contextmanager
 
 
    class Observed(object):
        """ Observed Object """
 
+       # The state is allocated when a listener registers:
+       # most of the observed objects of a dataflow have no listener.
+       _listeners = None
+       __isNotifying = False
+       __postNotifs = None #calls to execute after a notication is done
+       __exclusive = None
+       __blockNotifs = False
+
        def __init__(self):
+           pass
 
-           self.listeners = set()
-           self.__isNotifying = False
-           self.__postNotifs = [] #calls to execute after a notication is done
-           self.__exclusive = None
-           self.__blockNotifs = False
+       def get_listeners(self):
+           """ Return the set of weak references to the listeners """
+           if self._listeners is None:
+               self._listeners = set()
+           return self._listeners
+
+       def set_listeners(self, listeners):
+           self._listeners = listeners
+
+       listeners = property(get_listeners, set_listeners)
+
+       def __post(self, action):
+           if self.__postNotifs is None:
+               self.__postNotifs = []
+           self.__postNotifs.append(action)
 
        def register_listener(self, listener):
            """ Add listener to list of listeners.
@@ -56,11 +77,13 @@ else:
            else:
                def push_listener_after():
                    self.register_listener(listener)
-               self.__postNotifs.append(push_listener_after)
+               self.__post(push_listener_after)
 
        def unregister_listener(self, listener):
            """ Remove listener from the list of listeners """
            if(not self.__isNotifying):
+               if not self._listeners:
+                   return
                if isinstance(listener, weakref.ref):
                    self.listeners.discard(listener)
                else:
@@ -73,14 +96,14 @@ else:
            else:
                def discard_listener_after():
                    self.unregister_listener(listener)
-               self.__postNotifs.append(discard_listener_after)
+               self.__post(discard_listener_after)
 
        def transfer_listeners(self, newObs):
            """Takes all this observed's listeners, unregisters them
            from itself and registers them to the newObs, calling
            listener.change_observed if implemented"""
            self.__isNotifying = True
-           for lis in self.listeners:
+           for lis in self._listeners or ():
                self.unregister_listener(lis)
                newObs.register_listener(lis())
                lis().change_observed(self, newObs)
@@ -98,12 +121,28 @@ else:
            command(*args, **kargs)
            self.__exclusive = None
 
+       def has_listeners(self):
+           """ Return True if a notification would reach a listener """
+           return bool(self._listeners) or self.__exclusive is not None
+
        def notify_listeners(self, event=None):
            """
-           Send a notification to all listeners
+           Send a notification to all listeners, or to the current
+           observed_batch
 
            :param event: an object to pass to the notify function
            """
+           if not self._listeners and self.__exclusive is None:
+               return
+
+           batch = current_batch()
+           if batch is not None and self.__exclusive is None:
+               batch.add(self, event)
+           else:
+               self.send_notification(event)
+
+       def send_notification(self, event=None):
+           """ Send a notification to all listeners now """
 
            self.__isNotifying = True
 
@@ -131,16 +170,89 @@ else:
            self.post_notification()
 
        def post_notification(self):
-           for action in self.__postNotifs:
-               action()
-           self.__postNotifs = []
+           if self.__postNotifs:
+               for action in self.__postNotifs:
+                   action()
+               self.__postNotifs = None
 
        def __getstate__(self):
            """ Pickle function """
            odict = self.__dict__.copy()
-           odict['listeners'] = set()
+           odict['_listeners'] = None
            return odict
 
+   class NotificationBatch(object):
+       """ Notifications sent during an observed_batch, delivered when
+       the outermost batch ends.
+
+       Notifications of a sender with the same event type and first
+       argument (e.g. ('data_modified', key, value) or ('input_modified',
+       index)) are coalesced: the last one is delivered, at the position
+       of the first one.
+       """
+
+       def __init__(self):
+           self.depth = 0
+           self.events = OrderedDict()
+
+       def add(self, sender, event):
+           if isinstance(event, tuple):
+               key = (id(sender), event[:2])
+           else:
+               key = (id(sender), event)
+           try:
+               hash(key)
+           except TypeError:
+               key = object()
+           self.events[key] = (sender, event)
+
+       def take(self):
+           """ Remove the notifications not delivered yet and return them in a
+           new NotificationBatch, e.g. to deliver them in another thread """
+           batch = NotificationBatch()
+           batch.events, self.events = self.events, batch.events
+           return batch
+
+       def deliver(self):
+           events = self.events
+           self.events = OrderedDict()
+           for sender, event in events.itervalues():
+               sender.send_notification(event)
+
+
+   _batch = threading.local()
+
+
+   def current_batch():
+       """ Return the NotificationBatch of the current thread, or None """
+       return getattr(_batch, 'batch', None)
+
+
+   @contextmanager
+   def observed_batch():
+       """
+       Delay and coalesce the notifications sent in the current thread
+       until the end of the block.
+
+           >>> with observed_batch():
+           ...     cn.eval_as_expression()
+
+       Batches can be nested, the notifications are delivered at the end of
+       the outermost one, even if an exception is raised.
+       """
+       batch = current_batch()
+       if batch is None:
+           batch = _batch.batch = NotificationBatch()
+       batch.depth += 1
+       try:
+           yield batch
+       finally:
+           batch.depth -= 1
+           if batch.depth == 0:
+               _batch.batch = None
+               batch.deliver()
+
+
    class AbstractListener(object):
        """ Listener base class """
 
@@ -46,6 +46,9 @@ class PackageDict(dict):
     This object is able to handle protected entry begining with an '#'
     """
 
+    # incremented at each modification
+    version = 0
+
     def __init__(self, *args):
         self.nb_public = None
         dict.__init__(self, *args)
@@ -67,6 +70,7 @@ class PackageDict(dict):
            not is_protected(item)):
             self.nb_public += 1
 
+        self.version += 1
         return dict.__setitem__(self, lower(item), y)
 
     def __contains__(self, key):
@@ -86,11 +90,37 @@ class PackageDict(dict):
         if (self.nb_public and not is_protected(key)):
             self.nb_public -= 1
 
+        self.version += 1
         return dict.__delitem__(self, lower(key))
 
     def get(self, key, default=None):
         return dict.get(self, lower(key), default)
 
+    def clear(self):
+        # counted again by nb_public_values
+        self.nb_public = None
+        self.version += 1
+        dict.clear(self)
+
+    def update(self, *args, **kwds):
+        for item, y in dict(*args, **kwds).iteritems():
+            self[item] = y
+
+    def setdefault(self, item, default=None):
+        if item not in self:
+            self[item] = default
+        return self[item]
+
+    def pop(self, key, *args):
+        self.nb_public = None
+        self.version += 1
+        return dict.pop(self, lower(key), *args)
+
+    def popitem(self):
+        self.nb_public = None
+        self.version += 1
+        return dict.popitem(self)
+
     def iter_public_values(self):
         """ Iterate througth dictionnary value (remove protected value)  """
 
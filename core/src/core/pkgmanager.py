@@ -31,17 +31,22 @@ from os.path import isdir
 
 import tempfile
 import urlparse
+import cPickle
 from openalea.core.path import path
 from fnmatch import fnmatch
-from pkg_resources import iter_entry_points
 
 from openalea.core.singleton import Singleton
 from openalea.core.observer import Observed
 from openalea.core.package import (Package, UserPackage, PyPackageReader,
                                    PyPackageReaderWralea, PyPackageReaderVlab)
-from openalea.core.settings import get_userpkg_dir, Settings
-from openalea.core.pkgdict import PackageDict, is_protected, protected
+from openalea.core.settings import (get_userpkg_dir, get_openalea_home_dir,
+                                    Settings)
+from openalea.core.pkgdict import (PackageDict, is_protected, protected,
+                                   lower)
 from openalea.core.category import PackageManagerCategory
+from openalea.core.searchindex import FactoryIndex, search_score
+from openalea.core.factorygraph import FactoryGraph
+from openalea.core.entrypoints import get_index
 from openalea.core import logger
 
 from ConfigParser import NoSectionError, NoOptionError
@@ -53,6 +58,8 @@ from ConfigParser import NoSectionError, NoOptionError
 import time
 DEBUG = False
 SEARCH_OUTSIDE_ENTRY_POINTS = True
+# version of the index of wralea files
+CACHE_VERSION = 2
 
 
 class UnknowFileType(Exception):
@@ -146,6 +153,11 @@ class PackageManager(Observed):
         # dictionary of standard categories
         self.user_category = PackageManagerCategory()
 
+        # inverted index of factories for search_node
+        self.search_index = FactoryIndex()
+        # dependency graph of the composite factories
+        self.dependency_graph = FactoryGraph()
+
         # list of path to search wralea file related to the system
         self.user_wralea_path = set()
         self.sys_wralea_path = set()
@@ -226,11 +238,19 @@ class PackageManager(Observed):
 
         self.sys_wralea_path = set()
         self.deprecated_pkg = set()
+        # entry point name -> paths of its package
+        self.wralea_entry_points = {}
 
         if DEBUG:
             res = {}
+
+        # entry point key -> paths of its package
+        index = get_index()
+        cached = index.get_data('wralea', {})
+        wralea_paths = {}
+
         # Use setuptools entry_point
-        for epoint in iter_entry_points("wralea"):
+        for epoint in index.iter_entry_points("wralea"):
             # Get Deprecated packages
             if self.verbose:
                 pmanLogger.debug(epoint.name + " " + epoint.module_name)
@@ -242,32 +262,40 @@ class PackageManager(Observed):
             # m = epoint.module_name.split('.')
             # p = os.path.join(base, *m)
 
-            # Be careful, this lines will import __init__.py and all its predecessor
-            # to find the path.
-            if DEBUG:
-                print(epoint.module_name)
-                t1 = time.clock()
-
-            try:
-                m = __import__(epoint.module_name, fromlist=epoint.module_name)
-            except ImportError, e:
-                logger.error("Cannot load %s : %s" % (epoint.module_name, e))
-                # self.log.add("Cannot load %s : %s"%(epoint.module_name, e))
-                continue
-
-            if DEBUG:
-                print(epoint.module_name)
-                tn = time.clock() - t1
-                res[tn] = epoint.module_name
+            l = cached.get(epoint.key)
+            if l is None or not all(isdir(p) for p in l):
+                # Be careful, this lines will import __init__.py and all its predecessor
+                # to find the path.
+                if DEBUG:
+                    print(epoint.module_name)
+                    t1 = time.clock()
 
+                try:
+                    m = __import__(epoint.module_name, fromlist=epoint.module_name)
+                except ImportError, e:
+                    logger.error("Cannot load %s : %s" % (epoint.module_name, e))
+                    # self.log.add("Cannot load %s : %s"%(epoint.module_name, e))
+                    continue
+
+                if DEBUG:
+                    print(epoint.module_name)
+                    tn = time.clock() - t1
+                    res[tn] = epoint.module_name
+
+                l = list(m.__path__)
+            wralea_paths[epoint.key] = l
+            self.wralea_entry_points.setdefault(epoint.name.lower(),
+                                                []).extend(l)
 
-            l = list(m.__path__)
             for p in l:
                 p = os.path.abspath(p)
                 logger.info("Wralea entry point: %s (%s) " % (epoint.module_name, p))
                 # self.log.add("Wralea entry point: %s (%s) "%(epoint.module_name, p))
                 self.add_wralea_path(p, self.sys_wralea_path)
 
+        if wralea_paths != cached:
+            index.set_data('wralea', wralea_paths)
+
         # Search the path based on the old method (by hand).
         # Search in openalea namespace
 #        if(self.include_namespace):
@@ -602,8 +630,10 @@ class PackageManager(Observed):
         :return : a list of file paths
         """
 
-        files = set()
-        directories = self.get_wralea_path()
+        return self.find_wralea_in(self.get_wralea_path())
+
+    def find_wralea_in(self, directories):
+        """ Return the paths of the wralea files of directories """
         recursive = True
         if not SEARCH_OUTSIDE_ENTRY_POINTS:
             recursive = False
@@ -636,19 +666,23 @@ class PackageManager(Observed):
         """
         Find all wralea on the system and register them
         If no_cache is True, ignore cache file
+
+        The packages of __wralea__.py files are saved in an index.
+        A wralea file is imported only if it is not in the index
+        or if it has changed since, otherwise its packages
+        are registered from the index.
         """
 
-#        if(no_cache):
-#            self.delete_cache()
+        if(no_cache):
+            self.delete_cache()
         self.set_sys_wralea_path()
         self.set_user_wralea_path()
         if DEBUG:
             t1 = time.clock()
 
         wralea_files = self.find_all_wralea()
-        readerlist = self.create_readers(wralea_files)
-
-        # readerlist = self.find_wralea_files()
+        index = self.get_cache()
+        new_index = {}
 
         if DEBUG:
             t2 = time.clock()
@@ -657,54 +691,288 @@ class PackageManager(Observed):
 
         if DEBUG:
             res = {}
-        for x in readerlist:
+        for filename in wralea_files:
+            filename = str(filename)
             if DEBUG:
                 tn = time.clock()
-            x.register_packages(self)
+            self.register_wralea(filename, index, new_index)
+
             if DEBUG:
                 tt = time.clock() - tn
-                print 'register package ', x.get_pkg_name(), 'in ', time.clock() - tn
-                res[x.filename]=tt
+                print 'register package ', filename, 'in ', tt
+                res[filename]=tt
         if DEBUG:
             t3 = time.clock()
             print '-------------------'
             print 'register_packages takes %f seconds' % (t3 - t2)
-#        self.save_cache()
+
+        names = self.package_names()
+        if new_index != index or names != self.get_cache_names():
+            self.save_cache(new_index, names)
 
         self.rebuild_category()
 
         if DEBUG:
             return res
 
+    def load_package(self, pkg_id, factory_id=None):
+        """
+        Register the package pkg_id and, if factory_id is given, the
+        packages used by this factory, without searching and registering
+        all the wralea files of the system.
+
+        The wralea files of a package are found in the index of wralea
+        files (see find_and_register_packages), or else in the paths of
+        the wralea entry point named like the package.
+
+        Return False if the package, the factory or one of the factories
+        it uses cannot be found. Call init to register all the packages.
+        """
+
+        index, names = self.read_cache()
+        # package name -> wralea files
+        files = {}
+        for filename, l in names.iteritems():
+            for name in l:
+                files.setdefault(name, []).append(filename)
+        new_index = dict(index)
+        registered = set()
+
+        def register(name):
+            if name in self:
+                return True
+            name = lower(name)
+            filenames = (files.get(name) or files.get(protected(name)) or
+                         self.find_wralea_of_entry_point(name))
+            for filename in filenames:
+                if filename not in registered:
+                    registered.add(filename)
+                    self.register_wralea(filename, index, new_index)
+            return name in self
+
+        if not register(pkg_id):
+            return False
+
+        if factory_id is not None:
+            # packages used by the factory, directly or not
+            try:
+                factories = [self[pkg_id][factory_id]]
+            except Exception:
+                return False
+            seen = set()
+            while factories:
+                factory = factories.pop()
+                if not factory.is_composite_node():
+                    continue
+                for p, n in factory.elt_factory.itervalues():
+                    if is_protected(p) or is_protected(n) or (p, n) in seen:
+                        continue
+                    seen.add((p, n))
+                    if not register(p):
+                        return False
+                    try:
+                        factories.append(self[p][n])
+                    except Exception:
+                        return False
+
+        if new_index != index:
+            names = dict(names)
+            names.update(self.package_names())
+            self.save_cache(new_index, names)
+        return True
+
+    def find_wralea_of_entry_point(self, name):
+        """ Return the wralea files of the entry points named name
+        or named like a parent package of name (e.g. 'a.b' for 'a.b.c') """
+
+        directories = set()
+        for ep_name, paths in self.wralea_entry_points.iteritems():
+            if name == ep_name or name.startswith(ep_name + '.'):
+                directories.update(paths)
+        return sorted(str(f) for f in self.find_wralea_in(directories))
+
     # Cache functions
-    # def get_cache_filename(self):
-    #     """ Return the cache filename """
+    def get_cache_filename(self):
+        """ Return the filename of the index of wralea files """
 
-    #     return os.path.join(tempfile.gettempdir(), ".alea_pkg_cache")
+        return os.path.join(get_openalea_home_dir(), ".alea_pkg_index")
 
-    # def save_cache(self):
-    #     """ Save in cache current package manager state """
+    def register_wralea(self, filename, index, new_index):
+        """ Register the packages of the wralea file filename,
+        from index if it has not changed, and add its entry to new_index
 
-    #     f = open(self.get_cache_filename(),'w')
-    #     s = set([pkg.path + "\n" for pkg in self.pkgs.itervalues()])
-    #     f.writelines(list(s))
-    #     f.close()
+        Return False if the file cannot be read """
+        try:
+            stamp = self.file_stamp(filename)
+        except OSError:
+            return False
+
+        cached = index.get(filename)
+        if (cached is not None and cached[0] == stamp and
+            self.load_packages(cached[1])):
+            new_index[filename] = cached
+        else:
+            x = self.get_pkgreader(filename)
+            if x is None:
+                return False
+            x.register_packages(self)
+            if filename.endswith("__wralea__.py"):
+                data = self.dump_packages(filename)
+                if data is not None:
+                    new_index[filename] = (stamp, data)
+        return True
+
+    def package_names(self):
+        """ Return the names of the registered packages by wralea file """
+        names = {}
+        for k, p in self.pkgs.iteritems():
+            filename = getattr(p, 'wralea_path', None)
+            if filename:
+                names.setdefault(os.path.abspath(filename), []).append(k)
+        for l in names.itervalues():
+            l.sort()
+        return names
+
+    def save_cache(self, index, names=None):
+        """ Save the index of wralea files
+
+        :param index: dict filename -> (stamp, data)
+        :param names: dict filename -> names of its packages
+        """
 
-    # def delete_cache(self):
-    #     """ Remove cache """
+        if names is None:
+            names = self.get_cache_names()
+        # written to a temporary file then renamed, another process may
+        # read the index at the same time
+        filename = self.get_cache_filename()
+        tmp = '%s.%d.tmp' % (filename, os.getpid())
+        try:
+            f = open(tmp, 'wb')
+            try:
+                cPickle.dump((CACHE_VERSION, index, names), f,
+                             cPickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            if os.name != 'posix' and os.path.exists(filename):
+                os.remove(filename)
+            os.rename(tmp, filename)
+        except (IOError, OSError, cPickle.PicklingError), e:
+            logger.warning("Cannot save package index : %s" % (e,))
+
+    def delete_cache(self):
+        """ Remove the index of wralea files """
+
+        n = self.get_cache_filename()
+
+        if(os.path.exists(n)):
+            os.remove(n)
+
+    def read_cache(self):
+        """ Return the index of wralea files and the names of their
+        packages (see save_cache) """
 
-    #     n = self.get_cache_filename()
+        try:
+            f = open(self.get_cache_filename(), 'rb')
+        except IOError:
+            return {}, {}
+        try:
+            try:
+                cache = cPickle.load(f)
+            except Exception:
+                return {}, {}
+        finally:
+            f.close()
 
-    #     if(os.path.exists(n)):
-    #         os.remove(n)
+        if cache[0] != CACHE_VERSION:
+            return {}, {}
+        return cache[1:]
 
-    # def get_cache(self):
-    #     """ Return cache contents """
-    #     f = open(self.get_cache_filename(), "r")
-    #     for d in f:
-    #         d = d.strip()
-    #         yield d
-    #     f.close()
+    def get_cache(self):
+        """ Return the index of wralea files (filename -> (stamp, data)) """
+        return self.read_cache()[0]
+
+    def get_cache_names(self):
+        """ Return the names of the packages of the wralea files
+        (filename -> list of names) """
+        return self.read_cache()[1]
+
+    def file_stamp(self, filename):
+        """ Return the modification stamp of a file """
+
+        st = os.stat(filename)
+        return (st.st_mtime, st.st_size)
+
+    def dump_packages(self, filename):
+        """ Return the packages registered from the wralea file filename
+        as a string, or None if they cannot be saved """
+
+        filename = os.path.abspath(filename)
+        pkgs = {}
+        aliases = {}
+        for k, p in self.pkgs.iteritems():
+            if (not isinstance(p, Package) or
+                os.path.abspath(p.wralea_path) != filename):
+                continue
+            pkgs[id(p)] = p
+            if k != p.get_id():
+                aliases.setdefault(id(p), []).append(k)
+
+        entry = []
+        for pid, p in pkgs.iteritems():
+            pstate = p.__dict__.copy()
+            factories = []
+            for name, f in p.iteritems():
+                # factory aliases are added back by add_factory
+                if name != lower(f.name):
+                    continue
+                fstate = f.__getstate__()
+                fstate['__pkg__'] = None
+                fstate['__pkg_id__'] = None
+                fstate['listeners'] = set()
+                factories.append((f.__class__, fstate))
+            entry.append((p.__class__, pstate, factories,
+                          aliases.get(pid, [])))
+
+        try:
+            return cPickle.dumps(entry, cPickle.HIGHEST_PROTOCOL)
+        except Exception:
+            return None
+
+    def load_packages(self, data):
+        """ Register the packages saved by dump_packages
+        Return False if they cannot be loaded """
+
+        try:
+            entry = cPickle.loads(data)
+        except Exception:
+            return False
+
+        for pcls, pstate, factories, aliases in entry:
+            p = pcls.__new__(pcls)
+            PackageDict.__init__(p)
+            p.__dict__.update(pstate)
+            for fcls, fstate in factories:
+                f = fcls.__new__(fcls)
+                f.__dict__.update(fstate)
+                try:
+                    p.add_factory(f)
+                except Exception, e:
+                    self.log.add(str(e))
+
+            self.add_package(p)
+
+            # Add Package Aliases
+            for name in aliases:
+                if name in self:
+                    alias_pkg = self[name]
+                    for name_factory, factory in p.iteritems():
+                        if (name_factory not in alias_pkg and
+                           (alias_pkg.name + '.' + name_factory) not in self):
+                            alias_pkg[name_factory] = factory
+                else:
+                    self[name] = p
+
+        return True
 
     ###############################################################################
     # Package creation
@@ -865,42 +1133,14 @@ class PackageManager(Observed):
 
         search_str = search_str.upper()
 
-        match = []
+        # Only the candidates given by the index are scored
+        self.search_index.update(self.pkgs)
 
-        # Search for each package and for each factory
-        for name, pkg in self.iteritems():
-            if is_protected(name):
-                continue  # alias
-
-            for fname, factory in pkg.iteritems():
-                if is_protected(fname): 
-                    continue  # alias
-
-                # -- The scores for each string that is explored.
-                # They are long ints because we make a 96 bits bitshift
-                # to compute the final score --
-                facNameScore = 0L
-                facDescScore = 0L
-                facCateScore = 0L
-                pkgNameScore = 0L
-
-                fname = factory.name.upper()
-                if search_str in fname:
-                    l = float(len(fname))
-                    facNameScore = long(100 * (1 - fname.index(search_str) / l))
-
-                facDescScore = long(factory.description.upper().count(search_str))
-                facCateScore = long(factory.category.upper().count(search_str))
-
-                pname = pkg.name.upper()
-                if search_str in pname:
-                    l = float(len(pname))
-                    pkgNameScore = long(100 * (1 - pname.index(search_str) / l))
-
-                score = (facNameScore << (32 * 3) | facDescScore << (32 * 2) | 
-                         facCateScore << (32 * 1) | pkgNameScore << (32))
-                if score > 0:
-                    match.append((score, factory))
+        match = []
+        for pkg, factory in self.search_index.candidates(search_str):
+            score = search_score(search_str, factory, pkg)
+            if score > 0:
+                match.append((score, factory))
 
         # Filter ports
         if(nb_inputs >= 0):
@@ -953,45 +1193,10 @@ class PackageManager(Observed):
         return nf
 
     def _dependencies(self, factory):
-        f = factory
-        if not f.is_composite_node():
-            return
-
-        for p, n in f.elt_factory.values():
-            if is_protected(p) or is_protected(n):
-                continue
-            try:
-                fact = self[p][n]
-            except:
-                # print p, n
-                continue
-            yield fact
-
-            for df in self._dependencies(fact):
-                yield df
-
-    def _missing_dependencies(self, factory, l=[]):
-
-        f = factory
-        if not f.is_composite_node():
-            return
-
-        for p, n in f.elt_factory.values():
-            if is_protected(p) or is_protected(n):
-                continue
-            try:
-                fact = self[p][n]
-            except:
-                l.append((p, n))
-                continue
-            yield fact
-
-            for df in self._missing_dependencies(fact, l):
-                yield df
-
-    def _missing(self, factory, l=[]):
-        list(self._missing_dependencies(factory, l))
-        return l
+        """ Return (keys, missing) of factory, see FactoryGraph.closure """
+        graph = self.dependency_graph
+        graph.update(self.pkgs)
+        return graph.dependencies(factory)
 
     def missing_dependencies(self, package_or_factory=None):
         """ Return all the dependencies of a package or a factory. """
@@ -1023,15 +1228,14 @@ class PackageManager(Observed):
         return d
 
     def _pkg_dependencies(self, package):
-        cns = [f for f in package.itervalues() if f.is_composite_node()]
-        factories = set(
-            (f.package.name, f.name) for cn_factory in cns for f in self._dependencies(cn_factory) 
-            if f.package.name != package.name)
-        return sorted(factories)
+        factories = set()
+        for f in package.itervalues():
+            if f.is_composite_node():
+                factories.update(self._dependencies(f)[0])
+        return sorted(k for k in factories if k[0] != package.name)
 
     def _cn_dependencies(self, factory):
-        factories = set((f.package.name, f.name) for f in self._dependencies(factory))
-        return sorted(factories)
+        return sorted(self._dependencies(factory)[0])
 
     def _all_missing_dependencies(self):
         d = {}
@@ -1042,18 +1246,16 @@ class PackageManager(Observed):
         return d
 
     def _missing_pkg_dependencies(self, package):
-        cns = [f for f in package.itervalues() if f.is_composite_node()]
-        l = []
-        for cn in cns:
-            self._missing(cn, l)
-        factories = set(l)
+        factories = set()
+        for f in package.itervalues():
+            if f.is_composite_node():
+                factories.update(self._dependencies(f)[1])
         if factories:
             return sorted(factories)
         return None
 
     def _missing_cn_dependencies(self, factory):
-        l = []
-        factories = set(self._missing(factory, l))
+        factories = self._dependencies(factory)[1]
         if factories:
             return sorted(factories)
         return None
@@ -1063,13 +1265,12 @@ class PackageManager(Observed):
 
         return a list of factory.
         """
-        res = []
-        for pkg in self.get_packages():
-            cns = [f for f in pkg.itervalues() if f.is_composite_node()]
-            res.extend(
-                (pkg.name, cn.name) for cn in cns for pname, name in self._cn_dependencies(cn) 
-                if name == factory_name)
-        return res
+        graph = self.dependency_graph
+        graph.update(self.pkgs)
+        res = set()
+        for key in graph.used_keys(factory_name):
+            res.update(graph.ancestors(key))
+        return sorted(res)
 
 
 def cmp_name(x, y):
@@ -20,8 +20,15 @@ you can embed its in plugin proxies.
 To do that, you can specify a proxy class for an entire group or for one plugin.
 See :meth:`PluginManager.set_proxy` and "plugin_proxy" parameter in :meth:`PluginManager.add_plugin`.
 
+Entry points are read from the index of :mod:`openalea.core.entrypoints`.
+Once the plugins of an entry point have been loaded, their description is
+kept in this index and they are registered as :class:`LazyPlugin` at next
+starts: their module is imported only when they are used.
+
 """
 
+import os
+import sys
 import inspect
 from warnings import warn
 
@@ -30,8 +37,7 @@ from openalea.core.manager import GenericManager
 from openalea.core.plugin.plugin import PluginDef
 from openalea.core.service.introspection import name
 from openalea.core.util import camel_case_to_lower
-
-from pkg_resources import iter_entry_points
+from openalea.core.entrypoints import get_index
 
 __all__ = ['PluginManager']
 
@@ -65,6 +71,68 @@ def plugin_name(plugin):
     return plugin.name if hasattr(plugin, 'name') else plugin.__class__.__name__
 
 
+def is_simple(value):
+    """ Return True if value is made of builtin types only """
+    if isinstance(value, (basestring, int, long, float, bool, type(None))):
+        return True
+    elif isinstance(value, (list, tuple)):
+        return all(is_simple(v) for v in value)
+    elif isinstance(value, dict):
+        return all(is_simple(k) and is_simple(v)
+                   for k, v in value.iteritems())
+    return False
+
+
+def plugin_description(plugin):
+    """
+    Return a description of plugin from which a LazyPlugin can be made.
+
+    Attributes which are not made of builtin types are not described,
+    they are read from the plugin when they are used.
+    """
+    cls = plugin.__class__
+    attrs = {}
+    lazy = []
+    for attr in dir(plugin):
+        if attr.startswith('_') or attr in ('implementation', 'criteria',
+                                            'plugin_dist'):
+            continue
+        try:
+            value = getattr(plugin, attr)
+        except Exception:
+            value = None
+            lazy.append(attr)
+            continue
+        if is_simple(value):
+            attrs[attr] = value
+        else:
+            lazy.append(attr)
+    return dict(cls=(cls.__module__, cls.__name__), attrs=attrs, lazy=lazy)
+
+
+def module_stamp_file(stamp):
+    """ Return the stamp (filename, mtime) of the file of a stamp,
+    a module in a zipped egg gets the time of the egg """
+    path = stamp[0]
+    while path:
+        try:
+            return stamp[0], os.stat(path).st_mtime
+        except OSError:
+            parent = os.path.dirname(path)
+            if parent == path:
+                break
+            path = parent
+    return None
+
+
+def module_stamp(module_name):
+    """ Return (filename, mtime) of an imported module """
+    filename = getattr(sys.modules.get(module_name), '__file__', None)
+    if filename is None:
+        return None
+    return module_stamp_file((filename, None))
+
+
 def drop_plugin(name):
     try:
         idx = name.lower().index('plugin')
@@ -100,10 +168,40 @@ class PluginManager(GenericManager):
     def generate_item_id(self, plugin):
         return ':'.join([plugin.__class__.__module__, plugin.__class__.__name__])
 
+    # register the plugins described in the entry point index as LazyPlugin
+    lazy = True
+
     def discover(self, group=None, item_proxy=None):
         if "entry_points" in self._autoload:
-            for ep in iter_entry_points(group):
-                self._load_entry_point_plugin(group, ep, item_proxy=item_proxy)
+            index = get_index()
+            lazy = (self.lazy and not self.debug and item_proxy is None and
+                    group not in self._item_proxy)
+            # entry point key -> (module stamp, plugin descriptions)
+            described = index.get_data(('plugins', group), {}) if lazy else {}
+            descriptions = {}
+            for ep in index.iter_entry_points(group):
+                desc = described.get(ep.key)
+                if desc is not None and desc[0] == module_stamp_file(desc[0]):
+                    for plugin_desc in desc[1]:
+                        self._add_lazy_plugin(group, ep, plugin_desc)
+                    descriptions[ep.key] = desc
+                    continue
+
+                items = self._load_entry_point_plugin(group, ep,
+                                                      item_proxy=item_proxy)
+                stamp = module_stamp(ep.module_name)
+                if lazy and items and stamp is not None:
+                    descriptions[ep.key] = (
+                        stamp, [plugin_description(item) for item in items])
+
+            if lazy and descriptions != described:
+                index.set_data(('plugins', group), descriptions)
+
+    def _add_lazy_plugin(self, group, ep, desc):
+        item = LazyPlugin(self, ep, desc)
+        self.patch_ep_plugin(item, ep)
+        self._item.setdefault(group, {})[item.identifier] = item
+        return item
 
     def instantiate(self, item):
         if inspect.isclass(item):
@@ -150,12 +248,15 @@ class PluginManager(GenericManager):
         else:
             plugin_classes = [plugin_class]
 
+        items = []
         for plugin_class in plugin_classes:
             name = plugin_class.name if hasattr(plugin_class, 'name') else plugin_class.__name__
             parts = [str(s) for s in (ep.dist.egg_name(), group, ep.module_name, ep.name, name)]
             identifier = ':'.join(parts)
             item = self.add(plugin_class, group, item_proxy=plugin_proxy, identifier=identifier)
             self.patch_ep_plugin(item, ep)
+            items.append(item)
+        return items
 
     def _load_entry_point_plugin(self, group, entry_point, item_proxy=None):
         ep = entry_point
@@ -163,14 +264,69 @@ class PluginManager(GenericManager):
         if self.debug:
             plugin_class = ep.load()
             logger.debug('%s load plugin %s' % (self.__class__.__name__, ep))
-            self._add_plugin_from_ep(group, ep, plugin_class, item_proxy)
+            return self._add_plugin_from_ep(group, ep, plugin_class, item_proxy)
         else:
             try:
                 plugin_class = ep.load()
             except Exception:
                 logger.error('%s: error loading %s ' % (group, ep))
             else:
-                self._add_plugin_from_ep(group, ep, plugin_class, item_proxy)
+                return self._add_plugin_from_ep(group, ep, plugin_class, item_proxy)
+
+
+class LazyPlugin(object):
+    """
+    Plugin of an entry point registered from its description
+    (see plugin_description) without importing its module.
+
+    The plugin is loaded when its implementation is used, when it is
+    called, when one of its attributes which are not described is read,
+    or when its class is checked (isinstance).
+    """
+
+    def __init__(self, manager, ep, desc):
+        self._desc = desc
+        self._manager = manager
+        self._ep = ep
+        self._plugin = None
+        self.__patched__ = True
+        self.__dict__.update(desc['attrs'])
+
+    def _load(self):
+        """ Return the plugin, loaded at first call """
+        if self._plugin is None:
+            module_name, class_name = self._desc['cls']
+            module = __import__(module_name, fromlist=[class_name])
+            plugin = self._manager.instantiate(getattr(module, class_name))
+            plugin.identifier = self.identifier
+            self._manager.patch_item(plugin)
+            self._manager.patch_ep_plugin(plugin, self._ep)
+            self._plugin = plugin
+        return self._plugin
+
+    @property
+    def criteria(self):
+        return dict((k, v) for k, v in self._desc['attrs'].iteritems()
+                    if k not in ('name_conversion', 'identifier', 'tags'))
+
+    @property
+    def __class__(self):
+        return self._load().__class__
+
+    @property
+    def implementation(self):
+        return self._load().implementation
+
+    def __call__(self, *args, **kwds):
+        return self._load()(*args, **kwds)
+
+    def __getattr__(self, name):
+        if name in self.__dict__.get('_desc', {}).get('lazy', ()):
+            return getattr(self._load(), name)
+        raise AttributeError(name)
+
+    def __repr__(self):
+        return '<LazyPlugin %s>' % (self.identifier,)
 
 
 class SimpleClassPluginProxy(object):
@@ -28,11 +28,11 @@ Plugin fundamentals are:
 
 """
 
-import pkg_resources
 import site
 import sys
 
 from openalea.core.factory import AbstractFactory
+from openalea.core.entrypoints import iter_entry_points
 
 def plugin_name(plugin):
     return plugin.name if hasattr(plugin, 'name') else plugin.__name__
@@ -51,10 +51,12 @@ def discover(group, name=None):
     :todo: check that the same name is not used by several plugins
     """
 
-    plugin_map = {ep.name:ep for ep in pkg_resources.iter_entry_points(group, name)}
+    plugin_map = {ep.name:ep for ep in iter_entry_points(group, name)}
     return plugin_map
 
 def iter_groups():
+    import pkg_resources
+
     groups = set()
     paths = site.getsitepackages()
     usersite = site.getusersitepackages()
@@ -74,7 +76,7 @@ def iter_groups():
 
 
 def iter_plugins(group, name=None, debug=False):
-    for ep in pkg_resources.iter_entry_points(group, name):
+    for ep in iter_entry_points(group, name):
         if debug is True or debug == 'all' or debug == group:
             ep = ep.load()
             if isinstance(ep, (list, tuple)):
@@ -0,0 +1,201 @@
+# -*- python -*-
+#
+#       OpenAlea.Core
+#
+#       Copyright 2006-2009 INRIA - CIRAD - INRA
+#
+#       Distributed under the Cecill-C License.
+#       See accompanying file LICENSE.txt or copy at
+#           http://www.cecill.info/licences/Licence_CeCILL-C_V1-en.html
+#
+#       OpenAlea WebSite : http://openalea.gforge.inria.fr
+#
+###############################################################################
+"""Inverted index of factories used to search nodes in the package manager.
+
+The text of a factory (name, description, category and package name) is
+indexed by trigrams. A query gets the factories containing all the
+trigrams of the searched string, then only these candidates are scored.
+"""
+
+__license__ = "Cecill-C"
+__revision__ = " $Id$ "
+
+from openalea.core.pkgdict import is_protected
+
+GRAM = 3
+
+
+def search_score(search_str, factory, pkg):
+    """
+    Return the score of factory of package pkg for search_str (upper case)
+
+    The score is sorted in the following way:
+      1 - Highest Priority : presence of search_str in factory name
+                       and position in the name (closer to the
+                       begining = higher score)
+      2 - Then : Number of occurences of search_str in the factory
+          description.
+      3 - Then : Number of occurences of search_str in the category name
+      4 - Finally : presence of search_str in package name and position
+          in the name (close to the begining = higher score)
+    """
+
+    # -- The scores for each string that is explored.
+    # They are long ints because we make a 96 bits bitshift
+    # to compute the final score --
+    facNameScore = 0L
+    facDescScore = 0L
+    facCateScore = 0L
+    pkgNameScore = 0L
+
+    fname = factory.name.upper()
+    if search_str in fname:
+        l = float(len(fname))
+        facNameScore = long(100 * (1 - fname.index(search_str) / l))
+
+    facDescScore = long(factory.description.upper().count(search_str))
+    facCateScore = long(factory.category.upper().count(search_str))
+
+    pname = pkg.name.upper()
+    if search_str in pname:
+        l = float(len(pname))
+        pkgNameScore = long(100 * (1 - pname.index(search_str) / l))
+
+    return (facNameScore << (32 * 3) | facDescScore << (32 * 2) |
+            facCateScore << (32 * 1) | pkgNameScore << (32))
+
+
+def grams(text):
+    """ Return the set of trigrams of text """
+    return set(text[i:i + GRAM] for i in xrange(len(text) - GRAM + 1))
+
+
+class FactoryIndex(object):
+    """
+    Inverted index of the factories of a package dictionary.
+
+    The index is updated before each query: packages added, removed or
+    modified since the last query (see PackageDict.version) are indexed
+    again. Factory attributes modified in place are not seen until their
+    package is modified.
+    """
+
+    def __init__(self):
+        self._pkgs = None
+        self._pkgs_version = None
+        self._names = []
+
+        # package name -> (package, version, entry ids, trigrams)
+        self._packages = {}
+        # entry id -> (package, factory)
+        self._entries = {}
+        # trigram -> set of entry ids
+        self._grams = {}
+        # short string -> set of trigrams containing it
+        self._subgrams = {}
+        self._next_id = 0
+
+    def clear(self):
+        self.__init__()
+
+    def update(self, pkgs):
+        """ Update the index with the packages of the PackageDict pkgs """
+
+        if pkgs is not self._pkgs:
+            self.clear()
+            self._pkgs = pkgs
+
+        if pkgs.version != self._pkgs_version:
+            self._pkgs_version = pkgs.version
+            self._names = [name for name in pkgs.iterkeys()
+                           if not is_protected(name)]
+            for name in set(self._packages).difference(self._names):
+                self.remove_package(name)
+
+        for name in self._names:
+            pkg = dict.__getitem__(pkgs, name)
+            indexed = self._packages.get(name)
+            if (indexed is None or indexed[0] is not pkg or
+                indexed[1] != pkg.version):
+                self.add_package(name, pkg)
+
+    def add_package(self, name, pkg):
+        """ Index the factories of pkg registered under name """
+
+        self.remove_package(name)
+
+        ids = []
+        pkg_grams = set()
+        for fname, factory in pkg.iteritems():
+            if is_protected(fname):
+                continue  # alias
+
+            eid = self._next_id
+            self._next_id += 1
+            ids.append(eid)
+            self._entries[eid] = (pkg, factory)
+
+            text = '\n'.join(('', factory.name, factory.description or '',
+                              factory.category or '', pkg.name, ''))
+            text_grams = grams(text.upper())
+            pkg_grams.update(text_grams)
+            for g in text_grams:
+                entries = self._grams.get(g)
+                if entries is None:
+                    entries = self._grams[g] = set()
+                    for i in xrange(1, GRAM):
+                        for j in xrange(GRAM - i + 1):
+                            self._subgrams.setdefault(g[j:j + i],
+                                                      set()).add(g)
+                entries.add(eid)
+
+        self._packages[name] = (pkg, pkg.version, ids, pkg_grams)
+
+    def remove_package(self, name):
+        """ Remove the factories of the package registered under name """
+
+        indexed = self._packages.pop(name, None)
+        if indexed is None:
+            return
+
+        pkg, version, ids, pkg_grams = indexed
+        ids = set(ids)
+        for eid in ids:
+            del self._entries[eid]
+        for g in pkg_grams:
+            entries = self._grams[g]
+            entries -= ids
+            if not entries:
+                del self._grams[g]
+                for i in xrange(1, GRAM):
+                    for j in xrange(GRAM - i + 1):
+                        sub = self._subgrams.get(g[j:j + i])
+                        if sub is not None:
+                            sub.discard(g)
+
+    def candidates(self, search_str):
+        """ Return the list of (package, factory) whose text may contain
+        search_str (upper case) """
+
+        if not search_str:
+            return self._entries.values()
+
+        if len(search_str) < GRAM:
+            ids = set()
+            for g in self._subgrams.get(search_str, ()):
+                ids.update(self._grams[g])
+        else:
+            postings = []
+            for g in grams(search_str):
+                entries = self._grams.get(g)
+                if entries is None:
+                    return []
+                postings.append(entries)
+            postings.sort(key=len)
+            ids = set(postings[0])
+            for entries in postings[1:]:
+                ids &= entries
+
+        entries = self._entries
+        return [entries[eid] for eid in ids]
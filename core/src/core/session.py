@@ -15,7 +15,18 @@
 #
 ###############################################################################
 """Session regroups all the data which can be stored between different 
-executions of the system."""
+executions of the system.
+
+A session saved in `filename` is made of:
+  - `filename`: an index with the modules, the workspaces and the small
+    values of the datapool,
+  - `filename.data/`: one file per large value of the datapool, a .npy
+    file for NumPy arrays (memory mapped on load) or a pickle.
+
+Saving again in the same file only writes the large values which have
+changed. Values of the datapool are loaded on first access.
+Sessions saved by previous versions (shelve) can still be loaded.
+"""
 
 __license__ = "Cecill-C"
 __revision__ = " $Id$ "
@@ -23,6 +34,10 @@ __revision__ = " $Id$ "
 
 import os
 import sys
+import uuid
+import shutil
+import cPickle
+import hashlib
 import weakref
 
 from openalea.core.compositenode import CompositeNodeFactory
@@ -36,6 +51,45 @@ import shelve
 
 import time
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# first line of a session file
+MAGIC = 'OpenAlea session 2\n'
+# arrays of at least ARRAY_SIZE bytes are saved in .npy files
+ARRAY_SIZE = 2 ** 16
+# values pickled in at least INLINE_SIZE bytes are saved in .pkl files
+INLINE_SIZE = 2 ** 16
+
+
+def array_signature(array):
+    """ Return a digest of a contiguous array """
+    digest = hashlib.sha1('%s%s' % (array.dtype.str, array.shape))
+    digest.update(array.data)
+    return digest.hexdigest()
+
+
+def value_loader(data_dir, entry):
+    """ Return a function loading the datapool value saved as entry """
+    kind, data, signature = entry
+    if kind == 'pickle':
+        return lambda: cPickle.loads(data)
+
+    path = os.path.join(data_dir, data)
+    if kind == 'npy':
+        # copy on write: the value can be modified, not the file
+        return lambda: numpy.load(path, mmap_mode='c')
+
+    def load():
+        f = open(path, 'rb')
+        try:
+            return cPickle.load(f)
+        finally:
+            f.close()
+    return load
+
 
 class Session(Observed):
 
@@ -56,6 +110,9 @@ class Session(Observed):
         self.graphViews = weakref.WeakKeyDictionary()
 
         self.datapool = DataPool()
+        # key -> entry of the datapool values saved in _data_dir
+        self._entries = {}
+        self._data_dir = None
 
         # Use dictionary
         self.use_by_name = {}
@@ -117,6 +174,8 @@ class Session(Observed):
         """ Init the Session """
 
         self.session_filename = None
+        self._entries = {}
+        self._data_dir = None
         #self.workspaces = []
 
         # init pkgmanager
@@ -155,7 +214,8 @@ class Session(Observed):
         if (filename):
             self.session_filename = filename
 
-        d = shelve.open(self.session_filename, writeback=True)
+        filename = self.session_filename
+        data_dir = os.path.abspath(filename + '.data')
 
         # modules
         modules_path = []
@@ -164,34 +224,132 @@ class Session(Observed):
             if hasattr(m, '__file__'):
                 modules_path.append((m.__name__, os.path.abspath(m.__file__)))
 
-        d['__modules__'] = modules_path
-        d.sync()
-
         # datapool
-        d['datapool'] = {}
-        for key in self.datapool:
-
+        previous = self._entries if data_dir == self._data_dir else {}
+        entries = {}
+        for key in self.datapool.keys():
             try:
-                d['datapool'][key] = self.datapool[key]
-                d.sync()
+                lazy = self.datapool.get_lazy(key)
+                if lazy is not None and lazy.info is not None:
+                    # not loaded since the session was loaded
+                    entries[key] = self.copy_entry(lazy.info[1], lazy.info[0],
+                                                   data_dir)
+                elif self.datapool.spilled_path(key) is not None:
+                    # already pickled by the datapool
+                    f = open(self.datapool.spilled_path(key), 'rb')
+                    try:
+                        data = f.read()
+                    finally:
+                        f.close()
+                    entries[key] = self.dump_pickle(data, previous.get(key),
+                                                    data_dir)
+                else:
+                    entries[key] = self.dump_value(self.datapool[key],
+                                                   previous.get(key),
+                                                   data_dir)
             except Exception, e:
                 print e
                 print "Unable to save %s in the datapool..." % str(key)
-                del d['datapool'][key]
 
         # workspaces
-        d['workspaces'] = []
+        workspaces = []
         for cpt, ws in enumerate(self.workspaces):
             try:
-                d['workspaces'].append(ws)
-                d.sync()
+                workspaces.append(cPickle.dumps(ws, cPickle.HIGHEST_PROTOCOL))
             except Exception, e:
                 print e
                 print "Unable to save workspace %i. Skip this." % (cpt, )
                 print " WARNING: Your session is not saved. Please save your dataflow as a composite node !!!!!"
-                d['workspaces'].pop()
 
-        d.close()
+        index = dict(modules=modules_path, datapool=entries,
+                     workspaces=workspaces)
+        tmp = filename + '.tmp'
+        f = open(tmp, 'wb')
+        try:
+            f.write(MAGIC)
+            cPickle.dump(index, f, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        if os.name != 'posix' and os.path.exists(filename):
+            os.remove(filename)
+        os.rename(tmp, filename)
+
+        # files of the values which are not saved anymore
+        used = set(entry[1] for entry in entries.itervalues()
+                   if entry[0] != 'pickle')
+        if os.path.isdir(data_dir):
+            for name in os.listdir(data_dir):
+                if name not in used:
+                    try:
+                        os.remove(os.path.join(data_dir, name))
+                    except OSError:
+                        pass
+            if not used:
+                try:
+                    os.rmdir(data_dir)
+                except OSError:
+                    pass
+
+        self._entries = entries
+        self._data_dir = data_dir
+
+    def dump_value(self, value, previous, data_dir):
+        """
+        Return the entry (kind, data, signature) of a datapool value.
+
+        Small values are pickled in the entry, large ones are written in
+        data_dir unless they are unchanged since the previous entry.
+        """
+
+        if (numpy is not None and isinstance(value, numpy.ndarray) and
+                not value.dtype.hasobject and value.nbytes >= ARRAY_SIZE):
+            value = numpy.ascontiguousarray(value)
+            signature = array_signature(value)
+            return self.dump_file('npy', '.npy', value, signature,
+                                  previous, data_dir)
+
+        data = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+        return self.dump_pickle(data, previous, data_dir)
+
+    def dump_pickle(self, data, previous, data_dir):
+        """ Return the entry of a pickled datapool value """
+        if len(data) < INLINE_SIZE:
+            return ('pickle', data, None)
+        signature = hashlib.sha1(data).hexdigest()
+        return self.dump_file('file', '.pkl', data, signature,
+                              previous, data_dir)
+
+    def dump_file(self, kind, ext, value, signature, previous, data_dir):
+        """ Write value (an array or a pickle) in a new file of data_dir
+        unless it is unchanged since the previous entry """
+
+        if (previous is not None and previous[0] == kind and
+                previous[2] == signature and
+                os.path.exists(os.path.join(data_dir, previous[1]))):
+            return previous
+
+        if not os.path.isdir(data_dir):
+            os.makedirs(data_dir)
+        # new file: the previous one may be memory mapped
+        name = uuid.uuid4().hex + ext
+        f = open(os.path.join(data_dir, name), 'wb')
+        try:
+            if kind == 'npy':
+                numpy.save(f, value)
+            else:
+                f.write(value)
+        finally:
+            f.close()
+        return (kind, name, signature)
+
+    def copy_entry(self, entry, src_dir, data_dir):
+        """ Return entry, loaded from src_dir, saved in data_dir """
+        if entry[0] != 'pickle' and src_dir != data_dir:
+            if not os.path.isdir(data_dir):
+                os.makedirs(data_dir)
+            shutil.copyfile(os.path.join(src_dir, entry[1]),
+                            os.path.join(data_dir, entry[1]))
+        return entry
 
     def load(self, filename):
         """ Load session data from filename """
@@ -200,7 +358,48 @@ class Session(Observed):
 
         self.session_filename = filename
 
-        d = shelve.open(self.session_filename)
+        try:
+            f = open(filename, 'rb')
+        except IOError:
+            f = None
+        if f is None or f.read(len(MAGIC)) != MAGIC:
+            if f is not None:
+                f.close()
+            self.load_shelve(filename)
+            return
+
+        try:
+            index = cPickle.load(f)
+        finally:
+            f.close()
+
+        # modules
+        for name, path in index['modules']:
+            self.load_module(name, path)
+
+        # datapool
+        data_dir = os.path.abspath(filename + '.data')
+        entries = index['datapool']
+        for key, entry in entries.iteritems():
+            self.datapool.set_lazy(key, value_loader(data_dir, entry),
+                                   (data_dir, entry))
+        self._entries = dict(entries)
+        self._data_dir = data_dir
+
+        # workspaces
+        for cpt, data in enumerate(index['workspaces']):
+            try:
+                self.workspaces.append(cPickle.loads(data))
+            except Exception, e:
+                print e
+                print "Unable to load workspace %i. Skip this." % (cpt, )
+
+        self.notify_listeners()
+
+    def load_shelve(self, filename):
+        """ Load session data saved with shelve by previous versions """
+
+        d = shelve.open(filename)
 
         # modules
         modules = d['__modules__']
@@ -0,0 +1,474 @@
+# -*- python -*-
+#
+#       OpenAlea.Core
+#
+#       Copyright 2006-2009 INRIA - CIRAD - INRA
+#
+#       Distributed under the Cecill-C License.
+#       See accompanying file LICENSE.txt or copy at
+#           http://www.cecill.info/licences/Licence_CeCILL-C_V1-en.html
+#
+#       OpenAlea WebSite : http://openalea.gforge.inria.fr
+#
+###############################################################################
+"""Parameter sweeps: evaluation of a node for each row of a table of inputs.
+
+The rows are read from a CSV file (a header line with the names of the
+inputs), a JSON lines file (one dict per line) or built as the Cartesian
+product of lists of values (grid). They are evaluated by a pool of worker
+processes, each one with its own instance of the node, and the results are
+written to a JSON lines file as they complete:
+
+    {"row": 3, "inputs": {"a": 1, "b": 2}, "outputs": [3], "time": 0.01}
+    {"row": 4, "inputs": {"a": 1, "b": "x"}, "error": "TypeError: ...",
+     "attempts": 2}
+
+    >>> rows = grid([('a', [1, 2, 3]), ('b', [0.5, 1.])])
+    >>> sweep = Sweep(('pkg', 'node'), rows, 'results.jsonl', processes=4)
+    >>> done, failed, skipped = sweep.run()
+
+With resume, the rows already evaluated without error in the results file
+are skipped and the new results are appended to it. From the command line:
+
+    alea sweep pkg:node --grid a=1,2,3 --grid b=0.5,1. -o results.jsonl
+"""
+
+__license__ = "Cecill-C"
+__revision__ = " $Id$ "
+
+import os
+import sys
+import csv
+import json
+import cPickle
+import time
+import itertools
+import multiprocessing
+import traceback as tb
+from ast import literal_eval
+from Queue import Queue, Empty
+
+from openalea.core.algo.dataflow_evaluation import EvaluationException
+
+
+def parse_value(text):
+    """ Return the python value of text, or text if it is not a literal """
+    try:
+        return literal_eval(text)
+    except (ValueError, SyntaxError):
+        return text
+
+
+def read_table(filename):
+    """ Yield the rows (dict input name -> value) of a CSV
+    or a JSON lines file """
+    f = open(filename, 'rb')
+    try:
+        if filename.endswith('.csv'):
+            for row in csv.DictReader(f):
+                yield dict((k, parse_value(v)) for k, v in row.iteritems())
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    finally:
+        f.close()
+
+
+def grid(axes):
+    """ Yield the rows of the Cartesian product of axes,
+    a list of (input name, list of values) """
+    names = [name for name, values in axes]
+    for values in itertools.product(*[values for name, values in axes]):
+        yield dict(zip(names, values))
+
+
+def parse_grid(specs):
+    """ Return the axes of a grid from strings 'name=value,value,...' """
+    axes = []
+    for spec in specs:
+        name, sep, values = spec.partition('=')
+        if not sep:
+            raise ValueError("Invalid grid %s" % (spec,))
+        axes.append((name, [parse_value(v) for v in values.split(',')]))
+    return axes
+
+
+def read_results(filename):
+    """ Return the indices of the rows evaluated without error
+    in the results file filename """
+    done = set()
+    try:
+        f = open(filename, 'rb')
+    except IOError:
+        return done
+    try:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                # line truncated by an interruption
+                continue
+            if 'error' not in result:
+                done.add(result['row'])
+    finally:
+        f.close()
+    return done
+
+
+def truncate_partial_line(filename):
+    """ Remove the end of filename after its last new line,
+    written by an interrupted sweep """
+    try:
+        f = open(filename, 'r+b')
+    except IOError:
+        return
+    try:
+        f.seek(0, 2)
+        size = f.tell()
+        # read the end of the file until a new line
+        end = size
+        while end > 0:
+            start = max(0, end - 4096)
+            f.seek(start)
+            block = f.read(end - start)
+            i = block.rfind('\n')
+            if i >= 0:
+                end = start + i + 1
+                break
+            end = start
+        if end != size:
+            f.truncate(end)
+    finally:
+        f.close()
+
+
+# Node evaluated by the worker process, its default inputs and the queue
+# of the rows started by the worker
+_node = None
+_defaults = None
+_started = None
+
+
+def init_worker(component, started=None):
+    """ Instantiate the node of component in the worker process.
+
+    :param started: queue receiving (pid, row index, attempt) when the
+        worker starts to evaluate a row
+    """
+    global _node, _defaults, _started
+    from openalea.core.alea import load_package_manager
+
+    _started = started
+
+    pkg_id, node_id = component
+    pm = load_package_manager(pkg_id, node_id)
+    _node = pm[pkg_id][node_id].instantiate()
+    _defaults = [_node.get_input(i) for i in xrange(_node.get_nb_input())]
+
+
+def format_error(e, trace=()):
+    """ Return the string written in the results for the exception e """
+    # error of a node of a composite node
+    while isinstance(e, EvaluationException):
+        e, trace = e.exception, e.exc_info
+    return '%s: %s\n%s' % (e.__class__.__name__, e, ''.join(trace))
+
+
+def evaluate(index, inputs, attempt=1):
+    """ Evaluate the node of the worker with inputs.
+
+    Return (index, outputs, duration, error), error is None or a string.
+    The outputs are pickled here: outputs which can not be sent back to the
+    parent process are an error of the row, instead of a task lost by the
+    pool.
+    """
+    if _started is not None:
+        # the row to blame if the worker dies, see Sweep.lost_rows
+        _started.put((os.getpid(), index, attempt))
+    node = _node
+    t0 = time.time()
+    try:
+        # inputs not given by the row keep their default value
+        for i, value in enumerate(_defaults):
+            node.set_input(i, value)
+        for k, v in inputs.iteritems():
+            node.set_input(k, v)
+        node.eval()
+        outputs = [node.get_output(i) for i in xrange(node.get_nb_output())]
+    except Exception, e:
+        error = format_error(e, tb.format_tb(sys.exc_info()[2]))
+        return index, None, time.time() - t0, error
+
+    try:
+        outputs = cPickle.dumps(outputs, -1)
+    except Exception, e:
+        error = 'Outputs not picklable: %s' % format_error(e)
+        return index, None, time.time() - t0, error
+    return index, outputs, time.time() - t0, None
+
+
+class SerialPool(object):
+    """ Pool evaluating the tasks in the calling process """
+
+    def __init__(self, initializer=None, initargs=()):
+        if initializer is not None:
+            initializer(*initargs)
+
+    def apply_async(self, func, args=(), callback=None):
+        result = func(*args)
+        if callback is not None:
+            callback(result)
+        # the task is already completed, nothing to wait for
+        return None
+
+    def close(self):
+        pass
+
+    def join(self):
+        pass
+
+
+class Sweep(object):
+    """
+    Evaluation of a node for each row of inputs, in worker processes.
+
+    The rows in progress are checked every POLL_INTERVAL seconds: a row
+    whose task has failed, which a worker process was evaluating when it
+    died, or which is not completed after timeout seconds is an error,
+    evaluated again if it has retries left. The workers report the rows
+    they start to a queue of a Manager process, so that only the row of a
+    dead worker is blamed; a worker dying after having taken a row but
+    before reporting it leaves the row to the timeout. A worker stuck on a
+    row which has timed out stays busy until the end of the sweep, when
+    the pool is terminated.
+    """
+
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, component, rows, output, processes=None,
+                 max_in_flight=None, retries=1, resume=False, timeout=None):
+        """
+        :param component: (package id, node id)
+        :param rows: iterable of dict input name -> value
+        :param output: filename of the results (JSON lines)
+        :param processes: number of worker processes (default, number of
+            CPUs), 0 to evaluate the rows in the calling process
+        :param max_in_flight: maximum number of rows sent to the workers
+            and not completed (default, 2 * processes)
+        :param retries: number of new evaluations of a failed row
+        :param resume: if True, skip the rows evaluated without error in
+            output and append the new results to it
+        :param timeout: maximum number of seconds between the submission
+            of a row and its completion (default, no limit)
+        """
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        if max_in_flight is None:
+            max_in_flight = 2 * max(processes, 1)
+
+        self.component = component
+        self.rows = rows
+        self.output = output
+        self.processes = processes
+        self.max_in_flight = max_in_flight
+        self.retries = retries
+        self.resume = resume
+        self.timeout = timeout
+        # worker processes which may be evaluating a row
+        self._workers = set()
+        # queue of the rows started by the workers, see evaluate
+        self._manager = None
+        self._started = None
+        # worker pid -> (index, attempt) of the last row it has started
+        self._running = {}
+        # True if tasks will never complete (the pool can not be joined)
+        self._lost = False
+
+    def create_pool(self):
+        if self.processes:
+            # a worker dying while it writes to a Manager queue does not
+            # leave a lock of the queue acquired
+            self._manager = multiprocessing.Manager()
+            self._started = self._manager.Queue()
+            return multiprocessing.Pool(self.processes, init_worker,
+                                        (self.component, self._started))
+        return SerialPool(init_worker, (self.component,))
+
+    def run(self):
+        """ Evaluate the rows and write the results.
+
+        Return the number of rows evaluated, failed and skipped.
+        """
+        from openalea.core.alea import load_package_manager
+
+        # load the packages before the workers are forked
+        # and check that the node exists
+        pkg_id, node_id = self.component
+        pm = load_package_manager(pkg_id, node_id)
+        pm[pkg_id][node_id]
+
+        skip = set()
+        if self.resume:
+            skip = read_results(self.output)
+            truncate_partial_line(self.output)
+        out = open(self.output, 'ab' if self.resume else 'wb')
+        try:
+            return self._run(skip, out)
+        finally:
+            out.close()
+
+    def submit(self, pool, index, inputs, attempt, results):
+        """ Send the evaluation of a row to pool.
+
+        Return the AsyncResult of the task, or None if it is completed.
+        The results are put in the queue with the attempt they belong to.
+        """
+        # the pool replaces a dead worker quickly, remember the workers
+        # the row may be sent to before it can die
+        self._workers.update(getattr(pool, '_pool', ()))
+        return pool.apply_async(evaluate, (index, inputs, attempt),
+                        callback=lambda ret: results.put((attempt,) + ret))
+
+    def lost_rows(self, pool, pending):
+        """
+        Return the (index, error) of the rows in pending which will not
+        put their result in the queue: the failed tasks (the pool does not
+        call their callback), the rows the worker processes which have
+        died were evaluating and the rows which have timed out.
+        """
+        self._workers.update(getattr(pool, '_pool', ()))
+        died = [w for w in self._workers
+                if getattr(w, 'exitcode', None) not in (None, 0)]
+        self._workers.difference_update(died)
+
+        if self._started is not None:
+            while True:
+                try:
+                    pid, index, attempt = self._started.get_nowait()
+                except Empty:
+                    break
+                self._running[pid] = (index, attempt)
+        # (index, attempt) -> dead worker evaluating it
+        killed = {}
+        for w in died:
+            row = self._running.pop(w.pid, None)
+            if row is not None:
+                killed[row] = w
+
+        now = time.time()
+        lost = []
+        for index, (inputs, attempts, task, submitted) in pending.iteritems():
+            if task is None:
+                continue
+            if task.ready():
+                if not task.successful():
+                    try:
+                        task.get()
+                    except Exception, e:
+                        lost.append((index, format_error(e)))
+            elif (index, attempts) in killed:
+                w = killed[index, attempts]
+                self._lost = True
+                lost.append((index, "RuntimeError: Worker process %s has "
+                             "died (exit code %s)\n" % (w.pid, w.exitcode)))
+            elif (self.timeout is not None and
+                  now - submitted > self.timeout):
+                self._lost = True
+                lost.append((index, "RuntimeError: Row not completed "
+                             "after %s s\n" % self.timeout))
+        return lost
+
+    def _run(self, skip, out):
+        results = Queue()
+        pool = self.create_pool()
+        self._workers.clear()
+        self._running.clear()
+        self._lost = False
+
+        rows = enumerate(self.rows)
+        retry = []
+        # row index -> (inputs, number of attempts, task, submission time)
+        pending = {}
+        done = failed = skipped = 0
+        next_check = time.time() + self.POLL_INTERVAL
+        try:
+            while True:
+                # send rows until max_in_flight
+                # (the rows to retry are pending but not in flight)
+                while len(pending) - len(retry) < self.max_in_flight:
+                    if retry:
+                        index, inputs = retry.pop()
+                    else:
+                        try:
+                            index, inputs = rows.next()
+                        except StopIteration:
+                            break
+                        if index in skip:
+                            skipped += 1
+                            continue
+                    attempts = pending.get(index, (None, 0))[1] + 1
+                    submitted = time.time()
+                    task = self.submit(pool, index, inputs, attempts, results)
+                    pending[index] = (inputs, attempts, task, submitted)
+
+                if not pending:
+                    break
+
+                # a timeout keeps the main process interruptible
+                try:
+                    result = results.get(
+                        timeout=max(next_check - time.time(), 0))
+                except Empty:
+                    result = None
+                # checked even when results keep coming
+                if time.time() >= next_check:
+                    next_check = time.time() + self.POLL_INTERVAL
+                    for index, error in self.lost_rows(pool, pending):
+                        results.put((pending[index][1], index, None,
+                                     time.time() - pending[index][3], error))
+                if result is None:
+                    continue
+                attempt, index, outputs, duration, error = result
+
+                if index not in pending or pending[index][1] != attempt:
+                    # result of a row lost or completed since
+                    continue
+                inputs, attempts = pending[index][:2]
+                if error is not None and attempts <= self.retries:
+                    pending[index] = (inputs, attempts, None, None)
+                    retry.append((index, inputs))
+                    continue
+                del pending[index]
+
+                result = dict(row=index, inputs=inputs)
+                if error is None:
+                    outputs = cPickle.loads(outputs)
+                    result.update(outputs=outputs, time=duration)
+                    done += 1
+                else:
+                    result.update(error=error, attempts=attempts)
+                    failed += 1
+                out.write(json.dumps(result, default=repr, sort_keys=True))
+                out.write('\n')
+                out.flush()
+        except:
+            # interrupted, the rows in progress are lost
+            if hasattr(pool, 'terminate'):
+                pool.terminate()
+            pool.join()
+            self._shutdown_manager()
+            raise
+
+        if self._lost:
+            pool.terminate()
+        else:
+            pool.close()
+        pool.join()
+        self._shutdown_manager()
+        return done, failed, skipped
+
+    def _shutdown_manager(self):
+        if self._manager is not None:
+            self._manager.shutdown()
+            self._manager = self._started = None
@@ -19,7 +19,9 @@
 __license__ = "Cecill-C"
 __revision__ = " $Id$ "
 
-from openalea.core.node import AbstractNode, Node, Annotation
+from itertools import islice
+
+from openalea.core.node import AbstractNode, Node, Annotation, asynchronous
 from openalea.core.dataflow import SubDataflow
 
 DEBUG = False
@@ -45,6 +47,9 @@ class AnnotationNode(Annotation):
 class IterNode(Node):
     """ Iteration Node """
 
+    # the node asks for its reevaluation (see GeneratorEvaluation)
+    generator = True
+
     def __init__(self, *args):
         """ Constructor """
 
@@ -83,6 +88,23 @@ class IterNode(Node):
                 del self.nextval
             return False
 
+    def batches(self, size):
+        """
+        Iterate on the elements of the input by lists of at most size
+        elements, in place of the successive evaluations (see
+        BatchEvaluation)
+        """
+        try:
+            iterable = iter(self.inputs[0])
+        except TypeError:
+            yield [self.inputs[0]]
+            return
+
+        chunk = list(islice(iterable, size))
+        while chunk:
+            yield chunk
+            chunk = list(islice(iterable, size))
+
 
 class IterWithDelayNode(IterNode):
     """ Iteration Node """
@@ -113,10 +135,19 @@ class IterWithDelayNode(IterNode):
                 del self.nextval
             return False
 
+    def batches(self, size):
+        """ See IterNode.batches, the delay is ignored but a null delay
+        stops the iteration after the first element """
+        if self.inputs[1]:
+            return IterNode.batches(self, size)
+        return islice(IterNode.batches(self, 1), 1)
+
 
 class StopSimulation(Node):
     """ Iteration Node """
 
+    generator = True
+
     def __init__(self, *args):
         """ Constructor """
 
@@ -142,6 +173,8 @@ class StopSimulation(Node):
 class Counter(Node):
     """ Loop a number of cycle, then stop """
 
+    generator = True
+
     def __init__(self, *args):
         """ Constructor """
 
@@ -480,6 +513,7 @@ def while_multi2(values, test, function):
         return values
 
 
+@asynchronous
 def system_cmd(str_list):
     """ Execute a system command
     Input : a list of string
@@ -491,6 +525,7 @@ def system_cmd(str_list):
     return subprocess.Popen(str_list, stdout=subprocess.PIPE).communicate()
 
 
+@asynchronous
 def shell_command(cmd, directory):
     """ Execute a command in a shell
     cmd : the command as a string
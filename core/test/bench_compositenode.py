@@ -0,0 +1,59 @@
+__license__ = "Cecill-C"
+__revision__ = " $Id$ "
+
+# Benchmark of the instantiation of composite node factories, with and
+# without prototype, not run by the tests:
+#     python bench_compositenode.py [number of nodes ...]
+import sys
+import time
+
+from openalea.core.pkgmanager import PackageManager
+from openalea.core.compositenode import CompositeNodeFactory, CompositeNode
+
+
+def chain_factory(pkg, nb):
+    """Return the factory of a chain of nb additions"""
+    sg = CompositeNode(inputs=[dict(name='a')], outputs=[dict(name='b')])
+    prev = sg.id_in
+    for i in xrange(nb):
+        vid = sg.add_node(pkg['plus'].instantiate())
+        sg.connect(prev, 0, vid, 0)
+        sg.connect(prev, 0, vid, 1)
+        prev = vid
+    sg.connect(prev, 0, sg.id_out, 0)
+
+    factory = CompositeNodeFactory('chain%d' % nb)
+    sg.to_factory(factory)
+    return factory
+
+
+def instantiate_time(factory, use_prototype, repeat=20):
+    """Return the best time of an instantiation in seconds"""
+    factory.use_prototype = use_prototype
+    factory.instantiate()
+    best = None
+    for i in xrange(repeat):
+        t0 = time.time()
+        factory.instantiate()
+        t = time.time() - t0
+        if best is None or t < best:
+            best = t
+    return best
+
+
+def main(sizes):
+    d = {}
+    execfile('catalog.py', globals(), d)
+    pkg = d['pkg']
+    PackageManager().add_package(pkg)
+
+    print '%8s %12s %12s' % ('nodes', 'no proto ms', 'proto ms')
+    for nb in sizes:
+        factory = chain_factory(pkg, nb)
+        print '%8d %12.2f %12.2f' % (nb,
+                                     1000 * instantiate_time(factory, False),
+                                     1000 * instantiate_time(factory, True))
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [30, 300])
@@ -0,0 +1,36 @@
+__license__ = "Cecill-C"
+__revision__ = " $Id$ "
+
+# Benchmark of the creation and removal of graph vertices, not run by the
+# tests: python bench_graph.py [number of vertices ...]
+import sys
+import time
+
+from openalea.core.graph.graph import Graph
+
+
+def build_and_clear(nb):
+    """Build a graph with explicit vids then remove all its vertices,
+    return the durations of the two steps"""
+    t0 = time.time()
+    g = Graph()
+    for vid in xrange(nb - 1, -1, -1):
+        g.add_vertex(vid)
+    for vid in xrange(nb - 1):
+        g.add_edge((vid, vid + 1))
+    t1 = time.time()
+    for vid in xrange(nb):
+        g.remove_vertex(vid)
+    g.add_vertex()
+    return t1 - t0, time.time() - t1
+
+
+def main(sizes):
+    print '%10s %10s %10s' % ('vertices', 'build', 'clear')
+    for nb in sizes:
+        build, clear = build_and_clear(nb)
+        print '%10d %10.3f %10.3f' % (nb, build, clear)
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [10 ** 4, 10 ** 5])
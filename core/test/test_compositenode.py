@@ -354,3 +354,92 @@ class TestClass:
         assert ''.join(eval(res)) == "toto"
 
 
+
+    def test_eval_algo_cache(self):
+        """ Test that the evaluation algo is kept between evaluations"""
+        sg = CompositeNode()
+
+        val1id = sg.add_node(self.float_node)
+        val2id = sg.add_node(self.pkg['float'].instantiate())
+        sg.connect(val1id, 0, val2id, 0)
+
+        sg.node(val1id).set_input(0, 2.)
+        sg()
+        algo = sg.get_eval_algo()
+        assert sg.get_eval_algo() is algo
+        assert sg.node(val2id).get_output(0) == 2.
+
+        # Topological modifications update the cached structure
+        addid = sg.add_node(self.plus_node)
+        sg.connect(val1id, 0, addid, 0)
+        sg.connect(val2id, 0, addid, 1)
+        sg()
+        assert sg.get_eval_algo() is algo
+        assert sg.node(addid).get_output(0) == 4.
+
+        sg.disconnect(val2id, 0, addid, 1)
+        sg.node(addid).set_input(1, 1.)
+        sg.node(val1id).set_input(0, 3.)
+        sg()
+        assert sg.node(addid).get_output(0) == 4.
+
+        # Changing the algorithm creates a new instance
+        sg.eval_algo = "BrutEvaluation"
+        assert sg.get_eval_algo() is not algo
+
+    def test_prototype(self):
+        """ Test the instantiation from a prototype """
+        sg = CompositeNode(inputs=[dict(name='a')], outputs=[dict(name='b')])
+        prev = sg.id_in
+        for i in range(30):
+            vid = sg.add_node(self.pkg['plus'].instantiate())
+            sg.connect(prev, 0, vid, 0)
+            sg.connect(prev, 0, vid, 1)
+            prev = vid
+        sg.connect(prev, 0, sg.id_out, 0)
+
+        sgfactory = CompositeNodeFactory("chain")
+        sg.to_factory(sgfactory)
+
+        sgfactory.use_prototype = False
+        sg1 = sgfactory.instantiate()
+        sgfactory.use_prototype = True
+        sgfactory.instantiate()
+        sg2 = sgfactory.instantiate()
+        assert sgfactory._prototype is not None
+
+        # same composite node
+        assert set(sg1.vertices()) == set(sg2.vertices())
+        assert (set((sg1.source(eid), sg1.target(eid)) for eid in sg1.edges()) ==
+                set((sg2.source(eid), sg2.target(eid)) for eid in sg2.edges()))
+        for vid in sg1.vertices():
+            assert sg1.node(vid).inputs == sg2.node(vid).inputs
+        assert sg2.node(vid).internal_data is not sg1.node(vid).internal_data
+        for sg in (sg1, sg2):
+            sg.set_input(0, 1.)
+            sg()
+        assert sg1.get_output(0) == sg2.get_output(0) == 2. ** 30
+
+        # a modification of the factory builds a new prototype
+        proto = sgfactory.get_prototype()
+        sg2.to_factory(sgfactory)
+        assert sgfactory.get_prototype() is not proto
+
+        # even if its size does not change
+        proto = sgfactory.get_prototype()
+        assert sgfactory.get_prototype() is proto
+        vid = sorted(sgfactory.elt_factory)[0]
+        sgfactory.elt_value[vid] = [(1, '5.')]
+        assert sgfactory.get_prototype() is not proto
+        assert sgfactory.instantiate().node(vid).get_input(1) == 5.
+
+        proto = sgfactory.get_prototype()
+        sgfactory.elt_data[vid]['caption'] = 'first'
+        sgfactory.invalidate_prototype()
+        assert sgfactory.get_prototype() is not proto
+
+        # and so does a modification of the packages of its nodes
+        proto = sgfactory.get_prototype()
+        self.pkg.add_factory(CompositeNodeFactory('chain2'))
+        assert not proto.is_valid()
+        assert sgfactory.get_prototype() is not proto
@@ -56,3 +56,42 @@ def test_dataflow():
     except PortError:
         test=True
     assert test
+
+
+def test_port_index():
+    """ test port lookups after topological modifications"""
+    df = DataFlow()
+    vid1 = df.add_vertex()
+    pid11 = df.add_out_port(vid1, 0)
+    vid2 = df.add_vertex()
+    pid21 = df.add_in_port(vid2, 0)
+    pid22 = df.add_in_port(vid2, 1)
+
+    eid1 = df.connect(pid11, pid21)
+    eid2 = df.connect(pid11, pid22)
+    assert df.out_port(vid1, 0) == pid11
+    assert df.in_port(vid2, 1) == pid22
+    assert df.nb_connections(pid11) == 2
+    assert df.nb_connections(pid21) == 1
+    assert set(df.connected_edges(pid11)) == set((eid1, eid2))
+
+    df.remove_edge(eid1)
+    assert df.nb_connections(pid11) == 1
+    assert df.nb_connections(pid21) == 0
+    assert set(df.connected_ports(pid11)) == set((pid22, ))
+
+    df.remove_port(pid22)
+    assert df.nb_connections(pid11) == 0
+    try:
+        df.in_port(vid2, 1)
+        assert False
+    except PortError:
+        pass
+
+    df.remove_vertex(vid1)
+    try:
+        df.out_port(vid1, 0)
+        assert False
+    except PortError:
+        pass
+    assert df.in_port(vid2, 0) == pid21
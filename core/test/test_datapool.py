@@ -0,0 +1,182 @@
+# -*- python -*-
+#
+#       OpenAlea.Core
+#
+#       Copyright 2006-2009 INRIA - CIRAD - INRA
+#
+#       Distributed under the Cecill-C License.
+#       See accompanying file LICENSE.txt or copy at
+#           http://www.cecill.info/licences/Licence_CeCILL-C_V1-en.html
+#
+#       OpenAlea WebSite : http://openalea.gforge.inria.fr
+#
+"""Test the datapool"""
+
+__license__ = "Cecill-C"
+__revision__ = " $Id$ "
+
+import os
+import shutil
+
+from openalea.core.datapool import DataPool, estimate_size
+from openalea.core.observer import AbstractListener
+
+
+class Listener(AbstractListener):
+
+    def __init__(self):
+        AbstractListener.__init__(self)
+        self.events = []
+
+    def notify(self, sender, event):
+        self.events.append(event)
+
+
+def test_estimate_size():
+    small = estimate_size([1.] * 10)
+    big = estimate_size([1.] * 100000)
+    assert small < big
+    assert big >= 100000 * 8
+    assert estimate_size({'a': 'x' * 1000}) > 1000
+
+
+def test_budget():
+    pool = DataPool()
+    pool.clear()
+    listener = Listener()
+    pool.register_listener(listener)
+    directory = os.path.abspath('datapool_spill')
+
+    try:
+        pool.set_budget(70000, directory)
+        pool['a'] = range(1000)
+        pool['b'] = range(1000)
+        pool['c'] = range(1000)
+        assert len(listener.events) == 3
+
+        # least recently used values are on disk
+        assert pool.spilled_path('a') is not None
+        assert pool.spilled_path('c') is None
+        assert pool.nbytes <= 70000
+        usage = dict((key, state) for key, size, state in pool.memory_usage())
+        assert usage['a'] == 'disk' and usage['c'] == 'memory'
+
+        # loaded back on access, without notification
+        assert pool['a'] == range(1000)
+        assert pool.spilled_path('a') is None
+        assert pool.spilled_path('b') is not None
+        assert len(listener.events) == 3
+
+        # accumulation in place (AccuList)
+        for i in xrange(10):
+            l = pool['b']
+            l.append(i)
+            pool['a']
+        assert pool['b'][-10:] == range(10)
+
+        del pool['b']
+        spilled = [k for k in pool.keys() if pool.spilled_path(k)]
+        assert len(os.listdir(directory)) == len(spilled) == 1
+        assert sorted(pool.keys()) == ['a', 'c']
+        assert pool.items() == [(k, range(1000)) for k in pool.keys()]
+
+        pool.clear()
+        assert os.listdir(directory) == []
+        assert pool.nbytes == 0
+    finally:
+        pool.unregister_listener(listener)
+        pool.set_budget(None)
+        pool.clear()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def test_references():
+    from openalea.core import datapool
+    from openalea.core.system.systemnodes import AccuList
+
+    pool = DataPool()
+    pool.clear()
+    directory = os.path.abspath('datapool_spill')
+    measured = []
+
+    def estimate_size(value):
+        measured.append(len(value))
+        return 1000
+    size = datapool.estimate_size
+    datapool.estimate_size = estimate_size
+
+    try:
+        pool.set_budget(2500, directory)
+        accu = AccuList([dict(name='value'), dict(name='name')],
+                        [dict(name='list')])
+        accu.set_input(1, 'accu')
+        accu.set_input(0, 1)
+        accu.eval()
+
+        # the list of the accumulator is referenced by its output,
+        # the next least recently used value is spilled
+        pool['b'] = range(10)
+        pool['c'] = range(20)
+        assert pool.spilled_path('accu') is None
+        assert pool.spilled_path('b') is not None
+
+        accu.set_input(0, 2)
+        accu.eval()
+        assert pool['accu'] == [1, 2]
+        assert accu.get_output(0) is pool['accu']
+
+        # the size is measured when the value is set or loaded
+        del measured[:]
+        for i in xrange(10):
+            pool['c']
+        assert measured == []
+        pool['b']
+        assert measured == [10]
+    finally:
+        datapool.estimate_size = size
+        pool.set_budget(None)
+        pool.clear()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def test_views():
+    pool = DataPool()
+    pool.clear()
+    try:
+        pool.set_lazy('a', lambda: [1])
+        pool['b'] = 2
+        assert sorted(pool.viewvalues()) == [2, [1]]
+        pool.set_lazy('a', lambda: [1])
+        assert pool.copy() == dict(a=[1], b=2)
+        pool.set_lazy('a', lambda: [1])
+        assert pool == dict(a=[1], b=2)
+        assert pool != dict(a=[2], b=2)
+    finally:
+        pool.clear()
+
+
+def test_accumulator_budget():
+    from openalea.core.system.systemnodes import AccuList
+
+    pool = DataPool()
+    pool.clear()
+    directory = os.path.abspath('datapool_spill')
+    try:
+        pool.set_budget(10000, directory)
+        accu = AccuList([dict(name='value'), dict(name='name')],
+                        [dict(name='list')])
+        accu.set_input(1, 'accu')
+        for i in xrange(200):
+            accu.set_input(0, 'x' * 100 + str(i))
+            accu.eval()
+            pool['other'] = range(10)
+
+        # the list grown in place is measured again and spilled
+        assert pool.nbytes <= 10000
+        assert pool.spilled_path('accu') is not None
+        assert pool['accu'] == ['x' * 100 + str(i) for i in xrange(200)]
+        assert accu.get_output(0) == pool['accu']
+    finally:
+        pool.set_budget(None)
+        pool.clear()
+        shutil.rmtree(directory, ignore_errors=True)
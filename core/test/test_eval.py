@@ -78,3 +78,905 @@ def test_diamond_after_map():
 
 
 #see test_compositenode.py
+
+
+def get_package_manager():
+    from openalea.core import pkgmanager
+    from os.path import join
+    from os import getcwd
+
+    pm = pkgmanager.PackageManager()
+    pm.add_wralea_path(join(getcwd(), "pkg"), pm.user_wralea_path)
+    pm.init()
+    return pm
+
+
+def test_topological_deep_chain():
+    """ Tests that a dataflow deeper than the recursion limit is evaluated. """
+    import sys
+    from openalea.core import compositenode
+
+    pm = get_package_manager()
+    floatFac = pm["pkg_test"]["float"]
+
+    df = compositenode.CompositeNode()
+    df.eval_algo = "TopologicalEvaluation"
+
+    vids = [df.add_node(floatFac.instantiate())]
+    for i in xrange(sys.getrecursionlimit() + 100):
+        vids.append(df.add_node(floatFac.instantiate()))
+        df.connect(vids[-2], 0, vids[-1], 0)
+
+    df.node(vids[0]).set_input(0, 3.)
+    df.eval_as_expression(vids[-1])
+    assert df.node(vids[-1]).get_output(0) == 3.
+
+    # the topology changes: the cached schedule must be updated
+    plusFac = pm["pkg_test"]["+"]
+    addId = df.add_node(plusFac.instantiate())
+    df.connect(vids[-1], 0, addId, 0)
+    df.connect(vids[0], 0, addId, 1)
+    df.eval_as_expression(addId)
+    assert df.node(addId).get_output(0) == 6.
+
+
+def test_topological_lambda():
+    """ Tests that lambda evaluation gives the same result with both
+    the recursive and the iterative algorithms. """
+    from openalea.core import compositenode
+
+    pm = get_package_manager()
+
+    results = []
+    for algo in ("LambdaEvaluation", "TopologicalEvaluation"):
+        df = compositenode.CompositeNode()
+        df.eval_algo = algo
+
+        rId = df.add_node(pm["pkg_test"]["range"].instantiate())
+        mId = df.add_node(pm["pkg_test"]["map"].instantiate())
+        aId = df.add_node(pm["pkg_test"]["+"].instantiate())
+        xId = df.add_node(pm["openalea.flow control"]["X"].instantiate())
+
+        df.node(rId).set_input(1, 10)
+        df.connect(rId, 0, mId, 1)
+        df.connect(xId, 0, aId, 0)
+        df.connect(xId, 0, aId, 1)
+        df.connect(aId, 0, mId, 0)
+
+        df.eval_as_expression(mId)
+        results.append(df.node(mId).get_output(0))
+
+    assert results[0] == [2 * i for i in range(10)]
+    assert results[0] == results[1]
+
+
+def get_fan_out(pm, algo, nb=10):
+    """ Build a dataflow x -> (x + i) for i in range(nb) -> sum """
+    from openalea.core import compositenode
+
+    plusFac = pm["pkg_test"]["+"]
+
+    df = compositenode.CompositeNode()
+    df.eval_algo = algo
+
+    srcId = df.add_node(plusFac.instantiate())
+    df.node(srcId).set_input(0, 1)
+
+    sumId = None
+    for i in range(nb):
+        vid = df.add_node(plusFac.instantiate())
+        df.connect(srcId, 0, vid, 0)
+        df.node(vid).set_input(1, i)
+        if sumId is None:
+            sumId = vid
+        else:
+            addId = df.add_node(plusFac.instantiate())
+            df.connect(sumId, 0, addId, 0)
+            df.connect(vid, 0, addId, 1)
+            sumId = addId
+
+    return df, srcId, sumId
+
+
+def test_parallel_fan_out():
+    """ Tests the parallel evaluation of independent branches. """
+    from openalea.core.algo.dataflow_evaluation import ParallelEvaluation
+
+    pm = get_package_manager()
+
+    df, srcId, sumId = get_fan_out(pm, "ParallelEvaluation")
+    df.eval_as_expression(sumId)
+    assert df.node(sumId).get_output(0) == sum(1 + i for i in range(10))
+
+    df.node(srcId).set_input(0, 2)
+    df.eval_as_expression(None)
+    assert df.node(sumId).get_output(0) == sum(2 + i for i in range(10))
+
+    # the nodes evaluated by the threads are profiled
+    profiler = df.set_profiler()
+    df.node(srcId).set_input(0, 3)
+    df.eval_as_expression(sumId)
+    assert profiler.stats
+    assert all(len(path) == 1 for path in profiler.tree)
+    df.set_profiler(None)
+
+    df, srcId, sumId = get_fan_out(pm, "ParallelEvaluation")
+    algo = ParallelEvaluation(df, num_workers=2, processes=True)
+    algo.eval(sumId)
+    assert df.node(sumId).get_output(0) == sum(1 + i for i in range(10))
+
+
+def test_parallel_exception():
+    """ Tests that a failing node is reported by the parallel evaluation. """
+    from openalea.core.algo.dataflow_evaluation import EvaluationException
+
+    pm = get_package_manager()
+
+    df, srcId, sumId = get_fan_out(pm, "ParallelEvaluation")
+    df.node(srcId).set_input(0, 'a')
+    try:
+        df.eval_as_expression(sumId)
+    except EvaluationException, e:
+        assert e.vid == srcId
+        assert isinstance(e.exception, TypeError)
+    else:
+        assert False
+
+
+def return_function(x):
+    return lambda: x
+
+
+def exit_worker(x):
+    import os
+    os._exit(1)
+
+
+def test_parallel_lost_tasks():
+    """ Tests that the tasks lost by a pool of processes are reported. """
+    import multiprocessing
+    from openalea.core import compositenode
+    from openalea.core.node import FuncNode
+    from openalea.core.algo.dataflow_evaluation import (ParallelEvaluation,
+                                                        EvaluationException)
+
+    pool = multiprocessing.Pool(2)
+    try:
+        for func in (return_function, exit_worker):
+            df = compositenode.CompositeNode()
+            vid = df.add_node(FuncNode([dict(name='x', value=1)],
+                                       [dict(name='y')], func))
+            algo = ParallelEvaluation(df, pool=pool, processes=True)
+            try:
+                algo.eval(vid)
+            except EvaluationException, e:
+                assert e.vid == vid
+            else:
+                assert False
+    finally:
+        pool.terminate()
+
+
+def test_parallel_cycle():
+    """ Tests that the vertices of a cycle are reported. """
+    from openalea.core.algo.dataflow_evaluation import (ParallelEvaluation,
+                                                        EvaluationException)
+
+    pm = get_package_manager()
+    df, srcId, sumId = get_fan_out(pm, "ParallelEvaluation", nb=2)
+    df.connect(sumId, 0, srcId, 1)
+    try:
+        ParallelEvaluation(df).eval(sumId)
+    except EvaluationException, e:
+        assert isinstance(e.exception, RuntimeError)
+    else:
+        assert False
+
+
+def test_parallel_notifications():
+    """ Tests that the notifications of the nodes evaluated by threads are
+    delivered in the calling thread. """
+    import thread
+    from openalea.core.observer import AbstractListener
+
+    class ThreadRecorder(AbstractListener):
+        def __init__(self):
+            AbstractListener.__init__(self)
+            self.events = []
+
+        def notify(self, sender, event=None):
+            self.events.append((event[0], thread.get_ident()))
+
+    pm = get_package_manager()
+    df, srcId, sumId = get_fan_out(pm, "ParallelEvaluation")
+    listener = ThreadRecorder()
+    listener.initialise(df.node(srcId))
+    df.eval_as_expression(sumId)
+
+    names = [name for name, ident in listener.events]
+    assert "start_eval" in names and "stop_eval" in names
+    assert set(ident for name, ident in listener.events) == \
+        set([thread.get_ident()])
+
+
+class Later(object):
+    """ Future of func(*args) evaluated by a thread """
+
+    def __init__(self, func, *args):
+        import threading
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._done = False
+        threading.Thread(target=self._run, args=(func, args)).start()
+
+    def _run(self, func, args):
+        self._value = self._error = None
+        try:
+            self._value = func(*args)
+        except Exception, e:
+            self._error = e
+        with self._lock:
+            self._done = True
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def result(self):
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+    def add_done_callback(self, callback):
+        with self._lock:
+            if not self._done:
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+
+class Concurrency(object):
+    """ Records how many calls run at the same time. Each call waits until
+    `expected` calls are running, so that they really overlap. """
+
+    def __init__(self, expected):
+        import threading
+        self.expected = expected
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+        self.all_started = threading.Event()
+
+    def __call__(self, func, *args):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            if self.active >= self.expected:
+                self.all_started.set()
+        self.all_started.wait(10)
+        try:
+            return func(*args)
+        finally:
+            with self.lock:
+                self.active -= 1
+
+
+def test_async():
+    """ Tests that the asynchronous nodes and the futures are evaluated
+    concurrently. """
+    from openalea.core import compositenode
+    from openalea.core.node import FuncNode, asynchronous
+    from openalea.core.algo.dataflow_evaluation import (AsyncEvaluation,
+                                                        EvaluationException)
+
+    recorder = [Concurrency(4)]
+
+    def plus_one(x):
+        return x + 1
+
+    @asynchronous
+    def wait(x):
+        return recorder[0](plus_one, x)
+
+    def wait_later(x):
+        return Later(plus_one, 10 * x)
+
+    def identity(x):
+        return x
+
+    def add(*args):
+        return sum(args)
+
+    df = compositenode.CompositeNode()
+    df.eval_algo = "AsyncEvaluation"
+    out = [dict(name='y')]
+
+    srcId = df.add_node(FuncNode([dict(name='x', value=1)], out, identity))
+    ins = [dict(name='x%d' % i, value=0) for i in range(5)]
+    sumId = df.add_node(FuncNode(ins, out, add))
+    for i in range(5):
+        func = wait if i < 4 else wait_later
+        vid = df.add_node(FuncNode([dict(name='x')], out, func))
+        df.connect(srcId, 0, vid, 0)
+        df.connect(vid, 0, sumId, i)
+
+    # the four asynchronous nodes run at the same time
+    df.eval_as_expression(sumId)
+    assert df.node(sumId).get_output(0) == 4 * 2 + 11
+    assert recorder[0].max_active == 4
+
+    # ... unless the concurrency is limited
+    recorder[0] = Concurrency(1)
+    df.node(srcId).set_input(0, 2)
+    AsyncEvaluation(df, max_concurrency=1).eval(sumId)
+    assert df.node(sumId).get_output(0) == 4 * 3 + 21
+    assert recorder[0].max_active == 1
+
+    # the asynchronous nodes and the future fail
+    recorder[0] = Concurrency(4)
+    df.node(srcId).set_input(0, 'a')
+    try:
+        df.eval_as_expression(sumId)
+    except EvaluationException, e:
+        assert e.vid not in (srcId, sumId)
+        assert isinstance(e.exception, TypeError)
+    else:
+        assert False
+
+
+def test_async_notifications():
+    """ Tests that the notifications of the asynchronous nodes are
+    delivered in the thread calling eval. """
+    import thread
+    from openalea.core import compositenode
+    from openalea.core.node import FuncNode, asynchronous
+    from openalea.core.observer import AbstractListener
+    from openalea.core.algo.dataflow_evaluation import AsyncEvaluation
+
+    @asynchronous
+    def double(x):
+        return 2 * x
+
+    df = compositenode.CompositeNode()
+    out = [dict(name='y')]
+    srcId = df.add_node(FuncNode([dict(name='x', value=1)], out, double))
+    vid = df.add_node(FuncNode([dict(name='x')], out, double))
+    df.connect(srcId, 0, vid, 0)
+
+    class ThreadRecorder(AbstractListener):
+        def __init__(self):
+            AbstractListener.__init__(self)
+            self.threads = set()
+
+        def notify(self, sender, event=None):
+            self.threads.add(thread.get_ident())
+
+    listener = ThreadRecorder()
+    for v in (srcId, vid):
+        listener.initialise(df.node(v))
+
+    AsyncEvaluation(df).eval(vid)
+    assert df.node(vid).get_output(0) == 4
+    assert listener.threads == set([thread.get_ident()])
+
+
+def test_incremental():
+    """ Tests that only the nodes downstream of a modified node are
+    evaluated. """
+    from openalea.core import compositenode
+    from openalea.core.observer import observed_batch
+
+    pm = get_package_manager()
+    floatFac = pm["pkg_test"]["float"]
+
+    df = compositenode.CompositeNode()
+    df.eval_algo = "IncrementalEvaluation"
+
+    a, b, c, d, e = [df.add_node(floatFac.instantiate()) for i in range(5)]
+    df.connect(a, 0, b, 0)
+    df.connect(b, 0, c, 0)
+    df.connect(d, 0, e, 0)
+    df.node(a).set_input(0, 1.)
+    df.node(d).set_input(0, 2.)
+
+    algo = df.get_eval_algo()
+    df.eval_as_expression()
+    assert algo._evaluated >= set([a, b, c, d, e])
+    assert df.node(c).get_output(0) == 1.
+    assert df.node(e).get_output(0) == 2.
+
+    df.node(a).set_input(0, 3.)
+    df.eval_as_expression()
+    assert algo._evaluated == set([a, b, c])
+    assert df.node(c).get_output(0) == 3.
+
+    df.eval_as_expression()
+    assert not algo._evaluated
+
+    df.node(d).set_input(0, 4.)
+    df.eval_as_expression(c)
+    assert algo._evaluated == set([c])
+    df.eval_as_expression()
+    assert algo._evaluated == set([d, e])
+    assert df.node(e).get_output(0) == 4.
+
+    # modifications without notification
+    df.node(a).set_input(0, 5., notify=False)
+    df.eval_as_expression()
+    assert algo._evaluated == set([a, b, c])
+    assert df.node(c).get_output(0) == 5.
+
+    with observed_batch():
+        df.node(d).set_input(0, 6.)
+        df.eval_as_expression()
+    assert algo._evaluated == set([d, e])
+    assert df.node(e).get_output(0) == 6.
+
+
+def test_profiler():
+    """ Tests the profiling of an evaluation with a nested composite
+    node. """
+    import json
+    import os
+    import pstats
+    import tempfile
+    from openalea.core import compositenode
+    from openalea.core.algo.profiling import dataflow_name
+
+    pm = get_package_manager()
+    floatFac = pm["pkg_test"]["float"]
+
+    inner = compositenode.CompositeNode(inputs=[dict(name='a')],
+                                        outputs=[dict(name='b')])
+    fid = inner.add_node(floatFac.instantiate())
+    inner.connect(inner.id_in, 0, fid, 0)
+    inner.connect(fid, 0, inner.id_out, 0)
+
+    df = compositenode.CompositeNode()
+    a = df.add_node(floatFac.instantiate())
+    cid = df.add_node(inner)
+    df.connect(a, 0, cid, 0)
+    df.node(a).set_input(0, 2.)
+
+    profiler = df.set_profiler()
+    df.eval_as_expression()
+    assert inner.get_output(0) == 2.
+
+    names = set(name for (dfname, vid, name) in profiler.stats)
+    assert 'float' in names
+    assert profiler.stats[(dataflow_name(df), a, 'float')].calls == 1
+    paths = [path for path in profiler.tree if path[-1][2] == 'float']
+    assert max(len(path) for path in paths) == 2
+    assert profiler.total_time() >= 0
+    assert profiler.report()
+
+    fd, filename = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        profiler.dump_stats(filename)
+        stats = pstats.Stats(filename)
+        assert stats.total_calls == sum(s.calls for s in
+                                        profiler.stats.itervalues())
+    finally:
+        os.remove(filename)
+
+    data = json.loads(profiler.to_json())
+    assert len(data['nodes']) == len(profiler.stats)
+    data = json.loads(profiler.to_speedscope())
+    assert len(data['profiles'][0]['samples']) == len(profiler.tree)
+
+    # disabled
+    df.set_profiler(None)
+    df.node(a).set_input(0, 3.)
+    df.eval_as_expression()
+    assert profiler.stats[(dataflow_name(df), a, 'float')].calls == 1
+
+    # nodes evaluated in worker threads are not nested in each other
+    import threading
+    import time
+    from openalea.core.node import FuncNode
+
+    def wait(x):
+        time.sleep(0.01)
+        return x
+
+    profiler.clear()
+    nodes = [FuncNode([dict(name='x', value=i)], [dict(name='y')], wait)
+             for i in range(4)]
+    threads = [threading.Thread(target=profiler.eval_node,
+                                args=(df, vid, node))
+               for vid, node in enumerate(nodes)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(profiler.tree) == 4
+    assert all(len(path) == 1 for path in profiler.tree)
+    assert sum(s.calls for s in profiler.stats.itervalues()) == 4
+
+
+def test_batch():
+    """ Tests that BatchEvaluation evaluates the nodes not depending on
+    the iteration once and gives the same results as GeneratorEvaluation.
+    """
+    from openalea.core import compositenode
+    from openalea.core.node import Node
+    from openalea.core.system.systemnodes import IterNode
+    from openalea.core.algo.dataflow_evaluation import BatchEvaluation
+
+    class Collect(Node):
+        def __init__(self, values):
+            Node.__init__(self, [dict(name='x')], [])
+            self.values = values
+
+        def __call__(self, inputs):
+            self.values.append(inputs[0])
+            return ()
+
+    class Double(Node):
+        def __init__(self):
+            Node.__init__(self, [dict(name='x')], [dict(name='y')])
+            self.calls = 0
+
+        def __call__(self, inputs):
+            self.calls += 1
+            x = inputs[0]
+            if isinstance(x, (int, float)):
+                return 2 * x,
+            return [2 * v for v in x],
+
+    pm = get_package_manager()
+    floatFac = pm["pkg_test"]["float"]
+    addFac = pm["pkg_test"]["+"]
+
+    def build(eval_algo, values, vectorized=False):
+        df = compositenode.CompositeNode()
+        df.eval_algo = eval_algo
+        it = df.add_node(IterNode([dict(name='generator')],
+                                  [dict(name='value')]))
+        c = df.add_node(floatFac.instantiate())
+        p = df.add_node(Double())
+        q = df.add_node(addFac.instantiate())
+        leaf = df.add_node(Collect(values))
+        df.connect(it, 0, p, 0)
+        df.connect(p, 0, q, 0)
+        df.connect(c, 0, q, 1)
+        df.connect(q, 0, leaf, 0)
+        df.node(it).set_input(0, range(2500))
+        df.node(c).set_input(0, 10.)
+        df.node(p).vectorized = vectorized
+
+        calls = []
+        node = df.node(c)
+        node_eval = node.eval
+        node.eval = lambda: calls.append(1) or node_eval()
+        return df, calls, (it, c, p, leaf)
+
+    expected = []
+    df, calls, vids = build("GeneratorEvaluation", expected)
+    df.eval_as_expression()
+    assert len(expected) == 2500 and len(calls) == 2500
+    assert expected[-1] == 2 * 2499 + 10.
+
+    for vectorized in (False, True):
+        values = []
+        df, calls, (it, c, p, leaf) = build("BatchEvaluation", values,
+                                            vectorized)
+        df.get_eval_algo().batch_size = 1000
+        df.eval_as_expression()
+        assert values == expected
+        assert len(calls) == 1
+        assert df.node(p).calls == (3 if vectorized else 2500)
+        assert df.node(it).get_output(0) == 2499
+
+    # the inputs of the nodes evaluated per element are notified once per
+    # chunk
+    from openalea.core.observer import AbstractListener
+
+    class Recorder(AbstractListener):
+        def __init__(self):
+            AbstractListener.__init__(self)
+            self.events = []
+
+        def notify(self, sender, event=None):
+            self.events.append(event[0])
+
+    values = []
+    df, calls, (it, c, p, leaf) = build("BatchEvaluation", values)
+    df.get_eval_algo().batch_size = 1000
+    recorder = Recorder()
+    recorder.initialise(df.node(p))
+    df.eval_as_expression()
+    assert len(values) == 2500
+    assert recorder.events.count('input_modified') == 3
+    assert recorder.events.count('stop_eval') == 3
+
+    # no element: the cone is not evaluated
+    values = []
+    df, calls, (it, c, p, leaf) = build("BatchEvaluation", values)
+    df.node(it).set_input(0, [])
+    df.eval_as_expression()
+    assert values == [] and len(calls) == 1
+
+    # a cone longer than the recursion limit
+    import sys
+    df = compositenode.CompositeNode()
+    it = df.add_node(IterNode([dict(name='generator')],
+                              [dict(name='value')]))
+    prev = it
+    for i in range(sys.getrecursionlimit() + 10):
+        vid = df.add_node(Double())
+        df.connect(prev, 0, vid, 0)
+        prev = vid
+    order = BatchEvaluation(df).plan(it, prev)
+    assert len(order) == sys.getrecursionlimit() + 10
+    assert order[-1] == prev
+
+    # several generators: same evaluation as GeneratorEvaluation
+    values = []
+    df, calls, (it, c, p, leaf) = build("BatchEvaluation", values)
+    df.node(c).delay = 1
+    assert df.get_eval_algo().find_iterator(leaf) is None
+
+
+def test_discrete_time():
+    """ Tests that DiscreteTimeEvaluation evaluates the delayed nodes at
+    their cycle and only the nodes depending on them. """
+    from openalea.core import compositenode
+    from openalea.core.node import Node
+
+    class Ticker(Node):
+        def __init__(self, period, nb):
+            Node.__init__(self, [], [dict(name='t')])
+            self.period = period
+            self.nb = nb
+            self.cycles = []
+
+        def eval(self):
+            self.cycles.append(self.evaluator._current_cycle)
+            self.outputs[0] = len(self.cycles)
+            if len(self.cycles) < self.nb:
+                return self.period
+            return 0
+
+    class Collect(Node):
+        def __init__(self):
+            Node.__init__(self, [dict(name='x'), dict(name='y')],
+                          [dict(name='z')])
+            self.values = []
+            self.lazy = False
+
+        def __call__(self, inputs):
+            self.values.append(tuple(inputs))
+            return inputs[0]
+
+    def build(*tickers):
+        df = compositenode.CompositeNode()
+        df.eval_algo = "DiscreteTimeEvaluation"
+        leaf = df.add_node(Collect())
+        for i, ticker in enumerate(tickers):
+            df.connect(df.add_node(ticker), 0, leaf, i)
+        algo = df.get_eval_algo()
+        for ticker in tickers:
+            ticker.evaluator = algo
+        return df, algo, df.node(leaf)
+
+    fast, slow = Ticker(2, 100), Ticker(5, 3)
+    df, algo, collect = build(fast, slow)
+    df.eval_as_expression()
+    # the simulation stops when slow returns no delay
+    assert slow.cycles == [0, 5, 10]
+    assert fast.cycles == range(0, 11, 2)
+    assert collect.values == [(1, 1), (2, 1), (3, 1), (3, 2), (4, 2),
+                              (5, 2), (6, 3)]
+
+    # sparse activity over many cycles
+    ticker = Ticker(1000, 10 ** 6)
+    df, algo, collect = build(ticker)
+    algo.horizon = 10 ** 5
+    df.eval_as_expression()
+    assert len(ticker.cycles) == 101
+    assert len(collect.values) == 101
+    assert ticker.cycles[-1] == 10 ** 5
+
+    # step by step
+    ticker = Ticker(10, 3)
+    df, algo, collect = build(ticker)
+    for i in range(3):
+        df.eval_as_expression(step=True)
+    assert ticker.cycles == [0, 10, 20]
+    assert algo._current_cycle == 0
+
+
+def test_provenance():
+    """ Tests the recording of the executions of a nested composite node
+    in a provenance store. """
+    import os
+    import tempfile
+    import shutil
+    from openalea.core import compositenode, provenance
+    from openalea.core.node import FuncNode
+    from openalea.core.memoize import fingerprint
+
+    pm = get_package_manager()
+    floatFac = pm["pkg_test"]["float"]
+
+    inner = compositenode.CompositeNode(inputs=[dict(name='a')],
+                                        outputs=[dict(name='b')])
+    fid = inner.add_node(floatFac.instantiate())
+    inner.connect(inner.id_in, 0, fid, 0)
+    inner.connect(fid, 0, inner.id_out, 0)
+
+    df = compositenode.CompositeNode()
+    a = df.add_node(floatFac.instantiate())
+    cid = df.add_node(inner)
+    df.connect(a, 0, cid, 0)
+    df.node(a).set_input(0, 2.)
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        store = provenance.ProvenanceStore(os.path.join(tmpdir, 'prov.sq3'))
+        with store:
+            df.eval_as_expression()
+            df.node(a).set_input(0, 3.)
+            df.eval_as_expression()
+        assert provenance.active is None
+        store.flush(wait=True)
+
+        runs = [run for run in store.runs() if run.parent is None]
+        assert len(runs) == 2
+        assert all(run.end >= run.start for run in runs)
+        children = store.children(runs[0].id)
+        assert len(children) == 1
+
+        execs = store.executions(runs[1].id, vid=a)
+        assert len(execs) == 1
+        e = execs[0]
+        assert e.factory == 'float' and e.package == 'pkg_test'
+        assert e.end >= e.start
+        assert e.inputs == fingerprint([3.])
+        assert e.outputs == fingerprint([3.])
+        assert store.executions(children[0].id, vid=fid)
+
+        # not recorded when disabled
+        df.eval_as_expression()
+        store.close()
+        assert len([run for run in store.runs() if run.parent is None]) == 2
+
+        # fingerprints of the values at the end of the execution
+        values = [1, 2]
+        lid = df.add_node(FuncNode([dict(name='x')], [dict(name='y')], list))
+        df.node(lid).set_input(0, values)
+        with store:
+            df.eval_as_expression(lid)
+            df.node(lid).get_output(0).append(3)
+        run = [run for run in store.runs() if run.parent is None][-1]
+        e = store.executions(run.id, vid=lid)[0]
+        assert e.outputs == fingerprint([[1, 2]])
+        store.close()
+
+        # runs started in another thread are not nested in the current run
+        import threading
+        with store:
+            main = store.start_run(df)
+            other = []
+            t = threading.Thread(target=lambda: other.append(
+                store.start_run(inner)))
+            t.start()
+            t.join()
+            assert main.parent is None and other[0].parent is None
+            nested = store.start_run(inner)
+            assert nested.parent is main
+            store.end_run(nested)
+            store.end_run(other[0])
+            store.end_run(main)
+        store.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_compile():
+    """ Tests that a compiled composite node computes the same outputs as
+    its evaluation. """
+    from openalea.core import compositenode
+    from openalea.core.node import Node
+    from openalea.core.algo.dataflow_evaluation import EvaluationException
+    from openalea.core.algo.dataflow_compiler import CompileError
+    from openalea.core.system.systemnodes import IterNode
+
+    class DivMod(Node):
+        def __init__(self):
+            Node.__init__(self, [dict(name='a'), dict(name='b')],
+                          [dict(name='div'), dict(name='mod')])
+
+        def __call__(self, inputs):
+            return divmod(*inputs)
+
+    class Sum(Node):
+        def __init__(self):
+            Node.__init__(self, [dict(name='values')], [dict(name='sum')])
+
+        def __call__(self, inputs):
+            return sum(inputs[0]),
+
+    pm = get_package_manager()
+    floatFac = pm["pkg_test"]["float"]
+    addFac = pm["pkg_test"]["+"]
+
+    inner = compositenode.CompositeNode(inputs=[dict(name='a')],
+                                        outputs=[dict(name='b')])
+    fid = inner.add_node(floatFac.instantiate())
+    inner.connect(inner.id_in, 0, fid, 0)
+    inner.connect(fid, 0, inner.id_out, 0)
+
+    cn = compositenode.CompositeNode(inputs=[dict(name='x'), dict(name='y')],
+                                     outputs=[dict(name='r'),
+                                              dict(name='s')])
+    add = cn.add_node(addFac.instantiate())
+    cid = cn.add_node(inner)
+    dm = cn.add_node(DivMod())
+    add5 = cn.add_node(addFac.instantiate())
+    total = cn.add_node(Sum())
+    cn.connect(cn.id_in, 0, add, 0)
+    cn.connect(cn.id_in, 1, add, 1)
+    cn.connect(add, 0, cid, 0)
+    cn.connect(cid, 0, dm, 0)
+    cn.connect(cn.id_in, 1, dm, 1)
+    cn.connect(dm, 1, add5, 0)
+    cn.node(add5).set_input(1, 5)
+    cn.connect(dm, 0, total, 0)
+    cn.connect(add5, 0, total, 0)
+    cn.connect(total, 0, cn.id_out, 0)
+    cn.connect(dm, 0, cn.id_out, 1)
+
+    cn.set_input(1, -4)
+    compiled = cn.compile()
+    for x, y in [(7, 2), (10., 3.), (-4, 7)]:
+        cn.set_input(0, x)
+        cn.set_input(1, y)
+        cn()
+        expected = (cn.get_output(0), cn.get_output(1))
+        assert compiled(x, y) == expected
+        assert compiled(y=y, x=x) == expected
+
+    # the nodes are not modified
+    cn.set_input(0, 1)
+    cn.set_input(1, 1)
+    cn()
+    compiled(100, 3)
+    assert cn.node(dm).get_output(0) == 2
+
+    # nor the nodes evaluated with Node.eval
+    cn.node(add5).memoize = True
+    memoized = cn.compile()
+    cn()
+    inputs = list(cn.node(add5).inputs)
+    outputs = list(cn.node(add5).outputs)
+    assert memoized(100, 3) == compiled(100, 3)
+    assert cn.node(add5).inputs == inputs
+    assert cn.node(add5).outputs == outputs
+    cn.node(add5).memoize = False
+
+    # missing inputs take their value at compilation time
+    assert compiled(x=8) == compiled(8, -4)
+
+    try:
+        compiled('a', 1)
+        assert False
+    except EvaluationException, e:
+        assert e.vid == add
+
+    # error of a node of the nested composite node
+    try:
+        compiled([1], [2])
+        assert False
+    except EvaluationException, e:
+        assert e.vid == cid
+
+    it = cn.add_node(IterNode([dict(name='generator')],
+                              [dict(name='value')]))
+    cn.connect(it, 0, total, 0)
+    try:
+        cn.compile()
+        assert False
+    except CompileError:
+        pass
@@ -0,0 +1,76 @@
+__license__ = "Cecill-C"
+__revision__ = " $Id$ "
+
+# Test id generator module
+from openalea.core.graph.id_generator import IdGenerator
+from openalea.core.graph.graph import Graph
+
+
+def test_id_generator():
+    """Test id generation and reuse"""
+    gen = IdGenerator()
+    assert [gen.get_id() for i in range(3)] == [0, 1, 2]
+
+    # the last released id is reused first
+    gen.release_id(0)
+    gen.release_id(1)
+    assert gen.get_id() == 1
+    assert gen.get_id() == 0
+    assert gen.get_id() == 3
+
+    # explicit ids leave free ids behind them
+    assert gen.get_id(7) == 7
+    assert gen.get_id(5) == 5
+    assert [gen.get_id() for i in range(3)] == [6, 4, 8]
+
+    for id in (2, 5):
+        try:
+            gen.get_id(id)
+            assert False
+        except IndexError:
+            pass
+
+    gen.release_id(5)
+    try:
+        gen.release_id(5)
+        assert False
+    except IndexError:
+        pass
+    assert gen.get_id(5) == 5
+    assert gen.get_id() == 9
+
+    # an id taken explicitly, then released again, is reused once
+    gen.release_id(2)
+    gen.release_id(3)
+    assert gen.get_id(2) == 2
+    gen.release_id(2)
+    assert [gen.get_id() for i in range(3)] == [2, 3, 10]
+
+
+class CountedId(int):
+    """Id counting its comparisons"""
+    comparisons = 0
+
+    def __eq__(self, other):
+        CountedId.comparisons += 1
+        return int(self) == other
+
+    __hash__ = int.__hash__
+
+
+def test_graph_scaling():
+    """Test that building and clearing a graph does a linear number of
+    comparisons of ids"""
+    for nb in (10 ** 3, 2 * 10 ** 3):
+        CountedId.comparisons = 0
+        g = Graph()
+        for vid in xrange(nb - 1, -1, -1):
+            g.add_vertex(CountedId(vid))
+        for vid in xrange(nb - 1):
+            g.add_edge((vid, vid + 1))
+        for vid in xrange(nb):
+            g.remove_vertex(CountedId(vid))
+        g.add_vertex()
+        # a scan of the free ids for each explicit or released vid would
+        # compare about nb ** 2 / 2 ids
+        assert CountedId.comparisons <= 20 * nb
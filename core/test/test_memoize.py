@@ -0,0 +1,200 @@
+__license__ = "Cecill-C"
+__revision__ = " $Id$ "
+
+# Test node outputs memoization
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from openalea.core.node import Node, NodeFactory
+from openalea.core.memoize import OutputCache, get_output_cache, \
+    set_output_cache, fingerprint, node_key
+
+
+class CountNode(Node):
+    """ Node counting its calls """
+    calls = 0
+
+    def __init__(self):
+        Node.__init__(self, inputs=[dict(name='a'), dict(name='b')],
+                      outputs=[dict(name='out')])
+
+    def __call__(self, inputs):
+        CountNode.calls += 1
+        return sum(inputs[0]) + inputs[1]
+
+
+def test_fingerprint():
+    """Test fingerprint of values"""
+    assert fingerprint([1, 'a', [2.]]) == fingerprint([1, 'a', [2.]])
+    assert fingerprint([1]) != fingerprint([1.])
+    assert fingerprint(['ab', 'c']) != fingerprint(['a', 'bc'])
+    assert fingerprint([u'\xe9']) != fingerprint(['\xc3\xa9'])
+
+    try:
+        import numpy
+    except ImportError:
+        return
+    a = numpy.arange(10)
+    assert fingerprint([a]) == fingerprint([a.copy()])
+    assert fingerprint([a]) != fingerprint([a.reshape(2, 5)])
+    assert fingerprint([a]) != fingerprint([a.astype(float)])
+
+
+def test_memoize_node():
+    """Test memoized node evaluation across node instances"""
+    old = get_output_cache()
+    set_output_cache(OutputCache())
+    try:
+        CountNode.calls = 0
+        n = CountNode()
+        n.memoize = True
+        n.set_input(0, [1, 2])
+        n.set_input(1, 3)
+        n.eval()
+        assert n.get_output(0) == 6
+        assert CountNode.calls == 1
+
+        n2 = CountNode()
+        n2.memoize = True
+        n2.set_input(0, [1, 2])
+        n2.set_input(1, 3)
+        n2.eval()
+        assert n2.get_output(0) == 6
+        assert CountNode.calls == 1
+
+        n2.set_input(1, 4)
+        n2.eval()
+        assert n2.get_output(0) == 7
+        assert CountNode.calls == 2
+
+        # not memoized
+        n3 = CountNode()
+        n3.set_input(0, [1, 2])
+        n3.set_input(1, 3)
+        n3.eval()
+        assert CountNode.calls == 3
+    finally:
+        set_output_cache(old)
+
+
+def test_cache_bounds():
+    """Test LRU eviction by count and by size"""
+    cache = OutputCache(max_items=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert 'b' not in cache
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+
+    cache = OutputCache(max_bytes=1000)
+    cache.set('a', 'x' * 400)
+    cache.set('b', 'x' * 400)
+    cache.set('c', 'x' * 400)
+    assert len(cache) == 2
+    assert 'a' not in cache
+    assert cache.nbytes <= 1000
+    cache.set('d', 'x' * 2000)
+    assert 'd' not in cache
+    assert len(cache) == 2
+
+
+def test_cache_disk():
+    """Test on-disk tier"""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        cache = OutputCache(max_items=1, directory=tmpdir)
+        cache.set('k:1', [1, 2])
+        cache.set('k:2', [3])
+        assert len(cache) == 1
+        assert cache.get('k:1') == [1, 2]
+
+        cache = OutputCache(directory=tmpdir)
+        assert cache.get('k:2') == [3]
+        cache.clear(disk=True)
+        assert cache.get('k:1') is None
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_node_key():
+    """Test the keys of nodes with non-ASCII names and modified modules"""
+    factory = NodeFactory(name=u'\xe9t\xe9', nodemodule='test_memoize',
+                          nodeclass='CountNode')
+    n = factory.instantiate()
+    n.set_input(0, [1])
+    n.set_input(1, 2)
+    key = node_key(n)
+    assert key is not None
+    assert node_key(factory.instantiate()) != key
+
+    tmpdir = tempfile.mkdtemp()
+    sys.path.insert(0, tmpdir)
+    try:
+        filename = os.path.join(tmpdir, 'zzmemo.py')
+        f = open(filename, 'w')
+        f.write('def double(x):\n    return 2 * x\n')
+        f.close()
+        factory = NodeFactory(name='double', nodemodule='zzmemo',
+                              nodeclass='double')
+        n = factory.instantiate()
+        n.set_input(0, 1)
+        key = node_key(n)
+
+        # the source of the node is modified
+        f = open(filename, 'a')
+        f.write('# modified\n')
+        f.close()
+        os.utime(filename, (time.time() + 10, time.time() + 10))
+        assert node_key(n) != key
+    finally:
+        sys.path.remove(tmpdir)
+        sys.modules.pop('zzmemo', None)
+        shutil.rmtree(tmpdir)
+
+
+def test_cache_memory():
+    """Test that the outputs are not pickled without disk tier"""
+    class Unpicklable(object):
+        def __reduce__(self):
+            raise AssertionError('pickled')
+
+    cache = OutputCache()
+    value = Unpicklable()
+    cache.set('a', value)
+    assert cache.get('a') is value
+    assert cache.nbytes > 0
+
+
+def test_cache_threads():
+    """Test the cache bookkeeping with several threads"""
+    import threading
+
+    cache = OutputCache(max_items=50)
+
+    def work(n):
+        for i in range(2000):
+            key = str((i * 7 + n) % 80)
+            if cache.get(key) is None:
+                cache.set(key, 'x' * (i % 10))
+
+    interval = sys.getcheckinterval()
+    sys.setcheckinterval(1)
+    try:
+        threads = [threading.Thread(target=work, args=(n,))
+                   for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        sys.setcheckinterval(interval)
+
+    assert len(cache) <= 50
+    assert cache.nbytes == sum(size for value, size in
+                               cache._entries.itervalues())
+    assert cache.hits + cache.misses == 8000
@@ -49,6 +49,27 @@ def test_steps():
     assert m.run(nstep=10) == 100
 
 
+def test_fast():
+    from openalea.core.model import compile_code
+
+    for fast in (False, True):
+        m = Model('fast', fast=fast)
+        m.inputs_info = [InputObj('a=0')]
+        m.outputs_info = [OutputObj('a')]
+        m.set_func_code('init', 'def inc(x):\n    return x + k\nk = 2')
+        m.step_code = 'a = inc(a)'
+        assert m.run(nstep=100) == 200
+        assert m.run(5, nstep=2) == 9
+
+        # modified code is compiled again
+        m.step_code = 'a = inc(a) * 10'
+        assert m.run(nstep=2) == 220
+
+    code = compile_code('a = 1', '<test>')
+    assert compile_code('a = 1', '<test>') is code
+    assert compile_code('%time a = 1') is None
+
+
 def test_global_and_control():
     m1 = Model('IOFullyDefined')
     m1.inputs_info = [InputObj('a=0'), InputObj('b=0')]
@@ -14,5 +14,37 @@ def test_dict():
     print d
 
 
+def test_version():
+    """Test that the modifications change the version"""
+    d = PackageDict()
+    versions = [d.version]
+
+    def modified():
+        assert d.version not in versions
+        versions.append(d.version)
+
+    d['a'] = 1
+    modified()
+    d.update(B=2, c=3)
+    modified()
+    assert d['b'] == 2
+    assert d.setdefault('D', 4) == 4
+    modified()
+    assert d.setdefault('d', 5) == 4
+    assert d.version == versions[-1]
+    assert d.pop('A') == 1
+    modified()
+    d.popitem()
+    modified()
+    d['E'] = 5
+    modified()
+    del d['e']
+    modified()
+    assert d.nb_public_values() == len(d)
+    d.clear()
+    modified()
+    assert d.nb_public_values() == 0
+
+
 if __name__=="__main__":
     test_dict()
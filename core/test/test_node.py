@@ -154,3 +154,54 @@ def test_node_output():
     n2.eval()
     assert n1.get_output('y') == 1
     assert n2.get_output('y') == [1, 2]
+
+
+def allocated(func, n):
+    """ Return the number of objects tracked by the garbage collector
+    for each one of the n results of func """
+    import gc
+    gc.collect()
+    before = len(gc.get_objects())
+    results = [func() for i in xrange(n)]
+    gc.collect()
+    return (len(gc.get_objects()) - before) / float(n)
+
+
+def test_compact():
+    f = Factory(name = "MyFactory2",
+                nodemodule = "test_node",
+                nodeclass = "MyFunc",
+                inputs = (dict(name="a", interface=None, value=[]),
+                          dict(name="b", interface=None, value=[2])),
+                outputs = (dict(name="c", interface=None), ), )
+
+    normal = allocated(f.instantiate, 1000)
+    set_compact()
+    try:
+        compact = allocated(f.instantiate, 1000)
+        n1 = f.instantiate()
+        n2 = f.instantiate()
+    finally:
+        set_compact(False)
+    assert compact < 0.6 * normal
+
+    assert n1.input_desc[0] is n2.input_desc[0]
+    # the default values are copied
+    assert n1.get_input('a') is not n2.get_input('a')
+    n1.set_input('b', [3, 4])
+    n1.eval()
+    assert n1.get_output(0) == [3, 4]
+    assert n2.get_input('b') == [2]
+
+    # the ports are copied before they are modified
+    n1.set_port_hidden('a', True)
+    assert n1.input_desc[0] is not n2.input_desc[0]
+    assert n1.input_desc[0].vertex() is n1
+    assert n1.is_port_hidden('a')
+    assert not n2.is_port_hidden('a')
+    assert n2.input_desc[0].vertex is None
+
+    n2.add_input(name='d', value=0)
+    assert n2.get_nb_input() == 3
+    assert n1.get_nb_input() == 2
+    assert f.instantiate().get_nb_input() == 2
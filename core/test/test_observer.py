@@ -86,3 +86,45 @@ def test_lock():
         assert True
     except NotifyException:
         assert False
+
+
+# Test notification batches
+
+
+class recorder(AbstractListener):
+
+    def __init__(self):
+        AbstractListener.__init__(self)
+        self.events = []
+
+    def notify(self, sender, event=None):
+        self.events.append(event)
+
+
+def test_batch():
+    l = recorder()
+    o = myobserved()
+    l.initialise(o)
+
+    try:
+        with observed_batch():
+            o.notify_listeners(("start_eval",))
+            with observed_batch():
+                o.notify_listeners(("input_modified", 0))
+                o.notify_listeners(("input_modified", 1))
+                o.notify_listeners(("data_modified", "caption", "a"))
+                o.notify_listeners(("input_modified", 0))
+            o.notify_listeners(("data_modified", "caption", "b"))
+            o.notify_listeners(("start_eval",))
+            assert l.events == []
+            raise NotifyException()
+    except NotifyException:
+        pass
+
+    # coalesced, delivered even if an exception is raised
+    assert l.events == [("start_eval",), ("input_modified", 0),
+                        ("input_modified", 1),
+                        ("data_modified", "caption", "b")]
+
+    o.notify_listeners(("stop_eval",))
+    assert l.events[-1] == ("stop_eval",)
@@ -56,6 +56,38 @@ def test_load_pm():
     assert valfactory != None
 
 
+def test_package_index():
+    pkgman = PackageManager()
+    pkgman.init()
+
+    pkg = pkgman["openalea.flow control"]
+    filename = os.path.abspath(pkg.wralea_path)
+    index = pkgman.get_cache()
+    assert filename in index
+
+    # register the package again without importing its wralea
+    stamp, data = index[filename]
+    assert stamp == pkgman.file_stamp(filename)
+    assert pkgman.load_packages(data)
+
+    newpkg = pkgman["openalea.flow control"]
+    assert newpkg is not pkg
+    assert set(newpkg.keys()) == set(pkg.keys())
+    assert newpkg.metainfo == pkg.metainfo
+
+    factory = newpkg.get_factory('command')
+    assert factory.package is newpkg
+    assert factory.instantiate()
+
+    # the index is replaced, without leaving a temporary file
+    pkgman.save_cache(index)
+    cachefile = pkgman.get_cache_filename()
+    assert pkgman.read_cache()[0] == index
+    directory = os.path.dirname(cachefile)
+    assert not [name for name in os.listdir(directory)
+                if name.startswith('.alea_pkg_index.')]
+
+
 def test_category():
     pkgman = PackageManager()
 
@@ -81,6 +113,43 @@ def test_search():
     assert "sum" in res[0].name
 
 
+    # the index follows the changes of the packages
+    from openalea.core.node import NodeFactory
+    pkg = pkgman['Test']
+    pkg.add_factory(NodeFactory(name='zzsummary', nodemodule='nodes',
+                                nodeclass='Sum', inputs=[{}, {}]))
+    res = pkgman.search_node("zzsum")
+    assert len(res) == 1 and res[0].name == 'zzsummary'
+    assert pkgman.search_node("zzsum", nb_inputs=2) == res
+    assert not pkgman.search_node("zzsum", nb_inputs=1)
+    del pkg['zzsummary']
+    assert not pkgman.search_node("zzsum")
+
+
+def test_search_index():
+    from openalea.core.pkgdict import is_protected
+    from openalea.core.searchindex import search_score
+
+    pkgman = PackageManager()
+    pkgman.init()
+
+    for search_str in ["", "a", "SU", "Sum", "flow control", "xyzw"]:
+        # brute force search
+        s = search_str.upper()
+        match = set()
+        for name, pkg in pkgman.iteritems():
+            if is_protected(name):
+                continue
+            for fname, factory in pkg.iteritems():
+                if (not is_protected(fname) and
+                    search_score(s, factory, pkg) > 0):
+                    match.add(factory)
+
+        res = pkgman.search_node(search_str)
+        assert len(res) == len(match)
+        assert set(res) == match
+
+
     # comment these 3 lines because system.command is not part
     # of any nodes anymore.
     # res = pkgman.search_node("system.command")
@@ -103,3 +172,142 @@ def test_search():
 #     paths = list(eval(path))  # path is a string
 #
 #     assert set(paths) == set(p)
+
+
+def test_dependencies():
+    from openalea.core.package import Package
+    from openalea.core.compositenode import CompositeNodeFactory
+
+    pkgman = PackageManager()
+    pkgman.init()
+
+    def composite(pkg, name, *elements):
+        factory = CompositeNodeFactory(
+            name=name, elt_factory=dict(enumerate(elements)))
+        pkg.add_factory(factory)
+        return factory
+
+    a = Package('zzdep.a', {})
+    b = Package('zzdep.b', {})
+    # shared is used twice by top, loop and loop2 form a cycle
+    shared = composite(b, 'shared', ('openalea.flow control', 'counter'),
+                       ('zzdep.missing', 'x'))
+    mid = composite(b, 'mid', ('zzdep.b', 'shared'), ('zzdep.b', 'shared'))
+    top = composite(a, 'top', ('zzdep.b', 'mid'), ('zzdep.b', 'shared'),
+                    ('zzdep.a', 'loop'))
+    composite(a, 'loop', ('zzdep.a', 'loop2'))
+    composite(a, 'loop2', ('zzdep.a', 'loop'), ('zzdep.b', 'nothere'))
+    pkgman.add_package(a)
+    pkgman.add_package(b)
+    try:
+        command = ('openalea.flow control', 'counter')
+        assert pkgman.dependencies(top) == sorted([
+            ('zzdep.b', 'mid'), ('zzdep.b', 'shared'), ('zzdep.a', 'loop'),
+            ('zzdep.a', 'loop2'), command])
+        assert pkgman.dependencies(mid) == [command, ('zzdep.b', 'shared')]
+        assert pkgman.dependencies(a) == sorted([
+            ('zzdep.b', 'mid'), ('zzdep.b', 'shared'), command])
+        assert pkgman.dependencies()['zzdep.b'] == [command]
+
+        assert pkgman.missing_dependencies(top) == [('zzdep.b', 'nothere'),
+                                                    ('zzdep.missing', 'x')]
+        assert pkgman.missing_dependencies(mid) == [('zzdep.missing', 'x')]
+        assert pkgman.missing_dependencies()['zzdep.b'] == [
+            ('zzdep.missing', 'x')]
+
+        assert pkgman.who_use('shared') == [('zzdep.a', 'top'),
+                                            ('zzdep.b', 'mid')]
+        assert pkgman.who_use('loop') == [('zzdep.a', 'loop'),
+                                          ('zzdep.a', 'loop2'),
+                                          ('zzdep.a', 'top')]
+
+        # the graph follows the changes of the packages
+        composite(b, 'user', ('zzdep.b', 'shared'))
+        assert ('zzdep.b', 'user') in pkgman.who_use('shared')
+        missing = Package('zzdep.missing', {})
+        composite(missing, 'x')
+        pkgman.add_package(missing)
+        assert pkgman.missing_dependencies(mid) is None
+    finally:
+        for name in ('zzdep.a', 'zzdep.b', 'zzdep.missing'):
+            if name in pkgman:
+                del pkgman[name]
+    assert not pkgman.who_use('shared')
+
+
+def test_load_package():
+    import shutil
+    import tempfile
+
+    wraleas = {
+        'a': '''
+from openalea.core.external import *
+__name__ = 'zzload.a'
+__all__ = ['top']
+top = CompositeNodeFactory(name='top',
+                           elt_factory={1: ('zzload.b', 'mid')})
+''',
+        'b': '''
+from openalea.core.external import *
+__name__ = 'zzload.b'
+__all__ = ['mid', 'leaf']
+mid = CompositeNodeFactory(name='mid',
+                           elt_factory={1: ('zzload.c', 'leaf')})
+leaf = Factory(name='leaf', nodemodule='nodes', nodeclass='Float')
+''',
+        'c': '''
+from openalea.core.external import *
+__name__ = 'zzload.c'
+__all__ = ['leaf']
+leaf = Factory(name='leaf', nodemodule='nodes', nodeclass='Float')
+''',
+        'd': '''
+from openalea.core.external import *
+__name__ = 'zzload.d'
+__all__ = ['top']
+top = CompositeNodeFactory(name='top',
+                           elt_factory={1: ('zzload.missing', 'x')})
+'''}
+
+    tmpdir = tempfile.mkdtemp()
+    instance = PackageManager._instance
+    try:
+        for name, text in wraleas.iteritems():
+            os.mkdir(os.path.join(tmpdir, name))
+            f = open(os.path.join(tmpdir, name, '__wralea__.py'), 'w')
+            f.write(text)
+            f.close()
+        cache = os.path.join(tmpdir, 'index')
+
+        def package_manager():
+            PackageManager._instance = None
+            pm = PackageManager()
+            pm.get_cache_filename = lambda: cache
+            pm.get_wralea_path = lambda: [tmpdir]
+            return pm
+
+        # index of the wralea files
+        pm = package_manager()
+        pm.find_and_register_packages()
+        names = pm.get_cache_names()
+        assert names[os.path.join(tmpdir, 'a', '__wralea__.py')] == ['zzload.a']
+
+        # only the packages used by top are registered
+        pm = package_manager()
+        assert pm.load_package('zzload.a', 'top')
+        assert set(pm.keys()) == set(['zzload.a', 'zzload.b', 'zzload.c'])
+        assert pm.dependencies(pm['zzload.a']['top']) == [
+            ('zzload.b', 'mid'), ('zzload.c', 'leaf')]
+
+        pm = package_manager()
+        assert pm.load_package('zzload.c')
+        assert pm.keys() == ['zzload.c']
+
+        # not found
+        pm = package_manager()
+        assert not pm.load_package('zzload.nothere')
+        assert not pm.load_package('zzload.a', 'nothere')
+        assert not pm.load_package('zzload.d', 'top')
+    finally:
+        PackageManager._instance = instance
+        shutil.rmtree(tmpdir)
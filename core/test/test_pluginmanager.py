@@ -235,6 +235,50 @@ class TestPluginManager(unittest.TestCase):
         self.pm.debug = False
         self.pm.items('test.err1')
 
+    def test_entry_point_index(self):
+        import pkg_resources
+        from openalea.core.entrypoints import EntryPointIndex
+
+        index = EntryPointIndex(self.tmppath / 'ep_index')
+        for group in ('test.c1', 'test.c2', 'wralea'):
+            eps = [str(ep) for ep in pkg_resources.iter_entry_points(group)]
+            assert [str(ep) for ep in index.iter_entry_points(group)] == eps
+
+        ep = list(index.iter_entry_points('test.c2', 'Plugin1'))[0]
+        import tstpkg1.plugin
+        assert ep.load() is tstpkg1.plugin.C2Plugin1
+
+        # read from the file
+        index.set_data('test', 1)
+        index = EntryPointIndex(self.tmppath / 'ep_index')
+        assert index.get_data('test') == 1
+
+    def test_lazy_plugin(self):
+        from openalea.core.plugin.manager import LazyPlugin
+        import tstpkg1.plugin
+        import tstpkg1.impl
+
+        self.pm.items('test.c2')
+
+        # described plugins are registered without loading them
+        pm = PluginManager()
+        plugins = pm.items('test.c2')
+        assert len(plugins) == 2
+        assert all(type(pl) is LazyPlugin for pl in plugins)
+        plugin = pm.item('C2Plugin1', 'test.c2')
+        assert plugin._plugin is None
+        assert plugin.name_conversion == 0
+        assert plugin._plugin is None
+
+        assert plugin.implementation is tstpkg1.impl.C2Class1
+        assert isinstance(plugin, tstpkg1.plugin.C2Plugin1)
+        assert plugin._plugin is not None
+
+        pm = PluginManager()
+        pm.lazy = False
+        plugins = pm.items('test.c2')
+        assert not any(type(pl) is LazyPlugin for pl in plugins)
+
     @classmethod
     def tearDownClass(cls):
         cls.tmppath.rmtree()
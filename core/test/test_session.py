@@ -89,3 +89,56 @@ def test_save_workspace():
     assert type(i) == type(instance)
     #assert i.node_id[addid].get_input(0) == 3
 #test_save_workspace()
+
+
+def test_save_incremental():
+    import shutil
+    from openalea.core import session
+
+    asession = Session()
+    datapool = asession.datapool
+    datapool.clear()
+
+    datapool['small'] = [1, 2, 3]
+    datapool['big'] = 'x' * session.INLINE_SIZE
+    datapool['bad'] = lambda x: x   # not picklable: skipped
+
+    try:
+        asession.save('test_inc.pic')
+        files = os.listdir('test_inc.pic.data')
+        assert len(files) == 1
+
+        asession.load('test_inc.pic')
+        assert 'bad' not in datapool
+        # values are loaded on first access
+        assert datapool.get_lazy('big') is not None
+        assert datapool['small'] == [1, 2, 3]
+        assert datapool.get_lazy('small') is None
+
+        # unchanged values are not written again
+        asession.save('test_inc.pic')
+        assert os.listdir('test_inc.pic.data') == files
+        assert datapool['big'] == 'x' * session.INLINE_SIZE
+        asession.save()
+        assert os.listdir('test_inc.pic.data') == files
+
+        datapool['big'] = 'y' * session.INLINE_SIZE
+        asession.save()
+        new_files = os.listdir('test_inc.pic.data')
+        assert len(new_files) == 1 and new_files != files
+
+        # values not loaded yet are copied in another session
+        asession.load('test_inc.pic')
+        asession.save('test_copy.pic')
+        asession.load('test_copy.pic')
+        assert datapool['big'] == 'y' * session.INLINE_SIZE
+
+        del datapool['big']
+        asession.save()
+        assert not os.path.exists('test_copy.pic.data')
+    finally:
+        for name in ('test_inc.pic', 'test_copy.pic'):
+            if os.path.exists(name):
+                os.remove(name)
+            shutil.rmtree(name + '.data', ignore_errors=True)
+        datapool.clear()
@@ -0,0 +1,180 @@
+# -*- python -*-
+#
+#       OpenAlea.Core
+#
+#       Copyright 2006-2009 INRIA - CIRAD - INRA
+#
+#       Distributed under the Cecill-C License.
+#       See accompanying file LICENSE.txt or copy at
+#           http://www.cecill.info/licences/Licence_CeCILL-C_V1-en.html
+#
+#       OpenAlea WebSite : http://openalea.gforge.inria.fr
+#
+"""Test the parameter sweeps"""
+
+__license__ = "Cecill-C"
+__revision__ = " $Id$ "
+
+import os
+import json
+import time
+import shutil
+import tempfile
+
+from openalea.core.pkgmanager import PackageManager
+from openalea.core.package import Package
+from openalea.core.node import NodeFactory
+from openalea.core.compositenode import CompositeNode, CompositeNodeFactory
+from openalea.core.sweep import Sweep, grid, read_table, parse_grid
+
+tmpdir = None
+
+
+def setup():
+    global tmpdir
+    tmpdir = tempfile.mkdtemp()
+
+    pm = PackageManager()
+    pm.add_wralea_path(os.path.join(os.getcwd(), "pkg"), pm.user_wralea_path)
+    pm.init()
+
+    # composite node computing a + b
+    cn = CompositeNode(inputs=[dict(name='a', value=0),
+                               dict(name='b', value=0)],
+                       outputs=[dict(name='c')])
+    plus = cn.add_node(pm['pkg_test']['+'].instantiate())
+    cn.connect(cn.id_in, 0, plus, 0)
+    cn.connect(cn.id_in, 1, plus, 1)
+    cn.connect(plus, 0, cn.id_out, 0)
+    factory = CompositeNodeFactory(name='sum')
+    cn.to_factory(factory)
+
+    pkg = Package('zzsweep', {})
+    pkg.add_factory(factory)
+    # iterators can not be pickled
+    pkg.add_factory(NodeFactory(name='iter', nodemodule='__builtin__',
+                                nodeclass='iter',
+                                inputs=[dict(name='a', value=[])]))
+    # the worker process exits
+    pkg.add_factory(NodeFactory(name='exit', nodemodule='os',
+                                nodeclass='_exit',
+                                inputs=[dict(name='n', value=1)]))
+    pkg.add_factory(NodeFactory(name='exit_or_sleep',
+                                nodemodule='test_sweep',
+                                nodeclass='exit_or_sleep',
+                                inputs=[dict(name='t', value=0)]))
+    pm.add_package(pkg)
+
+
+def exit_or_sleep(t):
+    """ Exit the worker process if t is 0, else wait t seconds """
+    if t == 0:
+        os._exit(1)
+    time.sleep(t)
+    return t
+
+
+def teardown():
+    del PackageManager()['zzsweep']
+    shutil.rmtree(tmpdir)
+
+
+def read_results(filename):
+    f = open(filename)
+    try:
+        return dict((r['row'], r) for r in map(json.loads, f))
+    finally:
+        f.close()
+
+
+def test_rows():
+    rows = list(grid(parse_grid(['a=1,2', "b='x',[1]"])))
+    assert rows == [dict(a=1, b='x'), dict(a=1, b=[1]),
+                    dict(a=2, b='x'), dict(a=2, b=[1])]
+
+    filename = os.path.join(tmpdir, 'table.csv')
+    f = open(filename, 'w')
+    f.write('a,b\n1,2.5\n3,text\n')
+    f.close()
+    assert list(read_table(filename)) == [dict(a=1, b=2.5),
+                                          dict(a=3, b='text')]
+
+
+def test_sweep():
+    output = os.path.join(tmpdir, 'results.jsonl')
+    rows = list(grid([('a', [1, 2, 3]), ('b', [10, 'x'])]))
+
+    for processes in (0, 2):
+        sweep = Sweep(('zzsweep', 'sum'), rows, output, processes=processes,
+                      max_in_flight=3)
+        assert sweep.run() == (3, 3, 0)
+        results = read_results(output)
+        assert len(results) == 6
+        assert results[2]['outputs'] == [12]
+        assert results[2]['inputs'] == dict(a=2, b=10)
+        assert 'TypeError' in results[3]['error']
+        assert results[3]['attempts'] == 2
+
+    # inputs missing in a row keep their default value
+    Sweep(('zzsweep', 'sum'), [dict(a=1)], output, processes=0).run()
+    assert read_results(output)[0]['outputs'] == [1]
+
+
+def test_resume():
+    output = os.path.join(tmpdir, 'resume.jsonl')
+    rows = [dict(a=i, b=1) for i in range(5)]
+
+    # interrupted sweep
+    Sweep(('zzsweep', 'sum'), rows[:2], output, processes=0).run()
+    f = open(output, 'a')
+    f.write('{"row": 4, "outp')
+    f.close()
+
+    rows[1]['b'] = 'x'  # not evaluated again
+    sweep = Sweep(('zzsweep', 'sum'), rows, output, processes=0,
+                  resume=True)
+    assert sweep.run() == (3, 0, 2)
+    results = read_results_lines(output)
+    assert sorted(results) == range(5)
+    assert results[1]['outputs'] == [2]
+
+
+def read_results_lines(filename):
+    results = {}
+    for line in open(filename):
+        try:
+            r = json.loads(line)
+        except ValueError:
+            continue
+        results[r['row']] = r
+    return results
+
+
+def test_lost_rows():
+    output = os.path.join(tmpdir, 'lost.jsonl')
+
+    # outputs which can not be sent back by the workers
+    sweep = Sweep(('zzsweep', 'iter'), [dict(a=[1]), dict(a=[2])], output,
+                  processes=2, retries=0)
+    assert sweep.run() == (0, 2, 0)
+    results = read_results(output)
+    assert 'not picklable' in results[0]['error']
+
+    # worker processes which die
+    sweep = Sweep(('zzsweep', 'exit'), [dict(n=1)], output, processes=2)
+    assert sweep.run() == (0, 1, 0)
+    results = read_results(output)
+    assert 'died' in results[0]['error']
+    assert results[0]['attempts'] == 2
+
+    # only the row of the dead worker is lost, not the rows in flight on
+    # the other workers
+    rows = [dict(t=1), dict(t=1), dict(t=0), dict(t=1), dict(t=0.1)]
+    sweep = Sweep(('zzsweep', 'exit_or_sleep'), rows, output, processes=3,
+                  retries=0)
+    sweep.POLL_INTERVAL = 0.1
+    assert sweep.run() == (4, 1, 0)
+    results = read_results(output)
+    assert 'died' in results[2]['error']
+    assert [results[i]['outputs'] for i in (0, 1, 3, 4)] == \
+        [[1], [1], [1], [0.1]]